@@ -0,0 +1,119 @@
+"""Допуск CPU-тяжёлой работы по полосам: image, video, blur и interactive.
+
+У каждой полосы свой лимит одновременно выполняемых запросов и своя
+ограниченная очередь ждущих. Когда очередь полна, запрос сразу получает 503
+с Retry-After, а не ждёт вместе со всеми: при всплеске загрузок медленными
+становятся только лишние запросы, а не все.
+
+interactive — рендер вариантов для get_file. Его задачи в пуле процессов
+получают освободившийся процесс раньше загрузок (workers.PRIORITY_INTERACTIVE),
+поэтому скачивание не стоит в очереди за обработкой загрузок.
+"""
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+import metrics
+from conf import ADMISSION_LANES
+from workers import run_in_pool, PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+
+queue_seconds = metrics.Histogram("media_admission_queue_seconds",
+                                  "Time spent waiting for an admission slot", ("lane",))
+rejected_total = metrics.Counter("media_admission_rejected_total",
+                                 "Requests rejected with 503 because the lane queue was full", ("lane",))
+
+# Вес нового замера в скользящем среднем времени выполнения (для Retry-After)
+_EWMA_WEIGHT = 0.2
+_MAX_RETRY_AFTER = 60
+
+
+class Lane:
+    """Полоса допуска: не больше concurrency выполняемых и queue_size ждущих запросов."""
+
+    def __init__(self, name: str, concurrency: int, queue_size: int, priority: int = PRIORITY_NORMAL):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.priority = priority
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._duration = 1.0  # Скользящее среднее времени выполнения, секунды
+        self._semaphore = None
+
+    @property
+    def full(self) -> bool:
+        return self.active >= self.concurrency and self.waiting >= self.queue_size
+
+    def retry_after(self) -> int:
+        """Оценка, через сколько секунд освободится место в очереди."""
+        backlog = (self.waiting + 1) / max(self.concurrency, 1)
+        return min(max(1, math.ceil(self._duration * backlog)), _MAX_RETRY_AFTER)
+
+    def check(self):
+        """503, если полоса заполнена. Вызывается до приёма тела запроса."""
+        if self.full:
+            self.rejected += 1
+            rejected_total.inc(self.name)
+            raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                                headers={"Retry-After": str(self.retry_after())})
+
+    @asynccontextmanager
+    async def admit(self, bounded: bool = True):
+        """Ждёт места в полосе. bounded=False — ждать без лимита очереди (фоновые задачи)."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if bounded:
+            self.check()
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        queue_seconds.observe(time.perf_counter() - start, self.name)
+
+        self.active += 1
+        self.admitted += 1
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            self._duration += _EWMA_WEIGHT * (time.perf_counter() - start - self._duration)
+
+    async def run(self, func, *args, **kwargs):
+        """run_in_pool внутри полосы, с её приоритетом в пуле процессов."""
+        async with self.admit():
+            return await run_in_pool(func, *args, priority=self.priority, **kwargs)
+
+    def stats(self) -> dict:
+        return {"concurrency": self.concurrency, "queue_size": self.queue_size, "active": self.active,
+                "waiting": self.waiting, "admitted": self.admitted, "rejected": self.rejected}
+
+
+lanes = {name: Lane(name, concurrency, queue_size,
+                    PRIORITY_INTERACTIVE if name == "interactive" else PRIORITY_NORMAL)
+         for name, (concurrency, queue_size) in ADMISSION_LANES.items()}
+for _lane in lanes.values():
+    metrics.register_queue(f"admission_{_lane.name}", lambda lane=_lane: lane.waiting)
+metrics.Collected("media_admission_active", "Requests currently admitted per lane", ("lane",),
+                  lambda: {(name,): lane.active for name, lane in lanes.items()})
+
+
+def for_type(file_type: str) -> Lane | None:
+    """Полоса обработки загрузки по MIME-типу или виду файла; аудио не обрабатывается."""
+    for kind in ("image", "video"):
+        if file_type.startswith(kind):
+            return lanes[kind]
+    return None
+
+
+def stats() -> dict:
+    return {name: lane.stats() for name, lane in lanes.items()}
@@ -0,0 +1,166 @@
+import functools
+import hashlib
+import io
+import re
+import unicodedata
+
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, ImageDraw, ImageFont
+
+import metrics
+from cache import TTLCache
+from conf import AVATAR_SIZES, AVATAR_FONTS, AVATAR_CACHE_SIZE
+
+BACKGROUND_COLORS = [
+    ((230, 230, 230), (0, 0, 0)),  # Светлый серый
+    ((220, 220, 220), (0, 0, 0)),  # Серый
+    ((200, 200, 200), (0, 0, 0)),  # Тёмно-серый
+    ((190, 190, 190), (0, 0, 0)),  # Стальной серый
+    ((180, 180, 180), (0, 0, 0)),  # Графитовый
+    ((160, 160, 160), (0, 0, 0)),  # Угольно-серый
+    ((140, 140, 140), (255, 255, 255)),  # Тёмно-серый (белый текст)
+    ((120, 120, 120), (255, 255, 255)),  # Антрацитовый
+    ((100, 100, 100), (255, 255, 255)),  # Чёрный жемчуг
+    ((80, 80, 80), (255, 255, 255)),  # Графитовый
+    ((60, 60, 60), (255, 255, 255)),  # Темно-угольный
+    ((40, 40, 40), (255, 255, 255)),  # Почти чёрный
+    ((255, 239, 213), (0, 0, 0)),  # Персиковый
+    ((255, 228, 196), (0, 0, 0)),  # Бежевый
+    ((255, 218, 185), (0, 0, 0)),  # Песочный
+    ((250, 235, 215), (0, 0, 0)),  # Античный белый
+    ((255, 182, 193), (0, 0, 0)),  # Розовый
+    ((255, 160, 122), (0, 0, 0)),  # Лососевый
+    ((233, 150, 122), (0, 0, 0)),  # Персиково-оранжевый
+    ((210, 180, 140), (0, 0, 0)),  # Светло-коричневый
+    ((244, 164, 96), (0, 0, 0)),  # Тёмно-персиковый
+    ((218, 165, 32), (0, 0, 0)),  # Золотистый
+    ((184, 134, 11), (255, 255, 255)),  # Тёмно-золотистый
+    ((189, 183, 107), (0, 0, 0)),  # Оливковый
+    ((143, 188, 143), (0, 0, 0)),  # Тёмно-зелёный
+    ((60, 179, 113), (0, 0, 0)),  # Средне-зелёный
+    ((46, 139, 87), (255, 255, 255)),  # Морской волны
+    ((102, 205, 170), (0, 0, 0)),  # Аквамариновый
+    ((175, 238, 238), (0, 0, 0)),  # Голубоватый
+    ((72, 209, 204), (0, 0, 0)),  # Бирюзовый
+    ((0, 255, 255), (0, 0, 0)),  # Ярко-голубой
+    ((70, 130, 180), (255, 255, 255)),  # Стальной синий
+    ((100, 149, 237), (255, 255, 255)),  # Голубой Корнфлауэр
+    ((30, 144, 255), (255, 255, 255)),  # Ярко-голубой
+    ((25, 25, 112), (255, 255, 255)),  # Тёмно-синий
+    ((123, 104, 238), (255, 255, 255)),  # Средний сланцевый синий
+    ((72, 61, 139), (255, 255, 255)),  # Тёмно-фиолетовый
+    ((255, 140, 0), (0, 0, 0)),  # Оранжевый
+    ((255, 165, 0), (0, 0, 0)),  # Тёмно-оранжевый
+    ((218, 112, 214), (0, 0, 0)),  # Орхидея
+    ((199, 21, 133), (255, 255, 255)),  # Розово-фиолетовый
+    ((255, 20, 147), (0, 0, 0)),  # Темно-розовый
+    ((176, 224, 230), (0, 0, 0)),  # Светло-голубой
+    ((173, 255, 47), (0, 0, 0)),  # Жёлто-зелёный
+    ((124, 252, 0), (0, 0, 0)),  # Ярко-зелёный
+    ((50, 205, 50), (0, 0, 0)),  # Лаймовый
+    ((0, 255, 127), (0, 0, 0)),  # Весенне-зелёный
+    ((47, 79, 79), (255, 255, 255)),  # Тёмный серо-зелёный
+    ((119, 136, 153), (255, 255, 255)),  # Синий серый
+]
+
+# Плоская заливка и текст: без прореживания цвета, иначе края букв плывут
+AVATAR_JPEG_OPTIONS = {"quality": 90, "subsampling": "4:4:4"}
+MAX_INITIALS = 2
+
+_NAME_RE = re.compile(r"^(?P<initials>[^_/]{1,8})_(?P<width>\d+)x(?P<height>\d+)_(?P<palette>\d{2})\.jpg$")
+
+# Закодированные JPEG по имени файла; содержимое по имени не меняется, поэтому без TTL
+avatar_cache = TTLCache(AVATAR_CACHE_SIZE, float("inf"))
+metrics.register_cache("avatars", avatar_cache.stats)
+
+
+def _first_grapheme(word: str) -> str:
+    """Первая буква или цифра слова вместе с комбинируемыми знаками (й, ё в NFD)."""
+    word = unicodedata.normalize("NFC", word)
+    for n, char in enumerate(word):
+        if unicodedata.category(char)[0] in "LN":
+            end = n + 1
+            while end < len(word) and unicodedata.combining(word[end]):
+                end += 1
+            return word[n:end]
+    return ""
+
+
+def initials(string: str) -> str:
+    """Инициалы строки: по первой букве первых MAX_INITIALS слов, в верхнем регистре."""
+    letters = [_first_grapheme(word) for word in re.split(r"[\s_\-.]+", string)]
+    letters = [letter for letter in letters if letter][:MAX_INITIALS]
+    # upper() может удлинить букву (ß -> SS), поэтому по одной
+    return "".join(letter.upper() if len(letter.upper()) == len(letter) else letter for letter in letters)
+
+
+def _valid_initials(text: str) -> bool:
+    letters = [char for char in text if not unicodedata.combining(char)]
+    return 0 < len(letters) <= MAX_INITIALS and all(unicodedata.category(char)[0] in "LNM" for char in text)
+
+
+def palette_index(string: str) -> int:
+    """Цвет из палитры по хэшу строки: одинаковый на всех серверах и при каждом запросе."""
+    digest = hashlib.sha256(string.strip().casefold().encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % len(BACKGROUND_COLORS)
+
+
+def avatar_name(text: str, size: tuple, palette: int) -> str:
+    return f"{text}_{size[0]}x{size[1]}_{palette:02d}.jpg"
+
+
+def parse_name(name: str) -> tuple[str, tuple, int] | None:
+    """Разбирает имя аватара; None, если это не аватар или параметры не разрешены."""
+    match = _NAME_RE.match(name)
+    if match is None:
+        return None
+    size = (int(match["width"]), int(match["height"]))
+    palette = int(match["palette"])
+    text = match["initials"]
+    if size not in AVATAR_SIZES or palette >= len(BACKGROUND_COLORS) or not _valid_initials(text):
+        return None
+    return text, size, palette
+
+
+@functools.lru_cache(maxsize=16)
+def _font(size: int) -> ImageFont.FreeTypeFont:
+    """Шрифт нужного кегля; загружается один раз на процесс."""
+    for path in AVATAR_FONTS:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+def render(text: str, size: tuple, palette: int) -> bytes:
+    background, text_color = BACKGROUND_COLORS[palette]
+    image = Image.new("RGB", size, background)
+    draw = ImageDraw.Draw(image)
+    # Две буквы мельче одной, чтобы поместились с полями
+    font = _font(int(size[1] * (0.5 if len(text) == 1 else 0.4)))
+    draw.text((size[0] / 2, size[1] / 2), text, font=font, fill=text_color, anchor="mm")
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", **AVATAR_JPEG_OPTIONS)
+    return buffer.getvalue()
+
+
+def warm_up():
+    """Загружает шрифты всех кеглей и кодировщик JPEG до первого запроса."""
+    for size in AVATAR_SIZES:
+        for text in ("A", "AB"):
+            render(text, size, 0)
+
+
+async def get_avatar(text: str, size: tuple, palette: int) -> bytes:
+    """JPEG аватара из памяти, при промахе рендерится в пуле потоков и кладётся в LRU.
+
+    TTLCache не потокобезопасен, поэтому кэш читается и пишется только в цикле событий.
+    """
+    name = avatar_name(text, size, palette)
+    data = avatar_cache.get(name)
+    if data is None:
+        data = await run_in_threadpool(render, text, size, palette)
+        avatar_cache.set(name, data)
+    return data
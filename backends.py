@@ -0,0 +1,54 @@
+"""Реестр тяжёлых библиотек обработки медиа, которые импортируются при первом использовании.
+
+ffmpeg-python и mutagen нужны только процессам пула, а services.py
+импортирует каждый воркер uvicorn и tests.py. Библиотека регистрируется под
+именем и импортируется один раз при первом get(); warm_up() импортирует
+заранее (lifespan, процессы пула).
+"""
+import importlib
+import time
+
+import metrics
+
+_registry = {}  # Имя -> модуль для importlib
+_modules = {}
+_import_seconds = {}
+
+
+def register(name: str, module: str):
+    _registry[name] = module
+
+
+register("ffmpeg", "ffmpeg")
+register("mutagen.mp3", "mutagen.mp3")
+register("mutagen.wave", "mutagen.wave")
+
+
+def get(name: str):
+    """Модуль библиотеки name, импортируется при первом вызове."""
+    module = _modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(_registry[name])
+        _import_seconds.setdefault(name, time.perf_counter() - start)
+        _modules[name] = module
+    return module
+
+
+def warm_up(names=None) -> dict:
+    """Импортирует библиотеки names (по умолчанию все) и возвращает время импорта каждой."""
+    for name in names or _registry:
+        get(name)
+    return dict(_import_seconds)
+
+
+def names() -> list[str]:
+    return list(_registry)
+
+
+def loaded() -> dict:
+    return dict(_import_seconds)
+
+
+metrics.Collected("media_backend_import_seconds", "Time spent importing a media backend in this process",
+                  ("backend",), lambda: {(name,): seconds for name, seconds in _import_seconds.items()})
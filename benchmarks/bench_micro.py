@@ -0,0 +1,98 @@
+"""Микро-бенчмарки обработки: resize_image, validate_file, probe_media,
+generate_video_preview и буквенные аватары.
+
+Функции вызываются прямо в процессе, без пула и HTTP, на синтетических
+файлах из media.py. Для каждого случая — пропускная способность,
+p50/p95/p99 и пиковый RSS процесса за время замера.
+
+    python benchmarks/bench_micro.py --repeat 10 --save-baseline micro.json
+    python benchmarks/bench_micro.py --baseline micro.json --only resize
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import common
+import media
+
+
+def _cases(files: list[tuple[str, str]]):
+    """(имя, функция без аргументов) для всех замеров."""
+    from conf import PHOTO_SIZES, AVATAR_SIZES
+    import avatars
+    from services import resize_image, validate_file, probe_media, generate_video_preview
+
+    counter = iter(range(10 ** 9))
+    for path, mimetype in files:
+        name = os.path.basename(path)
+        if mimetype.startswith("image"):
+            yield (f"resize_image/{name}",
+                   lambda path=path: resize_image(path, PHOTO_SIZES, stem=f"bench{next(counter)}",
+                                                  remove_source=False))
+        yield f"probe_media/{name}", lambda path=path, mimetype=mimetype: probe_media(path, mimetype)
+        yield f"validate_file/{name}", lambda path=path: validate_file(path)
+        if mimetype.startswith("video"):
+            metadata = probe_media(path, mimetype)
+            yield (f"generate_video_preview/{name}",
+                   lambda path=path, metadata=metadata: generate_video_preview(
+                       path, metadata, PHOTO_SIZES, stem=f"bench{next(counter)}"))
+
+    # Бывший generate_image_from_string: рендер без кэша, как при первом запросе
+    for size in AVATAR_SIZES:
+        yield (f"avatar_render/{size[0]}x{size[1]}",
+               lambda size=size: avatars.render("ИП", size, avatars.palette_index("Иван Петров")))
+
+
+def run_case(func, repeat: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        func()
+    common.reset_peak_rss()
+    latencies = []
+    cpu_start, wall_start = common.cpu_seconds(), time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+    return common.summarize(latencies, wall,
+                            cpu_ms=round((common.cpu_seconds() - cpu_start) / repeat * 1000, 2),
+                            peak_rss_mb=round(common.rss_mb(), 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="повторов на случай")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--media", type=os.path.abspath,
+                        help="каталог синтетических файлов (создаётся и переиспользуется между запусками)")
+    parser.add_argument("--only", action="append", help="запускать случаи, содержащие подстроку")
+    common.add_report_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = common.prepare_workdir("bench_micro_")
+    try:
+        media_dir = args.media or os.path.join(workdir, "media")
+        if not media.has_ffmpeg():
+            print("ffmpeg не найден: видео и MP3 пропущены", file=sys.stderr)
+        files = media.generate(media_dir)
+
+        from conf import UPLOAD_DIR
+        results = {}
+        for name, func in _cases(files):
+            if args.only and not any(part in name for part in args.only):
+                continue
+            results[name] = run_case(func, args.repeat, args.warmup)
+            # Варианты от прошлого случая не нужны и только занимают диск
+            shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
+            os.makedirs(os.path.join(UPLOAD_DIR, ".tmp"), exist_ok=True)
+            print(f"{name}: p50 {results[name]['p50_ms']:.1f} ms", file=sys.stderr)
+
+        return common.report(results, args)
+    finally:
+        common.remove_workdir(workdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Сравнение старого и нового resize_image: процессорное время и пиковая память на загрузку.
+
+Каждая реализация запускается в отдельном процессе, чтобы пиковый RSS
+(ru_maxrss) не смешивался. Файлы пишутся во временный каталог.
+
+    python benchmarks/bench_resize.py --repeat 5
+    python benchmarks/bench_resize.py --image photo.jpg
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from common import ROOT, cpu_seconds, reset_peak_rss, rss_mb, write_conf
+from media import make_image
+
+# Синтетические исходники: крупное фото с камеры, скриншот PNG, небольшое фото
+SYNTHETIC = [
+    ("camera_6000x4000.jpg", (6000, 4000), "JPEG"),
+    ("screenshot_2560x1440.png", (2560, 1440), "PNG"),
+    ("small_640x480.jpg", (640, 480), "JPEG"),
+]
+
+
+def legacy_resize(image_path, sizes, blur=None, stem=None, remove_source=True):
+    """resize_image до переработки: копия оригинала и thumbnail на каждый вариант."""
+    from PIL import Image, ImageFilter
+    import storage
+    from conf import LETTERS
+    from services import _save_atomic, get_file_url
+
+    paths = {}
+    new_path = None
+    with Image.open(image_path) as img:
+        for n, size in enumerate(sizes):
+            max_width, max_height = size
+            img_width, img_height = img.width, img.height
+            if img_width < max_width and img_height < max_height:
+                paths[f"{LETTERS[n]}"] = new_path or image_path
+                continue
+            aspect_ratio = img.width / img.height
+            if img_width > img_height:
+                new_width = max_width
+                new_height = int(new_width / aspect_ratio)
+            else:
+                new_height = max_height
+                new_width = int(new_height * aspect_ratio)
+            img_resized = img.copy()
+            img_resized.thumbnail((new_width, new_height))
+            if blur and n < len(blur):
+                img_resized = img_resized.filter(ImageFilter.GaussianBlur(radius=blur[n]))
+                new_path = storage.path_for(f"{stem or uuid.uuid4().hex}_{new_width}x{new_height}_blurred.jpg")
+            else:
+                new_path = storage.path_for(f"{stem or uuid.uuid4().hex}_{new_width}x{new_height}.jpg")
+            if img_resized.mode != "RGB":
+                img_resized = img_resized.convert("RGB")  # Старый код падал на RGBA
+            _save_atomic(img_resized, new_path, "JPEG")
+            paths[f"{LETTERS[n]}"] = get_file_url(new_path)
+    if remove_source:
+        os.remove(image_path)
+    return paths
+
+
+def run_worker(impl, image, repeat):
+    sys.path.insert(0, ROOT)
+    from conf import PHOTO_SIZES, UPLOAD_DIR
+    from services import resize_image
+
+    func = resize_image if impl == "new" else legacy_resize
+    baseline_rss = rss_mb("VmRSS:")
+    reset_peak_rss()
+    cpu_start, wall_start = cpu_seconds(), time.perf_counter()
+    for n in range(repeat):
+        func(image, PHOTO_SIZES, stem=f"bench{n}", remove_source=False)
+    cpu, wall = cpu_seconds() - cpu_start, time.perf_counter() - wall_start
+    output = [os.path.join(root, name) for root, _, names in os.walk(UPLOAD_DIR)
+              for name in names if name.startswith("bench0_")]
+    print(json.dumps({
+        "output_kb": sum(os.path.getsize(path) for path in output) / 1024,
+        "cpu_ms": cpu / repeat * 1000,
+        "wall_ms": wall / repeat * 1000,
+        "peak_rss_mb": rss_mb("VmHWM:"),
+        "rss_over_baseline_mb": rss_mb("VmHWM:") - baseline_rss,
+    }))
+
+
+def measure(impl, image, repeat, workdir):
+    # Отдельный каталог на замер, чтобы uploads/ не накапливал чужие варианты
+    workdir = tempfile.mkdtemp(dir=workdir)
+    # conf.py читает conf.ini из текущего каталога, uploads/ тоже создаётся в нём
+    write_conf(workdir)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", impl, "--repeat", str(repeat), "--image", image],
+        cwd=workdir, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", action="append", help="свои изображения вместо синтетических")
+    parser.add_argument("--repeat", type=int, default=3, help="загрузок на замер")
+    parser.add_argument("--worker", choices=("old", "new"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.image[0], args.repeat)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench_resize_")
+    try:
+        images = [os.path.abspath(image) for image in args.image or []]
+        if not images:
+            sys.path.insert(0, ROOT)
+            for name, size, image_format in SYNTHETIC:
+                path = os.path.join(workdir, name)
+                make_image(path, size, image_format)
+                images.append(path)
+
+        print(f"{'image':<28}{'impl':<6}{'cpu ms':>10}{'wall ms':>10}{'peak MB':>10}{'+RSS MB':>10}{'out KB':>10}")
+        for image in images:
+            results = {impl: measure(impl, image, args.repeat, workdir) for impl in ("old", "new")}
+            for impl, result in results.items():
+                print(f"{os.path.basename(image):<28}{impl:<6}{result['cpu_ms']:>10.1f}{result['wall_ms']:>10.1f}"
+                      f"{result['peak_rss_mb']:>10.1f}{result['rss_over_baseline_mb']:>10.1f}{result['output_kb']:>10.1f}")
+            speedup = results["old"]["cpu_ms"] / max(results["new"]["cpu_ms"], 1e-9)
+            print(f"{'':<28}{'x':<6}{speedup:>10.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
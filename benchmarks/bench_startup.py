@@ -0,0 +1,101 @@
+"""Время холодного старта: импорт main и services, импорт каждой библиотеки
+обработки (backends.py) и первая задача в только что запущенном пуле процессов.
+
+Каждый замер — отдельный свежий процесс python, как при старте воркера
+uvicorn или tests.py. Для каждого случая — p50/p95 и пиковый RSS процесса.
+Базовая линия ловит регрессии времени импорта: тяжёлая библиотека,
+снова импортированная на уровне модуля, сразу видна в import/main.
+
+    python benchmarks/bench_startup.py --repeat 10 --save-baseline startup.json
+    python benchmarks/bench_startup.py --baseline startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import common
+
+SCRIPT = """
+import json, time
+{setup}
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+with open("/proc/self/status") as status:
+    peak = next((int(line.split()[1]) / 1024 for line in status if line.startswith("VmHWM:")), 0.0)
+print(json.dumps({{"seconds": seconds, "peak_rss_mb": peak}}))
+"""
+
+POOL_SETUP = """
+import asyncio
+import backends
+from services import variant_family
+from workers import WorkerPool
+
+async def on_new_pool(func, *args, warm_up=False):
+    pool = WorkerPool(1, 0, 120, "spawn")
+    try:
+        if warm_up:
+            return await pool.warm_up(func, *args)
+        return await pool.run(func, *args)
+    finally:
+        pool.shutdown()
+"""
+
+
+def _cases() -> dict:
+    """Имя -> (подготовка, замеряемый код)."""
+    import backends
+
+    cases = {
+        "import/main": ("", "import main"),
+        "import/services": ("", "import services"),
+    }
+    for name in backends.names():
+        cases[f"backend/{name}"] = ("import backends", f"backends.get({name!r})")
+    # Запуск процесса и импорт services в нём, без библиотек обработки
+    cases["pool/first_task"] = (POOL_SETUP, "asyncio.run(on_new_pool(variant_family, 'x.jpg'))")
+    # То же с прогревом из lifespan (WARMUP=pool)
+    cases["pool/warm_up"] = (POOL_SETUP, "asyncio.run(on_new_pool(backends.warm_up, warm_up=True))")
+    return cases
+
+
+def run_case(setup: str, statement: str, repeat: int) -> dict:
+    env = {**os.environ, "PYTHONPATH": common.ROOT}
+    latencies, peaks = [], []
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", SCRIPT.format(setup=setup, statement=statement)],
+                                capture_output=True, text=True, env=env, check=True)
+        data = json.loads(output.stdout.strip().splitlines()[-1])
+        latencies.append(data["seconds"])
+        peaks.append(data["peak_rss_mb"])
+    return common.summarize(latencies, time.perf_counter() - wall_start, peak_rss_mb=round(max(peaks), 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="запусков на случай")
+    parser.add_argument("--only", action="append", help="запускать случаи, содержащие подстроку")
+    common.add_report_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = common.prepare_workdir("bench_startup_")
+    try:
+        results = {}
+        for name, (setup, statement) in _cases().items():
+            if args.only and not any(part in name for part in args.only):
+                continue
+            results[name] = run_case(setup, statement, args.repeat)
+            print(f"{name}: p50 {results[name]['p50_ms']:.1f} ms", file=sys.stderr)
+
+        return common.report(results, args)
+    finally:
+        common.remove_workdir(workdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
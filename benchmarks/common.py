@@ -0,0 +1,174 @@
+"""Общие части бенчмарков: рабочий каталог, замер памяти, перцентили и сравнение с базовой линией."""
+import configparser
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Минимальный conf.ini, если рядом с кодом своего нет
+DEFAULT_SETTINGS = {
+    "SERVER_ID": "1",
+    "PORT": "8000",
+    "SAVE_LOG_URL": "",
+    "LOG_SECRET": "",
+    "SECRET": "bench-secret",
+}
+
+
+def write_conf(directory: str, **settings):
+    """Пишет в directory conf.ini проекта, где settings переопределяют его значения."""
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(ROOT, "conf.ini"))
+    if not config.has_section("settings"):
+        config.add_section("settings")
+    for key, value in DEFAULT_SETTINGS.items():
+        if not config.has_option("settings", key):
+            config.set("settings", key, value)
+    for key, value in settings.items():
+        if value is not None:
+            config.set("settings", key, str(value))
+    with open(os.path.join(directory, "conf.ini"), "w") as conf_file:
+        config.write(conf_file)
+
+
+def prepare_workdir(prefix: str, **settings) -> str:
+    """Создаёт временный рабочий каталог с conf.ini и переходит в него.
+
+    conf.py читает conf.ini из текущего каталога и создаёт там uploads/,
+    поэтому бенчмарк не трогает файлы сервера.
+    """
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    write_conf(workdir, **settings)
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return workdir
+
+
+def remove_workdir(workdir: str):
+    os.chdir(ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss(pid="self"):
+    """Сбрасывает VmHWM (Linux), иначе пик останется от импорта библиотек обработки."""
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def rss_mb(field: str = "VmHWM:", pid="self") -> float:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != "self":
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # В Linux ru_maxrss в КБ
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль с линейной интерполяцией, как numpy.percentile по умолчанию."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(latencies: list, wall: float, errors: int = 0, **extra) -> dict:
+    """Сводка замера: latencies — секунды на операцию, wall — общее время замера."""
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        **extra,
+    }
+
+
+COLUMNS = [("count", "n", "{:>8}"), ("errors", "err", "{:>6}"), ("throughput", "op/s", "{:>10.1f}"),
+           ("p50_ms", "p50 ms", "{:>10.1f}"), ("p95_ms", "p95 ms", "{:>10.1f}"), ("p99_ms", "p99 ms", "{:>10.1f}"),
+           ("cpu_ms", "cpu ms", "{:>10.1f}"), ("peak_rss_mb", "peak MB", "{:>10.1f}"),
+           ("workers_peak_rss_mb", "pool MB", "{:>10.1f}")]
+
+
+def print_table(results: dict):
+    columns = [column for column in COLUMNS if any(column[0] in result for result in results.values())]
+    header = "".join(f"{title:>{len(fmt.format(0))}}" for _, title, fmt in columns)
+    print(f"{'benchmark':<36}{header}")
+    for name, result in results.items():
+        row = "".join(fmt.format(result.get(key, 0)) for key, _, fmt in columns)
+        print(f"{name:<36}{row}")
+
+
+def save_baseline(path: str, results: dict):
+    with open(path, "w") as baseline_file:
+        json.dump(results, baseline_file, indent=2, ensure_ascii=False)
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> bool:
+    """Печатает изменения относительно сохранённой базовой линии.
+
+    Регрессия — рост p50/p95 или падение пропускной способности больше чем
+    на threshold процентов. Возвращает True, если регрессий нет.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    ok = True
+    print(f"\n{'benchmark':<36}{'metric':>12}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<36}{'(нет в базовой линии)':>46}")
+            continue
+        for key, higher_is_better in (("p50_ms", False), ("p95_ms", False), ("throughput", True)):
+            old, new = base.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            regression = change < -threshold if higher_is_better else change > threshold
+            ok = ok and not regression
+            mark = "  REGRESSION" if regression else ""
+            print(f"{name:<36}{key:>12}{old:>12.1f}{new:>12.1f}{change:>+9.1f}%{mark}")
+    return ok
+
+
+def add_report_arguments(parser):
+    # Пути приводятся к абсолютным сразу: дальше бенчмарк работает во временном каталоге
+    parser.add_argument("--save-baseline", metavar="PATH", type=os.path.abspath,
+                        help="сохранить результаты как базовую линию (JSON)")
+    parser.add_argument("--baseline", metavar="PATH", type=os.path.abspath,
+                        help="сравнить с сохранённой базовой линией")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="допустимое ухудшение в процентах, иначе код выхода 1 (по умолчанию 10)")
+
+
+def report(results: dict, args) -> int:
+    """Печатает таблицу, сохраняет/сравнивает базовую линию. Возвращает код выхода."""
+    print_table(results)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+    if args.baseline and not compare(results, args.baseline, args.threshold):
+        return 1
+    return 0
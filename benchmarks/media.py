@@ -0,0 +1,115 @@
+"""Синтетические медиафайлы для бенчмарков: изображения разного размера, короткие видео и аудио.
+
+Изображения и WAV генерируются на Python, видео и MP3 — локальным ffmpeg
+(если его нет, эти файлы пропускаются).
+
+    python benchmarks/media.py /tmp/media
+"""
+import argparse
+import math
+import os
+import shutil
+import struct
+import subprocess
+import wave
+
+# (имя, размер, формат Pillow) — от аватарки до фото с 24-мегапиксельной камеры
+IMAGES = [
+    ("photo_0.3mp.jpg", (640, 480), "JPEG"),
+    ("photo_2mp.jpg", (1920, 1080), "JPEG"),
+    ("photo_12mp.jpg", (4000, 3000), "JPEG"),
+    ("photo_24mp.jpg", (6000, 4000), "JPEG"),
+    ("screenshot_3.7mp.png", (2560, 1440), "PNG"),
+]
+# (имя, секунды, размер кадра)
+VIDEOS = [
+    ("clip_5s_720p.mp4", 5, (1280, 720)),
+    ("clip_30s_1080p.mp4", 30, (1920, 1080)),
+]
+# (имя, секунды)
+AUDIO = [
+    ("tone_10s.wav", 10),
+    ("tone_60s.mp3", 60),
+]
+
+MIMETYPES = {".jpg": "image/jpeg", ".png": "image/png", ".mp4": "video/mp4",
+             ".wav": "audio/wav", ".mp3": "audio/mpeg"}
+
+
+def has_ffmpeg() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def make_image(path: str, size: tuple, image_format: str):
+    """Фото-подобное изображение: градиент с шумом, чтобы JPEG не сжимался в ноль."""
+    from PIL import Image
+    noise = Image.effect_noise(size, 64).convert("RGB")
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    Image.blend(noise, gradient, 0.6).save(path, image_format, quality=92)
+
+
+def make_wav(path: str, seconds: float, rate: int = 44100, frequency: float = 440.0):
+    with wave.open(path, "wb") as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(rate)
+        frames = (int(12000 * math.sin(2 * math.pi * frequency * n / rate)) for n in range(int(seconds * rate)))
+        output.writeframes(b"".join(struct.pack("<h", frame) for frame in frames))
+
+
+def _ffmpeg(*args):
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", *args], check=True)
+
+
+def make_video(path: str, seconds: float, size: tuple):
+    """Тестовая таблица с движением и тоном: H.264 + AAC, как с телефона."""
+    _ffmpeg("-f", "lavfi", "-i", f"testsrc2=size={size[0]}x{size[1]}:rate=30:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path)
+
+
+def make_mp3(path: str, seconds: float):
+    _ffmpeg("-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}", "-c:a", "libmp3lame", path)
+
+
+def generate(directory: str, kinds=("image", "video", "audio")) -> list[tuple[str, str]]:
+    """Создаёт недостающие файлы в directory. Возвращает [(путь, mimetype)]."""
+    os.makedirs(directory, exist_ok=True)
+    ffmpeg = has_ffmpeg()
+    files = []
+
+    def target(name):
+        path = os.path.join(directory, name)
+        files.append((path, MIMETYPES[os.path.splitext(name)[1]]))
+        return None if os.path.exists(path) else path
+
+    if "image" in kinds:
+        for name, size, image_format in IMAGES:
+            if path := target(name):
+                make_image(path, size, image_format)
+    if "video" in kinds and ffmpeg:
+        for name, seconds, size in VIDEOS:
+            if path := target(name):
+                make_video(path, seconds, size)
+    if "audio" in kinds:
+        for name, seconds in AUDIO:
+            if name.endswith(".mp3") and not ffmpeg:
+                continue
+            if path := target(name):
+                make_wav(path, seconds) if name.endswith(".wav") else make_mp3(path, seconds)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory")
+    parser.add_argument("--kind", action="append", choices=("image", "video", "audio"))
+    args = parser.parse_args()
+    if not has_ffmpeg():
+        print("ffmpeg не найден: видео и MP3 пропущены")
+    for path, mimetype in generate(args.directory, args.kind or ("image", "video", "audio")):
+        print(f"{mimetype:<12}{os.path.getsize(path) / 1024:>10.0f} KB  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+from urllib.parse import unquote, urlparse
+
+from sqlalchemy import update, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import ContentBlob
+
+
+def result_files(result: dict) -> list[str]:
+    """Имена файлов на диске из всех ссылок ответа обработки."""
+    names = []
+
+    def walk(value):
+        if isinstance(value, dict):
+            for item in value.values():
+                walk(item)
+        elif isinstance(value, str):
+            names.append(os.path.basename(unquote(urlparse(value).path)))
+
+    walk(result.get("urls", {}))
+    return names
+
+
+async def find(db: AsyncSession, digest: str) -> ContentBlob | None:
+    return await db.get(ContentBlob, digest)
+
+
+async def add_reference(db: AsyncSession, digest: str, filename: str, file_type: str):
+    """Увеличивает счётчик ссылок на содержимое, создавая запись при первой загрузке."""
+    increment = (
+        update(ContentBlob)
+        .where(ContentBlob.digest == digest)
+        .values(refcount=ContentBlob.refcount + 1)
+    )
+    result = await db.execute(increment)
+    if result.rowcount:
+        return
+
+    try:
+        async with db.begin_nested():
+            db.add(ContentBlob(digest=digest, filename=filename, type=file_type,
+                               refcount=1, files=[filename]))
+    except IntegrityError:
+        # Параллельная загрузка того же содержимого успела создать запись
+        await db.execute(increment)
+
+
+async def store_result(db: AsyncSession, digest: str, result: dict):
+    """Запоминает результат обработки, чтобы следующие загрузки его переиспользовали."""
+    blob = await db.get(ContentBlob, digest)
+    if blob is None:
+        return
+    blob.result = {key: value for key, value in result.items() if key != "file"}
+    blob.files = sorted(set([blob.filename, *result_files(result)]))
+
+
+async def release(db: AsyncSession, digest: str, count: int = 1) -> list[str]:
+    """Уменьшает счётчик ссылок на count. Возвращает файлы, которые больше никому не нужны."""
+    result = await db.execute(
+        update(ContentBlob)
+        .where(ContentBlob.digest == digest)
+        .values(refcount=ContentBlob.refcount - count)
+        .returning(ContentBlob.refcount, ContentBlob.files)
+    )
+    row = result.first()
+    if row is None or row.refcount > 0:
+        return []
+
+    await db.execute(delete(ContentBlob).where(ContentBlob.digest == digest, ContentBlob.refcount <= 0))
+    return row.files or []
@@ -2,9 +2,33 @@ from fastapi import Header, HTTPException, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
+import metrics
+from cache import TTLCache
+from conf import AUTH_CACHE_SIZE, AUTH_CACHE_TTL, AUTH_NEGATIVE_CACHE_SIZE, AUTH_NEGATIVE_CACHE_TTL
 from database import get_db
 from models import User
 
+# Найденные пользователи и неверные ключи кэшируются раздельно, чтобы перебор
+# случайных ключей не вытеснял настоящих пользователей из кэша
+user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+invalid_key_cache = TTLCache(AUTH_NEGATIVE_CACHE_SIZE, AUTH_NEGATIVE_CACHE_TTL)
+metrics.register_cache("auth_users", user_cache.stats)
+metrics.register_cache("auth_invalid_keys", invalid_key_cache.stats)
+
+
+def invalidate_user(api_key: str):
+    """Сбрасывает кэш ключа после создания или удаления пользователя.
+
+    Действует только на текущий процесс, в остальных воркерах запись
+    устареет через AUTH_CACHE_TTL / AUTH_NEGATIVE_CACHE_TTL.
+    """
+    user_cache.pop(api_key)
+    invalid_key_cache.pop(api_key)
+
+
+def auth_cache_stats() -> dict:
+    return {"users": user_cache.stats(), "invalid_keys": invalid_key_cache.stats()}
+
 
 async def get_current_user(
     secret: str = Header(None),
@@ -13,12 +37,22 @@ async def get_current_user(
     if not secret:
         raise HTTPException(status_code=401, detail="SECRET header missing")
 
+    user = user_cache.get(secret)
+    if user is not None:
+        return user
+    if invalid_key_cache.get(secret):
+        raise HTTPException(status_code=403, detail="Invalid API key")
+
     result = await db.execute(
         select(User).where(User.api_key == secret)
     )
     user = result.scalar_one_or_none()
 
     if not user:
+        invalid_key_cache.set(secret, True)
         raise HTTPException(status_code=403, detail="Invalid API key")
 
+    # Объект отвязываем от сессии запроса: дальше он живёт только в кэше
+    db.expunge(user)
+    user_cache.set(secret, user)
     return user
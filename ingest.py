@@ -0,0 +1,340 @@
+import hashlib
+import os
+import tempfile
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from metrics import stage
+from conf import TMP_DIR, MAX_FILE_SIZES, UPLOAD_CHUNK_SIZE
+
+SNIFF_BYTES = 64
+QUOTA_EXCEEDED = "Storage quota exceeded"
+
+# Расширения, под которыми сохраняются распознанные типы
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+    "image/bmp": "bmp",
+    "image/tiff": "tiff",
+    "image/avif": "avif",
+    "video/mp4": "mp4",
+    "video/quicktime": "mov",
+    "video/webm": "webm",
+    "video/x-matroska": "mkv",
+    "video/x-msvideo": "avi",
+    "audio/mpeg": "mp3",
+    "audio/wav": "wav",
+    "audio/ogg": "ogg",
+    "audio/flac": "flac",
+    "audio/mp4": "m4a",
+}
+
+# Бренды контейнера ISO BMFF (ftyp). Неизвестный бренд — неизвестный тип, а не видео:
+# в том же контейнере лежат AVIF и HEIF
+_FTYP_BRANDS = {
+    **dict.fromkeys((b"M4A ", b"M4B ", b"M4P ", b"F4A "), "audio/mp4"),
+    b"qt  ": "video/quicktime",
+    **dict.fromkeys((b"isom", b"iso2", b"iso3", b"iso4", b"iso5", b"iso6", b"mp41", b"mp42", b"avc1",
+                     b"M4V ", b"M4VH", b"M4VP", b"3gp4", b"3gp5", b"3gp6", b"3g2a", b"dash", b"f4v ",
+                     b"mmp4", b"MSNV", b"XAVC"), "video/mp4"),
+    **dict.fromkeys((b"avif", b"avis"), "image/avif"),
+    # HEIC не принимается (нет в EXTENSIONS): Pillow его не декодирует
+    **dict.fromkeys((b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx"), "image/heic"),
+}
+# Общие бренды HEIF: AVIF это или HEIC, видно по совместимым брендам
+_HEIF_BRANDS = (b"mif1", b"msf1")
+
+
+def sniff_mimetype(head: bytes) -> str | None:
+    """Определяет тип файла по первым байтам (сигнатурам), а не по имени."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head.startswith(b"BM"):
+        return "image/bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    if head.startswith(b"RIFF") and len(head) >= 12:
+        kind = head[8:12]
+        if kind == b"WEBP":
+            return "image/webp"
+        if kind == b"WAVE":
+            return "audio/wav"
+        if kind == b"AVI ":
+            return "video/x-msvideo"
+        return None
+    if head[4:8] == b"ftyp":
+        return _ftyp_mimetype(head)
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm" if b"webm" in head else "video/x-matroska"
+    if head.startswith(b"ID3") or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return "audio/mpeg"
+    if head.startswith(b"OggS"):
+        return "audio/ogg"
+    if head.startswith(b"fLaC"):
+        return "audio/flac"
+    return None
+
+
+def _ftyp_mimetype(head: bytes) -> str | None:
+    """Тип по основному бренду ftyp, а если он неизвестен — по совместимым."""
+    size = int.from_bytes(head[:4], "big")
+    brands = [head[8:12], *(head[n:n + 4] for n in range(16, min(size, len(head)) - 3, 4))]
+    for brand in brands:
+        if brand in _FTYP_BRANDS:
+            return _FTYP_BRANDS[brand]
+    if any(brand in _HEIF_BRANDS for brand in brands):
+        return "image/heic"
+    return None
+
+
+class IngestedFile:
+    """Файл, принятый из multipart-запроса во временную директорию."""
+
+    def __init__(self, field: str, filename: str):
+        self.field = field
+        self.filename = filename
+        self.mimetype = None
+        self.size = 0
+        self.path = None
+        self.error = None
+        self.status_code = None
+        self.digest = None  # sha256 содержимого, считается во время приёма
+
+    @property
+    def kind(self) -> str | None:
+        return self.mimetype.split("/")[0] if self.mimetype else None
+
+    @property
+    def extension(self) -> str | None:
+        return EXTENSIONS.get(self.mimetype)
+
+    async def save(self, file_path: str):
+        """Атомарно переносит временный файл на постоянное место."""
+        await run_in_threadpool(os.replace, self.path, file_path)
+        self.path = None
+
+    async def discard(self):
+        if self.path:
+            path, self.path = self.path, None
+            await run_in_threadpool(_unlink, path)
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _format_size(size: int) -> str:
+    if size % (1024 ** 3) == 0:
+        return f"{size // 1024 ** 3}GB"
+    return f"{size // 1024 ** 2}MB"
+
+
+def _open_temp():
+    fd, path = tempfile.mkstemp(dir=TMP_DIR, suffix=".part")
+    return os.fdopen(fd, "wb"), path
+
+
+class _PartWriter:
+    """Пишет одну часть multipart-запроса на диск, проверяя тип и размер по ходу."""
+
+    def __init__(self, upload: IngestedFile, allowed: tuple, budget: int = None):
+        self.upload = upload
+        self.allowed = allowed
+        self.budget = budget  # Остаток квоты пользователя, None — без ограничения
+        self.limit = None
+        self.buffer = bytearray()
+        self.file = None
+        self.hash = hashlib.sha256()
+
+    def fail(self, status_code: int, detail: str):
+        self.upload.status_code = status_code
+        self.upload.error = detail
+
+    def _check_type(self):
+        upload = self.upload
+        upload.mimetype = sniff_mimetype(bytes(self.buffer[:SNIFF_BYTES]))
+        if upload.kind not in self.allowed or upload.extension is None:
+            self.fail(400, f"Invalid file type: {upload.mimetype}")
+            return
+        self.limit = MAX_FILE_SIZES[upload.kind]
+
+    async def write(self, data: bytes):
+        if self.upload.error:
+            return  # Остаток ошибочной части просто пропускаем
+        self.buffer.extend(data)
+        self.upload.size += len(data)
+
+        if self.limit is None and len(self.buffer) >= SNIFF_BYTES:
+            self._check_type()
+        if self.limit is not None and self.upload.size > self.limit:
+            self.fail(413, f"{self.upload.kind.capitalize()} file size must not exceed "
+                           f"{_format_size(self.limit)}")
+        elif self.budget is not None and self.upload.size > self.budget:
+            self.fail(413, QUOTA_EXCEEDED)
+        if self.upload.error:
+            await self.close()
+            return
+        if self.limit is not None and len(self.buffer) >= UPLOAD_CHUNK_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if self.file is None:
+            self.file, self.upload.path = await run_in_threadpool(_open_temp)
+        chunk, self.buffer = bytes(self.buffer), bytearray()
+        await run_in_threadpool(self._write, chunk)
+
+    def _write(self, chunk: bytes):
+        # hashlib отпускает GIL на больших буферах, поэтому хэш считается в том же потоке
+        with stage("ingest.write"):
+            self.hash.update(chunk)
+            self.file.write(chunk)
+
+    async def finish(self):
+        if not self.upload.error:
+            if self.upload.size == 0:
+                self.fail(400, "Empty file")
+            elif self.limit is None:
+                self._check_type()
+        if not self.upload.error:
+            await self.flush()
+            self.upload.digest = self.hash.hexdigest()
+        await self.close()
+
+    async def close(self):
+        if self.file is not None:
+            await run_in_threadpool(self.file.close)
+            self.file = None
+        if self.upload.error:
+            self.buffer = bytearray()
+            await self.upload.discard()
+
+
+def _check_content_length(request: Request, allowed: tuple, max_files: int, max_bytes: int = None):
+    content_length = request.headers.get("content-length")
+    if not content_length or not content_length.isdigit():
+        return
+    # Небольшой запас на заголовки частей multipart
+    limit = max(MAX_FILE_SIZES[kind] for kind in allowed) * max_files + 64 * 1024
+    if int(content_length) > limit:
+        raise HTTPException(status_code=413, detail="Request body is too large")
+    if max_bytes is not None and max_files == 1 and int(content_length) > max_bytes + 64 * 1024:
+        raise HTTPException(status_code=413, detail=QUOTA_EXCEEDED)
+
+
+async def iter_uploads(request: Request, allowed: tuple = ("image", "video", "audio"),
+                       max_files: int = 1, fail_fast: bool = False, max_bytes: int = None):
+    """Потоково разбирает multipart-тело и отдаёт файлы по мере их получения.
+
+    Тело не буферизуется целиком: куски пишутся во временный файл в TMP_DIR,
+    тип определяется по первым байтам, лимит размера проверяется на лету.
+    max_bytes — остаток квоты на все файлы запроса (quotas.remaining).
+    При fail_fast первая ошибка сразу прерывает приём тела, иначе ошибочные
+    файлы отдаются с заполненными error/status_code.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data body")
+    _check_content_length(request, allowed, max_files, max_bytes)
+
+    events = []
+    header_field = bytearray()
+    header_value = bytearray()
+    headers = {}
+
+    def on_header_end():
+        events.append(("header", (bytes(header_field), bytes(header_value))))
+        header_field.clear()
+        header_value.clear()
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": lambda: events.append(("begin", None)),
+        "on_header_field": lambda data, start, end: header_field.extend(data[start:end]),
+        "on_header_value": lambda data, start, end: header_value.extend(data[start:end]),
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("headers_finished", None)),
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+    })
+
+    writer = None
+    received = 0
+    accepted = 0  # Байты принятых файлов, в счёт max_bytes
+    try:
+        async for chunk in request.stream():
+            with stage("ingest.parse"):
+                parser.write(chunk)
+            for event, payload in events:
+                if event == "begin":
+                    headers = {}
+                elif event == "header":
+                    headers[payload[0].lower()] = payload[1]
+                elif event == "headers_finished":
+                    _, options = parse_options_header(headers.get(b"content-disposition"))
+                    if b"filename" not in options:
+                        writer = None  # Обычное поле формы
+                        continue
+                    received += 1
+                    if received > max_files:
+                        raise HTTPException(status_code=413, detail=f"Too many files, max is {max_files}")
+                    upload = IngestedFile(options.get(b"name", b"").decode("utf-8", "replace"),
+                                          options[b"filename"].decode("utf-8", "replace"))
+                    writer = _PartWriter(upload, allowed,
+                                         None if max_bytes is None else max_bytes - accepted)
+                elif event == "data" and writer is not None:
+                    await writer.write(payload)
+                    if fail_fast and writer.upload.error:
+                        raise HTTPException(status_code=writer.upload.status_code,
+                                            detail=writer.upload.error)
+                elif event == "end" and writer is not None:
+                    await writer.finish()
+                    upload, writer = writer.upload, None
+                    if not upload.error:
+                        accepted += upload.size
+                    yield upload
+            events.clear()
+        parser.finalize()
+    finally:
+        if writer is not None:
+            await writer.close()
+            await writer.upload.discard()
+
+
+async def ingest_upload(request: Request, allowed: tuple = ("image", "video", "audio"),
+                        field: str = "file", max_bytes: int = None) -> IngestedFile:
+    """Принимает один файл из поля field; при ошибке сразу отвечает 400/413."""
+    result = None
+    uploads = iter_uploads(request, allowed, fail_fast=True, max_bytes=max_bytes)
+    try:
+        async for upload in uploads:
+            if upload.error:
+                raise HTTPException(status_code=upload.status_code, detail=upload.error)
+            if upload.field == field and result is None:
+                result = upload
+            else:
+                await upload.discard()
+    except BaseException:
+        if result is not None:
+            await result.discard()
+        raise
+    finally:
+        await uploads.aclose()
+
+    if result is None:
+        raise HTTPException(status_code=400, detail=f"Field '{field}' with a file is required")
+    return result
@@ -0,0 +1,180 @@
+import asyncio
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, or_
+
+from conf import (
+    JOB_CONCURRENCY,
+    JOB_MAX_ATTEMPTS,
+    JOB_RETRY_DELAY,
+    JOB_POLL_INTERVAL,
+    JOB_STALE_AFTER
+)
+import cas
+import metrics
+import quotas
+import storage
+from database import AsyncSessionLocal
+from models import MediaFile, ProcessingJob
+from pipeline import process_upload, derived_files, variant_rows
+from services import MEDIA_METADATA_FIELDS
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class JobRunner:
+    """Очередь фоновой обработки видео поверх таблицы processing_jobs.
+
+    Задачи забираются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому
+    несколько воркеров uvicorn могут безопасно работать с одной таблицей.
+    Упавшие задачи перезапускаются с нарастающей задержкой до max_attempts,
+    зависшие в running дольше JOB_STALE_AFTER подбираются заново, пока
+    попытки не кончились, а после последней помечаются failed.
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float, retry_delay: float, stale_after: float):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        self.running = 0
+        self._tasks = []
+        self._wakeup = None
+
+    def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Будит воркеров сразу после постановки задачи, не дожидаясь опроса."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            try:
+                claimed = await self._claim()
+            except Exception:
+                traceback.print_exc()
+                claimed = None
+
+            if claimed is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.running += 1
+            try:
+                await self._run(*claimed)
+            finally:
+                self.running -= 1
+
+    async def _claim(self):
+        while True:
+            now = _now()
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(ProcessingJob, MediaFile)
+                    .join(MediaFile, MediaFile.id == ProcessingJob.media_id)
+                    .where(or_(
+                        (ProcessingJob.status == "queued") & (ProcessingJob.run_after <= now),
+                        (ProcessingJob.status == "running")
+                        & (ProcessingJob.updated_at < now - timedelta(seconds=self.stale_after)),
+                    ))
+                    .order_by(ProcessingJob.created_at)
+                    .limit(1)
+                    .with_for_update(of=ProcessingJob, skip_locked=True)
+                )
+                row = result.first()
+                if row is None:
+                    return None
+
+                job, media = row
+                job.updated_at = now
+                if job.status == "running" and job.attempts >= job.max_attempts:
+                    # Последняя попытка убила процесс (OOM, падение декодера) — больше не перезапускаем
+                    job.status = "failed"
+                    job.error = job.error or "Processing was interrupted"
+                    await db.commit()
+                    continue
+                job.status = "running"
+                job.attempts += 1
+                await db.commit()
+                return job.id, job.attempts, job.max_attempts, media
+
+    async def _set(self, job_id, **values):
+        values["updated_at"] = _now()
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(ProcessingJob).where(ProcessingJob.id == job_id).values(**values))
+            await db.commit()
+
+    async def _heartbeat(self, job_id):
+        """Обновляет updated_at, пока задача ждёт места в полосе video или
+        обрабатывается: иначе другой воркер подберёт её как зависшую."""
+        while True:
+            await asyncio.sleep(self.stale_after / 3)
+            try:
+                await self._set(job_id)
+            except Exception:
+                traceback.print_exc()
+
+    async def _run(self, job_id, attempts: int, max_attempts: int, media: MediaFile):
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await self._process(job_id, attempts, max_attempts, media)
+        finally:
+            heartbeat.cancel()
+
+    async def _process(self, job_id, attempts: int, max_attempts: int, media: MediaFile):
+        async def progress(value: int):
+            await self._set(job_id, progress=value)
+
+        file_path = storage.resolve(media.filename) or storage.path_for(media.filename)
+        metadata = {field: getattr(media, field) for field in MEDIA_METADATA_FIELDS}
+        try:
+            result = await process_upload(file_path, media.type, media.original_name, metadata, progress,
+                                          stem=media.stem or media.digest, background=True)
+            async with AsyncSessionLocal() as db:
+                variants = derived_files(result, media.filename)
+                variants_size = await quotas.files_size(variants)
+                await db.execute(update(MediaFile).where(MediaFile.id == media.id)
+                                 .values(urls=result["urls"], size=MediaFile.size + variants_size))
+                db.add_all(variant_rows(media.id, variants))
+                await quotas.add(db, media.user_id, variants_size)
+                if media.digest:
+                    await cas.store_result(db, media.digest, result)
+                await db.commit()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = getattr(e, "detail", None) or repr(e)
+            if attempts < max_attempts:
+                await self._set(job_id, status="queued", error=error,
+                                run_after=_now() + timedelta(seconds=self.retry_delay * attempts))
+            else:
+                await self._set(job_id, status="failed", error=error)
+            return
+
+        await self._set(job_id, status="done", progress=100, result=result, error=None)
+
+
+runner = JobRunner(JOB_CONCURRENCY, JOB_POLL_INTERVAL, JOB_RETRY_DELAY, JOB_STALE_AFTER)
+metrics.register_queue("jobs_running", lambda: runner.running)
+
+
+def new_job(media: MediaFile) -> ProcessingJob:
+    return ProcessingJob(media_id=media.id, user_id=media.user_id, max_attempts=JOB_MAX_ATTEMPTS)
@@ -1,62 +1,286 @@
+import asyncio
 import json
-import httpx
+import os
 import traceback
-from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
+
+import httpx
+from starlette.datastructures import Headers
 from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import metrics
+from conf import (
+    SERVER_ID,
+    SAVE_LOG_URL,
+    SAVE_LOGS_BATCH_URL,
+    LOG_SECRET,
+    LOG_QUEUE_SIZE,
+    LOG_BATCH_SIZE,
+    LOG_FLUSH_INTERVAL,
+    LOG_SHIP_TIMEOUT,
+    LOG_BODY_LIMIT,
+    LOG_SPILL_PATH,
+    LOG_SPILL_MAX_BYTES
+)
+
+# Тела этих типов не логируем: бинарные и огромные (загрузки до 1GB)
+_SKIP_BODY_TYPES = ("multipart/", "application/octet-stream", "application/offset+octet-stream",
+                    "image/", "video/", "audio/")
+
 
-from conf import SERVER_ID, SAVE_LOG_URL, LOG_SECRET
+class LogShipper:
+    """Отправка логов в SAVE_LOG_URL в фоне, пачками и через один пул соединений.
 
+    Запрос только кладёт запись в ограниченную очередь и не ждёт сборщик логов.
+    Если очередь переполнена, запись отбрасывается. Если сборщик недоступен,
+    неотправленные записи дописываются в LOG_SPILL_PATH (до LOG_SPILL_MAX_BYTES)
+    и переотправляются после первой успешной отправки.
+    """
 
-class ErrorLoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        request.state.body = None  # Инициализация
+    def __init__(self):
+        self.shipped = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed_batches = 0
+        self._queue = None
+        self._client = None
+        self._task = None
 
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> dict:
+        return {
+            "shipped": self.shipped,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "queued": self.queued,
+            "failed_batches": self.failed_batches,
+        }
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._client = httpx.AsyncClient(timeout=LOG_SHIP_TIMEOUT, headers={"SECRET": LOG_SECRET})
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        # Остаток очереди пробуем отправить одной попыткой, иначе он уйдёт на диск
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await self._ship(batch)
+        await self._client.aclose()
+        self._task = None
+
+    def enqueue(self, record: dict):
+        self.start()
         try:
-            # Читаем тело запроса один раз
-            body_bytes = await request.body()
-            request.state.body = body_bytes.decode("utf-8")
-        except Exception:
-            request.state.body = "Failed to read body"
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + LOG_FLUSH_INTERVAL
+            while len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._ship(batch)
+
+    async def _ship(self, batch: list[dict]):
+        if SAVE_LOGS_BATCH_URL:
+            try:
+                response = await self._client.post(SAVE_LOGS_BATCH_URL, json=batch)
+                response.raise_for_status()
+                errors = [None] * len(batch)
+            except Exception as e:
+                errors = [e] * len(batch)
+        else:
+            errors = await asyncio.gather(*(self._post(record) for record in batch), return_exceptions=True)
+        # По одной записи сборщик мог принять часть пачки: на диск уходят только
+        # неотправленные, иначе после переотправки принятые задвоятся
+        failed = [record for record, error in zip(batch, errors) if error is not None]
+        self.shipped += len(batch) - len(failed)
+        if failed:
+            print(f"Не удалось отправить логи: {next(e for e in errors if e is not None)!r}")
+            self.failed_batches += 1
+            await self._spill(failed)
+            return
+
+        if LOG_SPILL_PATH and os.path.exists(LOG_SPILL_PATH):
+            await self._replay()
+
+    async def _post(self, record: dict):
+        response = await self._client.post(SAVE_LOG_URL, json=record)
+        response.raise_for_status()
+
+    async def _spill(self, records: list[dict]):
+        written = await asyncio.to_thread(_write_spill, records) if LOG_SPILL_PATH else 0
+        self.spilled += written
+        self.dropped += len(records) - written
+
+    async def _replay(self):
+        """Возвращает записи с диска в очередь после восстановления сборщика.
+
+        Файл читается в потоке, в очередь записи кладутся в цикле событий:
+        asyncio.Queue не потокобезопасна. Берётся не больше свободного места
+        в очереди, остальное ждёт на диске следующей успешной отправки.
+        """
+        free = self._queue.maxsize - self._queue.qsize()
+        if free <= 0:
+            return
+        records = await asyncio.to_thread(_take_spilled, free)
+        self.spilled -= len(records)
+        for n, record in enumerate(records):
+            try:
+                self._queue.put_nowait(record)
+            except asyncio.QueueFull:
+                # Очередь успели заполнить новые запросы — остаток обратно на диск
+                await self._spill(records[n:])
+                break
+
+
+def _write_spill(records: list[dict]) -> int:
+    """Дописывает записи в LOG_SPILL_PATH; 0 — не поместились в LOG_SPILL_MAX_BYTES."""
+    size = os.path.getsize(LOG_SPILL_PATH) if os.path.exists(LOG_SPILL_PATH) else 0
+    lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+    if size + len(lines) > LOG_SPILL_MAX_BYTES:
+        return 0
+    with open(LOG_SPILL_PATH, "a", encoding="utf-8") as spill:
+        spill.write(lines)
+    return len(records)
+
+
+def _take_spilled(limit: int) -> list[dict]:
+    """Забирает из LOG_SPILL_PATH первые limit записей, остальные оставляет в файле."""
+    try:
+        with open(LOG_SPILL_PATH, encoding="utf-8") as spill:
+            lines = spill.readlines()
+    except FileNotFoundError:
+        return []
+    rest = lines[limit:]
+    if rest:
+        tmp_path = f"{LOG_SPILL_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as spill:
+            spill.writelines(rest)
+        os.replace(tmp_path, LOG_SPILL_PATH)
+    else:
+        os.remove(LOG_SPILL_PATH)
 
+    records = []
+    for line in lines[:limit]:
         try:
-            response = await call_next(request)
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records
+
+
+shipper = LogShipper()
+metrics.register_queue("log_shipper", lambda: shipper.queued)
+
+
+class _BodyCapture:
+    """Сохраняет начало тела запроса не больше LOG_BODY_LIMIT байт."""
+
+    def __init__(self, headers: Headers):
+        content_type = headers.get("content-type", "")
+        self.skip_reason = content_type if content_type.startswith(_SKIP_BODY_TYPES) else None
+        self.prefix = bytearray()
+        self.size = 0
+
+    def feed(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.skip_reason is None and len(self.prefix) < LOG_BODY_LIMIT:
+            self.prefix.extend(chunk[:LOG_BODY_LIMIT - len(self.prefix)])
+
+    def text(self) -> str | None:
+        if self.skip_reason is not None:
+            return f"<{self.skip_reason}, {self.size} bytes>"
+        if not self.size:
+            return None
+        body = self.prefix.decode("utf-8", "replace")
+        if self.size > len(self.prefix):
+            body += f"... <{self.size} bytes>"
+        return body
+
+
+class ErrorLoggingMiddleware:
+    """Логирует каждый запрос и необработанные ошибки, не задерживая ответ.
+
+    Тело не вычитывается заранее: записывается только то, что прочитал
+    обработчик, и только начало текстовых тел.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        capture = _BodyCapture(headers)
+        response = {"status_code": None}
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                capture.feed(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status_code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
         except Exception as e:
             # Генерируем traceback ошибки
             tb_str = "".join(traceback.format_exception(None, e, e.__traceback__))
-            last_500_chars = tb_str[-500:]
-
-            log_data = {
-                "service_name": f"file server{SERVER_ID}",
-                "level": 4,
-                "method": request.method,
-                "url": str(request.url),
-                "status_code": 500,
-                "client_ip": request.client.host,
-                "headers": dict(request.headers),
-                "body": request.state.body,  # Берём сохранённое тело запроса
-                "error_traceback": last_500_chars,  # Сохраняем traceback ошибки
-            }
-
-            # Асинхронно отправляем лог
-            async with httpx.AsyncClient() as client:
-                await client.post(SAVE_LOG_URL, json=log_data, headers={'SECRET': LOG_SECRET})
-
-            return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
-
-        if response.status_code >= 200:
-            log_data = {
-                "service_name": f"file server{SERVER_ID}",
-                "level": 4 if response.status_code >= 400 else 1,
-                "method": request.method,
-                "url": str(request.url),
-                "status_code": response.status_code,
-                "client_ip": request.client.host,
-                "headers": dict(request.headers),
-                "body": request.state.body,  # Используем сохранённое тело запроса
-            }
-
-            async with httpx.AsyncClient() as client:
-                await client.post(SAVE_LOG_URL, json=log_data, headers={'SECRET': LOG_SECRET})
-
-        return response
+            log_data = self._record(scope, headers, capture, 500, level=4)
+            log_data["error_traceback"] = tb_str[-500:]  # Сохраняем traceback ошибки
+            shipper.enqueue(log_data)
+
+            if response["status_code"] is not None:
+                raise  # Ответ уже начат, отдать 500 нельзя
+            await JSONResponse(status_code=500, content={"detail": "Internal Server Error"})(scope, receive, send)
+            return
+
+        status_code = response["status_code"]
+        if status_code is not None and status_code >= 200:
+            shipper.enqueue(self._record(scope, headers, capture, status_code,
+                                         level=4 if status_code >= 400 else 1))
+
+    @staticmethod
+    def _record(scope: Scope, headers: Headers, capture: _BodyCapture, status_code: int, level: int) -> dict:
+        client = scope.get("client")
+        query = scope.get("query_string", b"").decode("latin-1")
+        path = scope.get("root_path", "") + scope["path"]
+        return {
+            "service_name": f"file server{SERVER_ID}",
+            "level": level,
+            "method": scope["method"],
+            "url": f"{path}?{query}" if query else path,
+            "status_code": status_code,
+            "client_ip": client[0] if client else None,
+            "headers": dict(headers),
+            "body": capture.text(),
+        }
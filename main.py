@@ -1,39 +1,79 @@
+import asyncio
+import base64
+import json
 import mimetypes
-import random
+import time
+import traceback
 import uuid
-import shutil
 import os
+from contextlib import asynccontextmanager, AsyncExitStack
+from datetime import datetime
 from typing import List
-from urllib.parse import quote, unquote
+from collections import Counter
+from urllib.parse import quote, unquote, urlparse
 
-import uvicorn
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import select, delete, update, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import ClientDisconnect
 
 from conf import (
-    UPLOAD_DIR,
     SERVER_ID,
     PHOTO_SIZES,
     PHOTO_BLURED,
     AVATAR_SIZES,
-    AVATAR_SIZES_STRINGS,
     LETTERS,
     SECRET,
-    PORT
+    PORT,
+    CONTENT_ADDRESSED,
+    BATCH_MAX_FILES,
+    BATCH_CONCURRENCY,
+    METRICS_ENABLED,
+    GC_ENABLED,
+    MEDIA_PAGE_SIZE,
+    MEDIA_PAGE_MAX,
+    MAX_FILE_SIZES,
+    VARIANT_SIZES,
+    WARMUP
 )
 
-from logs import ErrorLoggingMiddleware
+from database import get_db, AsyncSessionLocal
+import admission
+import avatars
+import backends
+import cas
+import quotas
+import resumable
+import storage
+from dependencies import get_current_user, invalidate_user, auth_cache_stats
+from ingest import ingest_upload, iter_uploads, QUOTA_EXCEEDED
+from jobs import runner, new_job
+from logs import ErrorLoggingMiddleware, shipper
+from storage_gc import collector
+import metrics
+from metrics import MetricsMiddleware, stage
+from models import User, MediaFile, MediaVariant, ProcessingJob
+from pipeline import process_upload, derived_files, variant_rows, upload_lane
+from responses import MediaFileResponse, MemoryFileResponse, negotiate_format
+from variants import variant_cache, variant_name, variant_names, is_variant_source, VARIANT_FITS
+from workers import run_in_pool, pool
 
 from services import (
     validate_file,
-    generate_video_preview,
     resize_image,
-    generate_image_from_string,
-    BACKGROUND_COLORS,
     get_file_url,
-    get_audio_duration,
-    get_video_duration
+    probe_media,
+    render_variant,
+    encode_alternate,
+    alternate_formats,
+    alternate_name,
+    with_alternates,
+    variant_family,
+    IMAGE_FORMATS,
+    MEDIA_METADATA_FIELDS
 )
 
 from schemas import (
@@ -44,18 +84,117 @@ from schemas import (
     VideoUploadResponse,
     AudioUploadResponse,
     AvatarUploadResponse,
-    FromStringResponse
+    FromStringResponse,
+    JobStatusResponse,
+    MediaPage,
+    QuotaUpdate,
+    UsageOut,
+    UserCreate,
+    UserOut
 )
 
-app = FastAPI()
+
+# Время шагов прогрева в этом воркере, секунды
+warmup_seconds = {}
+
+
+async def warm_up(targets: list[str]):
+    """Прогрев из WARMUP: процессы пула, библиотеки обработки, кэши."""
+    steps = {
+        "pool": lambda: pool.warm_up(backends.warm_up),
+        "backends": lambda: run_in_threadpool(backends.warm_up),
+        "variant_cache": variant_cache.warm_up,
+        "avatars": lambda: run_in_threadpool(avatars.warm_up),
+    }
+    for target in targets:
+        start = time.perf_counter()
+        try:
+            await steps[target]()
+        except Exception:
+            traceback.print_exc()
+            continue
+        warmup_seconds[target] = round(time.perf_counter() - start, 3)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    shipper.start()
+    runner.start()
+    resumable.reaper.start()
+    if GC_ENABLED:
+        collector.start()
+    # В фоне, чтобы не задерживать старт: запросы до конца прогрева обслуживаются как обычно
+    warmup = asyncio.create_task(warm_up(WARMUP))
+    yield
+    warmup.cancel()
+    await asyncio.gather(warmup, return_exceptions=True)
+    await collector.stop()
+    await resumable.reaper.stop()
+    await runner.stop()
+    pool.shutdown()
+    await shipper.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(ErrorLoggingMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# Тело загрузок разбирается вручную (ingest.py), поэтому схему описываем явно
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+BATCH_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                    "required": ["files"],
+                }
+            }
+        },
+    }
+}
+
 
 async def verify_secret(secret: str = Header(None)):
     """Проверка ключа в заголовке"""
     if secret != SECRET:
         raise HTTPException(status_code=403, detail="Invalid SECRET")
     return True
-    
+
+
+@app.get("/stats")
+async def stats(authorized: bool = Depends(verify_secret)):
+    """Счётчики фоновых подсистем сервера"""
+    return {"logs": shipper.stats(), "auth_cache": auth_cache_stats(), "variant_cache": variant_cache.stats(),
+            "avatar_cache": avatars.avatar_cache.stats(), "storage_gc": collector.stats(),
+            "admission": admission.stats(), "warmup": warmup_seconds}
+
+
+@app.get("/metrics")
+async def get_metrics(authorized: bool = Depends(verify_secret)):
+    """Метрики в формате Prometheus. Счётчики ведутся в памяти процесса: при
+    нескольких воркерах uvicorn каждый отдаёт только свои."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/users", response_model=UserOut)
 async def create_user(
     data: UserCreate,
@@ -65,152 +204,792 @@ async def create_user(
     db.add(user)
     await db.commit()
     await db.refresh(user)
+    invalidate_user(user.api_key)  # Ключ мог попасть в кэш неверных ключей
     return user
 
+@app.delete("/users/{user_id}")
+async def delete_user(
+    user_id: uuid.UUID,
+    authorized: bool = Depends(verify_secret),
+    db: AsyncSession = Depends(get_db)
+):
+    """Отзыв ключа: загрузки удаляются как в /delete_files, остальные записи — каскадом в БД"""
+    rows, to_remove = await _delete_media(db, user_id)
+    result = await db.execute(delete(User).where(User.id == user_id).returning(User.api_key))
+    api_key = result.scalar_one_or_none()
+    if api_key is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    await db.commit()
+    invalidate_user(api_key)
+    await _remove_media_files(rows, to_remove)
+    return {"message": "User deleted"}
+
+@app.put("/users/{user_id}/quota", response_model=UsageOut)
+async def set_user_quota(
+    user_id: uuid.UUID,
+    data: QuotaUpdate,
+    authorized: bool = Depends(verify_secret),
+    db: AsyncSession = Depends(get_db)
+):
+    """Свои лимиты пользователя: null — QUOTA_BYTES / QUOTA_FILES, 0 — без ограничения"""
+    result = await db.execute(update(User).where(User.id == user_id)
+                              .values(quota_bytes=data.quota_bytes, quota_files=data.quota_files))
+    if not result.rowcount:
+        raise HTTPException(status_code=404, detail="User not found")
+    await db.commit()
+    return await quotas.usage(db, user_id)
+
+@app.get("/usage", response_model=UsageOut)
+async def get_usage(user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Занятое место и лимиты текущего пользователя"""
+    return await quotas.usage(db, user.id)
+
 @app.post("/blur_image")
-async def blur_image(data: BlurRequest, authorized: bool = Depends(verify_secret)):
-    filename = os.path.basename(data.url)
-    file_path = os.path.join(UPLOAD_DIR, filename)
+async def blur_image(
+    data: BlurRequest,
+    authorized: bool = Depends(verify_secret),
+    db: AsyncSession = Depends(get_db)
+):
+    filename = os.path.basename(unquote(urlparse(str(data.url)).path))
+    file_path = storage.resolve(filename)
 
-    if not os.path.exists(file_path):
+    if file_path is None:
         raise HTTPException(status_code=404, detail="File not found")
-    valid, error = validate_file(file_path)
-    if not valid:
-        raise HTTPException(status_code=400, detail=error)
-
-    blurred_urls = resize_image(file_path, PHOTO_SIZES, PHOTO_BLURED)
+    # Имя от той же загрузки, чтобы копии удалялись вместе с ней
+    stem = storage.stem(filename)
+    # У аватаров нет записей в БД: копии остаются в их семействе, иначе сборщик мусора их удалит
+    family = "avatar" if variant_family(filename) == "avatar" else "photo"
+    async with admission.lanes["blur"].admit():
+        valid, error = await run_in_pool(validate_file, file_path)
+        if not valid:
+            raise HTTPException(status_code=400, detail=error)
+        blurred_urls = await run_in_pool(resize_image, file_path, PHOTO_SIZES, PHOTO_BLURED, stem=stem,
+                                         family=family)
+
+    blurred = cas.result_files({"urls": blurred_urls})
+    owners = (await db.execute(select(MediaFile.id, MediaFile.user_id).where(MediaFile.stem == stem))).all()
+    if owners:
+        # Повторный запрос перезаписывает те же файлы, записи и квоту не дублируем
+        existing = set((await db.execute(
+            select(MediaVariant.media_id, MediaVariant.filename)
+            .where(MediaVariant.media_id.in_([media_id for media_id, _ in owners]),
+                   MediaVariant.filename.in_(blurred))
+        )).all())
+        for media_id, user_id in owners:
+            names = [name for name in blurred if (media_id, name) not in existing]
+            if not names:
+                continue
+            size = await quotas.files_size(names)
+            db.add_all(variant_rows(media_id, names))
+            await db.execute(update(MediaFile).where(MediaFile.id == media_id).values(size=MediaFile.size + size))
+            await quotas.add(db, user_id, size)
+        await db.commit()
 
     return {"file": filename, "blurred_urls": blurred_urls}
 
 
-@app.post("/upload/file")
-async def upload_file(file: UploadFile = File(...), user=Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)):
-    results = []
-    ext = file.filename.split(".")[-1]
-    file_type, _ = mimetypes.guess_type(file.filename)
-    if not any((file_type.startswith("image"), file_type.startswith("video"), file_type.startswith("audio"))):
-        raise HTTPException(detail=f"Invalid file type: {file_type}", status_code=400)
-    unique_name = f"{uuid.uuid4().hex}.{ext}"
-    file_path = os.path.join(UPLOAD_DIR, unique_name)
+async def _add_processed(db: AsyncSession, user, file, blob) -> bool:
+    """Записи для повторной загрузки уже обработанного содержимого (CAS).
+
+    False — не хватает квоты, ничего не добавлено.
+    """
+    variants = derived_files(blob.result, blob.filename)
+    size = file.size + await quotas.files_size(variants)
+    if not await quotas.charge(db, user.id, size):
+        return False
+    await cas.add_reference(db, blob.digest, blob.filename, blob.type)
     media = MediaFile(
+        id=uuid.uuid4(),
         user_id=user.id,
-        filename=unique_name,
+        filename=blob.filename,
         original_name=file.filename,
-        type=file_type,
-        duration=None,
-        url=get_file_url(file_path),
+        type=blob.type,
+        url=get_file_url(blob.filename),
+        digest=blob.digest,
+        stem=blob.digest,
+        urls=blob.result.get("urls"),
+        size=size,
+        **(blob.result.get("metadata") or {}),
     )
-
     db.add(media)
-    await db.commit()
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    db.add_all(variant_rows(media.id, variants))
+    return True
 
-    valid, error = validate_file(file_path)
 
+async def _save_upload(file, user) -> tuple[MediaFile, str, dict]:
+    """Переносит принятый файл в хранилище и читает метаданные.
+
+    Возвращает ещё не добавленную в сессию запись MediaFile, путь и метаданные.
+    """
+    digest = file.digest if CONTENT_ADDRESSED else None
+    stem = digest or uuid.uuid4().hex
+    unique_name = f"{stem}.{file.extension}"
+    file_path = storage.path_for(unique_name)
+    try:
+        await file.save(file_path)
+    finally:
+        await file.discard()
+
+    # Метаданные читаются один раз и дальше передаются в проверку, превью и ответ
+    try:
+        metadata = await run_in_pool(probe_media, file_path, file.mimetype)
+    except BaseException:
+        if not digest:  # Файл с digest могут делить другие загрузки
+            await run_in_threadpool(storage.remove, unique_name)
+        raise
+    media = MediaFile(
+        user_id=user.id,
+        filename=unique_name,
+        original_name=file.filename,
+        type=file.mimetype,
+        url=get_file_url(file_path),
+        digest=digest,
+        stem=stem,
+        size=file.size,
+        **metadata,
+    )
+    return media, file_path, metadata
+
+
+@app.post("/upload/file", openapi_extra=UPLOAD_OPENAPI)
+async def upload_file(request: Request, user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    async_mode: bool = Query(False, alias="async")):
+    """Загрузка файла. С ?async=true видео обрабатывается в фоне: ответ 202 с job_id,
+    статус и итоговый результат — в GET /jobs/{job_id}."""
+    file = await ingest_upload(request, max_bytes=await quotas.remaining(db, user.id))
+    return await _store_upload(db, user, file, async_mode)
+
+
+async def _store_upload(db: AsyncSession, user, file, async_mode: bool):
+    """Сохраняет и обрабатывает принятый файл: общий путь /upload/file и /uploads/{id}/complete."""
+    digest = file.digest if CONTENT_ADDRESSED else None
+
+    if digest:
+        blob = await cas.find(db, digest)
+        if blob is not None and blob.result is not None:
+            # Такое содержимое уже обработано — отдаём готовые ссылки без пересчёта
+            await file.discard()
+            if not await _add_processed(db, user, file, blob):
+                raise HTTPException(status_code=413, detail=QUOTA_EXCEEDED)
+            await db.commit()
+            return [{"file": file.filename, **blob.result}]
+
+    # Место в полосе занимается до записи в БД и списания квоты: при полной
+    # очереди — 503 без следов, повтор запроса не спишет квоту дважды
+    lane = None if async_mode and file.kind == "video" else upload_lane(file.kind)
+    if lane is None:
+        return await _save_and_process(db, user, file, async_mode)
+    async with AsyncExitStack() as stack:
+        try:
+            await stack.enter_async_context(lane.admit())
+        except BaseException:
+            await file.discard()
+            raise
+        return await _save_and_process(db, user, file, async_mode, admitted=True)
+
+
+async def _save_and_process(db: AsyncSession, user, file, async_mode: bool, admitted: bool = False):
+    """Запись в хранилище и БД, проверка и обработка. admitted — место в полосе уже занято."""
+    results = []
+    digest = file.digest if CONTENT_ADDRESSED else None
+    media, file_path, metadata = await _save_upload(file, user)
+
+    # Проверка до записи в БД и списания квоты: у ответа с ошибкой нет ссылки,
+    # клиент не смог бы удалить такую загрузку
+    valid = False
+    try:
+        valid, error = await run_in_pool(validate_file, file_path, metadata)
+    finally:
+        if not valid and not digest:  # Файл с digest могут делить другие загрузки, его уберёт storage_gc
+            await run_in_threadpool(storage.remove, media.filename)
     if not valid:
         results.append({"file": file.filename, "error": error})
         return results
 
-    if file_type and file_type.startswith("image"):
-        urls = resize_image(file_path, PHOTO_SIZES)
-        results.append({"file": file.filename, "type": "image", "urls": urls})
-
-    elif file_type and file_type.startswith("video"):
-        preview = generate_video_preview(file_path)
-        preview = resize_image(preview, PHOTO_SIZES)
-        results.append({"file": file.filename,
-                        "type": "video",
-                        "duration": get_video_duration(file_path),
-                        "urls": {"preview": preview,
-                                 "video": get_file_url(file_path)}})
-
-    elif file_type and file_type.startswith("audio"):
-        results.append({"file": file.filename,
-                        "type": "audio",
-                        "duration":get_audio_duration(file_path),
-                        "urls": {"audio": get_file_url(file_path)}})
-    else:
-        os.remove(file_path)  # Неизвестные файлы удаляем
-    
+    # Квоту могли занять параллельные загрузки, пока принималось тело
+    if not await quotas.charge(db, user.id, media.size):
+        if not digest:
+            await run_in_threadpool(storage.remove, media.filename)
+        raise HTTPException(status_code=413, detail=QUOTA_EXCEEDED)
+    if digest:
+        await cas.add_reference(db, digest, media.filename, media.type)
+    db.add(media)
+    with stage("db.commit"):
+        await db.commit()
+
+    # Дальше запись уже в БД: если обработка упала, загрузка удаляется целиком,
+    # чтобы повтор запроса (или complete возобновляемой загрузки) не списал квоту дважды
+    media_id = media.id
+    try:
+        if async_mode and file.kind == "video":
+            job = new_job(media)
+            db.add(job)
+            await db.commit()
+            runner.notify()
+            results.append({"file": file.filename, "type": "video", "job_id": str(job.id), "status": job.status})
+            return JSONResponse(status_code=202, content=results)
+
+        result = await process_upload(file_path, media.type, file.filename, metadata, stem=media.stem,
+                                      admitted=admitted)
+        variants = derived_files(result, media.filename)
+        variants_size = await quotas.files_size(variants)
+        media.urls = result["urls"]
+        media.size += variants_size
+        db.add_all(variant_rows(media.id, variants))
+        await quotas.add(db, user.id, variants_size)
+        if digest:
+            await cas.store_result(db, digest, result)
+        with stage("db.commit"):
+            await db.commit()
+    except BaseException:
+        await _discard_media(db, user.id, media_id)
+        raise
+    results.append(result)
     return results
 
 
-@app.post("/upload/avatar")
-async def upload_avatar(file: UploadFile = File(...), authorized: bool = Depends(verify_secret)):
-    ext = file.filename.split(".")[-1]
-    file_type, _ = mimetypes.guess_type(file.filename)
+async def _discard_media(db: AsyncSession, user_id, media_id):
+    """Удаляет загрузку, обработка которой не удалась: запись, квоту, ссылку CAS и файлы."""
+    await db.rollback()
+    rows, to_remove = await _delete_media(db, user_id, MediaFile.id == media_id)
+    await db.commit()
+    await _remove_media_files(rows, to_remove)
+
+
+def _batch_line(index: int, item: dict) -> str:
+    return json.dumps({"index": index, **item}, ensure_ascii=False) + "\n"
+
+
+def _batch_error(index: int, filename: str, error, status_code: int) -> str:
+    return _batch_line(index, {"file": filename, "error": error, "status_code": status_code})
+
+
+# Обработка пакетов продолжается после отключения клиента; ссылки держим, чтобы задачи не собрал GC
+_batch_tasks = set()
+metrics.register_queue("upload_batches", lambda: len(_batch_tasks))
+
+
+async def _process_batch_item(limit: asyncio.Semaphore, media: MediaFile, file_path: str,
+                              metadata: dict, entries: list) -> list[str]:
+    """Обрабатывает один файл пакета. entries — (index, имя файла, id записи) этого
+    файла и его копий с тем же digest; возвращает по строке NDJSON на каждую."""
+    async with limit:
+        try:
+            valid, error = await run_in_pool(validate_file, file_path, metadata)
+            if not valid:
+                # Записи пакета уже созданы: удаляем их, иначе квота останется занятой
+                async with AsyncSessionLocal() as session:
+                    rows, to_remove = await _delete_media(
+                        session, media.user_id, MediaFile.id.in_([media_id for _, _, media_id in entries]))
+                    await session.commit()
+                await _remove_media_files(rows, to_remove)
+                return [_batch_error(index, filename, error, 400) for index, filename, _ in entries]
+
+            result = await process_upload(file_path, media.type, entries[0][1], metadata, stem=media.stem)
+            variants = derived_files(result, media.filename)
+            variants_size = await quotas.files_size(variants)
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(MediaFile)
+                    .where(MediaFile.id.in_([media_id for _, _, media_id in entries]))
+                    .values(urls=result["urls"], size=MediaFile.size + variants_size)
+                )
+                session.add_all([row for _, _, media_id in entries for row in variant_rows(media_id, variants)])
+                await quotas.add(session, media.user_id, variants_size * len(entries))
+                if media.digest:
+                    await cas.store_result(session, media.digest, result)
+                with stage("db.commit"):
+                    await session.commit()
+        except HTTPException as e:
+            return [_batch_error(index, filename, e.detail, e.status_code) for index, filename, _ in entries]
+        except Exception:
+            traceback.print_exc()
+            return [_batch_error(index, filename, "Processing failed", 500) for index, filename, _ in entries]
+
+    return [_batch_line(index, {**result, "file": filename}) for index, filename, _ in entries]
+
+
+@app.post("/upload/files", openapi_extra=BATCH_UPLOAD_OPENAPI)
+async def upload_files(request: Request, user=Depends(get_current_user),
+                       db: AsyncSession = Depends(get_db)):
+    """Пакетная загрузка: до BATCH_MAX_FILES файлов в одном multipart-запросе.
+
+    Записи MediaFile создаются одной транзакцией, файлы обрабатываются параллельно,
+    не больше BATCH_CONCURRENCY одновременно. Ответ — NDJSON по мере готовности:
+    строка на файл, index — его номер в запросе. Ошибка в одном файле не
+    прерывает остальные.
+    """
+    files = []
+    budget = await quotas.remaining(db, user.id)
+    try:
+        async for file in iter_uploads(request, max_files=BATCH_MAX_FILES, max_bytes=budget):
+            files.append(file)
+    except BaseException:
+        for file in files:
+            await file.discard()
+        raise
+    if not files:
+        raise HTTPException(status_code=400, detail="No files in request")
+
+    ready = []      # Строки, известные до обработки: ошибки приёма, готовые результаты CAS
+    pending = []    # Индексы файлов, которые нужно сохранить и обработать
+    copies = {}     # Индекс копии -> индекс первого файла с тем же digest
+    first = {}
+    blobs = {}
+    for index, file in enumerate(files):
+        if file.error:
+            ready.append(_batch_error(index, file.filename, file.error, file.status_code))
+            continue
+        digest = file.digest if CONTENT_ADDRESSED else None
+        if digest:
+            if digest not in blobs:
+                blobs[digest] = await cas.find(db, digest)
+            blob = blobs[digest]
+            if blob is not None and blob.result is not None:
+                await file.discard()
+                if await _add_processed(db, user, file, blob):
+                    ready.append(_batch_line(index, {"file": file.filename, **blob.result}))
+                else:
+                    ready.append(_batch_error(index, file.filename, QUOTA_EXCEEDED, 413))
+                continue
+            if digest in first:
+                # Одинаковое содержимое внутри пакета сохраняется и обрабатывается один раз
+                await file.discard()
+                copies[index] = first[digest]
+                continue
+            first[digest] = index
+        pending.append(index)
+
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def save(index):
+        async with limit:
+            return await _save_upload(files[index], user)
+
+    saved = dict(zip(pending, await asyncio.gather(*map(save, pending), return_exceptions=True)))
+    for index, item in list(saved.items()):
+        if isinstance(item, HTTPException):
+            ready.append(_batch_error(index, files[index].filename, item.detail, item.status_code))
+        elif isinstance(item, BaseException):
+            ready.append(_batch_error(index, files[index].filename, "Processing failed", 500))
+        else:
+            continue
+        del saved[index]
+
+    items = {index: (media, file_path, metadata, [(index, files[index].filename, media)])
+             for index, (media, file_path, metadata) in saved.items()}
+    for index, original in copies.items():
+        if original not in items:
+            ready.append(_batch_error(index, files[index].filename, "Processing failed", 500))
+            continue
+        media = items[original][0]
+        copy = MediaFile(
+            user_id=user.id,
+            filename=media.filename,
+            original_name=files[index].filename,
+            type=media.type,
+            url=media.url,
+            digest=media.digest,
+            stem=media.stem,
+            size=media.size,
+            **items[original][2],
+        )
+        items[original][3].append((index, files[index].filename, copy))
+
+    rejected = []
+    try:
+        for original, (media, _, _, entries) in list(items.items()):
+            charged = []
+            for entry in entries:
+                index, filename, row = entry
+                if not await quotas.charge(db, user.id, row.size):
+                    ready.append(_batch_error(index, filename, QUOTA_EXCEEDED, 413))
+                    continue
+                if media.digest:
+                    await cas.add_reference(db, media.digest, media.filename, media.type)
+                db.add(row)
+                charged.append(entry)
+            entries[:] = charged
+            if not charged:
+                rejected.append(items.pop(original)[0])
+        with stage("db.commit"):
+            await db.commit()
+    except BaseException:
+        await run_in_threadpool(storage.remove_many,
+                                [media.filename for media, *_ in items.values() if not media.digest])
+        raise
+    finally:
+        # Файлы с digest могут делить другие загрузки, без ссылок их подберёт storage_gc.py
+        await run_in_threadpool(storage.remove_many, [media.filename for media in rejected if not media.digest])
+
+    tasks = []
+    for media, file_path, metadata, entries in items.values():
+        entries = [(index, filename, row.id) for index, filename, row in entries]
+        task = asyncio.create_task(_process_batch_item(limit, media, file_path, metadata, entries))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
+        tasks.append(task)
+
+    async def stream():
+        for line in ready:
+            yield line
+        for task in asyncio.as_completed(tasks):
+            for line in await task:
+                yield line
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.post("/uploads", status_code=201)
+async def create_upload(
+    request: Request,
+    upload_length: int = Header(..., gt=0),
+    upload_metadata: str = Header(None),
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Возобновляемая загрузка (tus): создаёт сессию на Upload-Length байт.
+    Имя файла — filename в Upload-Metadata. Куски шлются PATCH на Location."""
+    if upload_length > max(MAX_FILE_SIZES.values()):
+        raise HTTPException(status_code=413, detail="Upload-Length is too large")
+    budget = await quotas.remaining(db, user.id)
+    if budget is not None and upload_length > budget:
+        raise HTTPException(status_code=413, detail=QUOTA_EXCEEDED)
+    filename = resumable.parse_metadata(upload_metadata).get("filename") or "upload"
+    session = await resumable.create(db, user.id, filename, upload_length)
+    location = str(request.url_for("append_upload", upload_id=session.id))
+    return JSONResponse(status_code=201, content={"id": str(session.id), "location": location},
+                        headers={**resumable.headers(session), "Location": location})
+
+
+@app.head("/uploads/{upload_id}")
+async def upload_status(upload_id: uuid.UUID, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Сколько байт уже принято: с этого Upload-Offset продолжать после обрыва"""
+    session = await resumable.get_session(db, upload_id, user.id)
+    return Response(status_code=200, headers=resumable.headers(session))
+
+
+@app.patch("/uploads/{upload_id}")
+async def append_upload(
+    upload_id: uuid.UUID,
+    request: Request,
+    upload_offset: int = Header(..., ge=0),
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Дописывает кусок тела application/offset+octet-stream с Upload-Offset.
+    Принятые до обрыва связи байты сохраняются."""
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        raise HTTPException(status_code=415, detail="Content-Type must be application/offset+octet-stream")
+    session = await resumable.get_session(db, upload_id, user.id)
+    # Соединение с БД не держим, пока принимается тело; дальше session — просто значения
+    db.expunge(session)
+    await db.rollback()
+    if upload_offset != session.upload_offset:
+        raise HTTPException(status_code=409, detail="Upload-Offset mismatch",
+                            headers={"Upload-Offset": str(session.upload_offset)})
+
+    resumable.claim(upload_id)
+    partial = resumable.PartialFile(upload_id, session.upload_offset, session.length)
+    try:
+        async with partial:
+            async for chunk in request.stream():
+                await partial.write(chunk)
+    except ClientDisconnect:
+        pass
+    finally:
+        try:
+            session.upload_offset = partial.offset
+            session.expires_at = await resumable.save_offset(db, upload_id, partial.offset)
+        finally:
+            resumable.release(upload_id)
+    return Response(status_code=204, headers=resumable.headers(session))
+
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def cancel_upload(upload_id: uuid.UUID, user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if not await resumable.terminate(db, upload_id, user.id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return Response(status_code=204, headers={"Tus-Resumable": resumable.TUS_VERSION})
+
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: uuid.UUID,
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    async_mode: bool = Query(False, alias="async")
+):
+    """Передаёт докачанный файл в обработку. Ответ как у /upload/file, в том числе 202 с ?async=true."""
+    session = await resumable.get_session(db, upload_id, user.id)
+    if session.upload_offset != session.length:
+        raise HTTPException(status_code=409, detail="Upload is incomplete",
+                            headers={"Upload-Offset": str(session.upload_offset)})
+    file = await resumable.complete(db, session, with_digest=CONTENT_ADDRESSED)
+    try:
+        # При ошибке _store_upload ничего не оставляет в БД, поэтому файл можно вернуть сессии
+        response = await _store_upload(db, user, file, async_mode)
+    except BaseException:
+        await file.discard()
+        await db.rollback()
+        await resumable.restore(upload_id)
+        raise
+    await resumable.finish(db, upload_id)
+    return response
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: uuid.UUID, user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)):
+    result = await db.execute(
+        select(ProcessingJob).where(
+            ProcessingJob.id == job_id,
+            ProcessingJob.user_id == user.id
+        )
+    )
+    job = result.scalar_one_or_none()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+# Колонки списка: строки читаются как mapping, без создания объектов MediaFile
+MEDIA_LIST_COLUMNS = (
+    MediaFile.id,
+    MediaFile.original_name,
+    MediaFile.type,
+    MediaFile.url,
+    MediaFile.urls,
+    MediaFile.created_at,
+    *(getattr(MediaFile, field) for field in MEDIA_METADATA_FIELDS),
+)
 
-    if not file_type.startswith("image"):
-        raise HTTPException(status_code=400, detail=f"file type is invalid, need image, current is {file_type}")
 
-    unique_name = f"{uuid.uuid4().hex}.{ext}"
-    file_path = os.path.join(UPLOAD_DIR, unique_name)
+def _encode_cursor(row) -> str:
+    raw = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
 
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
 
-    valid, error = validate_file(file_path)
-    if not valid:
-        raise HTTPException(status_code=400, detail=error)
+def _decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, _, media_id = raw.partition("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(media_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 
-    result = resize_image(file_path, AVATAR_SIZES)
+@app.get("/media", response_model=MediaPage)
+async def list_media(
+    user=Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    type: str = Query(None, pattern="^(image|video|audio)$"),
+    created_after: datetime = Query(None),
+    created_before: datetime = Query(None),
+    cursor: str = Query(None),
+    limit: int = Query(MEDIA_PAGE_SIZE, ge=1, le=MEDIA_PAGE_MAX)
+):
+    """Файлы пользователя, новые первыми, с курсорной пагинацией.
+
+    cursor — next_cursor предыдущей страницы, то есть (created_at, id) её
+    последней строки. Страница читается по индексу (user_id, created_at, id)
+    сразу с этого места, поэтому любая страница стоит одинаково, сколько бы
+    файлов ни было у пользователя.
+    """
+    query = select(*MEDIA_LIST_COLUMNS).where(MediaFile.user_id == user.id)
+    if type:
+        query = query.where(MediaFile.type.like(f"{type}/%"))
+    if created_after:
+        query = query.where(MediaFile.created_at >= created_after)
+    if created_before:
+        query = query.where(MediaFile.created_at < created_before)
+    if cursor:
+        created_at, media_id = _decode_cursor(cursor)
+        query = query.where(tuple_(MediaFile.created_at, MediaFile.id) < tuple_(created_at, media_id))
+    query = query.order_by(MediaFile.created_at.desc(), MediaFile.id.desc()).limit(limit + 1)
+
+    rows = (await db.execute(query)).mappings().all()
+    items = [{
+        "id": row["id"],
+        "file": row["original_name"],
+        "type": row["type"].split("/")[0],
+        "mimetype": row["type"],
+        "url": row["url"],
+        "urls": row["urls"],
+        "metadata": {field: row[field] for field in MEDIA_METADATA_FIELDS},
+        "created_at": row["created_at"],
+    } for row in rows[:limit]]
+    return {"items": items, "next_cursor": _encode_cursor(rows[limit - 1]) if len(rows) > limit else None}
+
+
+@app.post("/upload/avatar", openapi_extra=UPLOAD_OPENAPI)
+async def upload_avatar(request: Request, authorized: bool = Depends(verify_secret)):
+    lane = admission.lanes["image"]
+    lane.check()
+    file = await ingest_upload(request, allowed=("image",))
+
+    unique_name = f"{uuid.uuid4().hex}.{file.extension}"
+    file_path = storage.path_for(unique_name)
+    await file.save(file_path)
+
+    async with lane.admit():
+        valid, error = await run_in_pool(validate_file, file_path)
+        if not valid:
+            raise HTTPException(status_code=400, detail=error)
+        result = await run_in_pool(resize_image, file_path, AVATAR_SIZES, family="avatar", remove_source=True)
     return {"result": {"urls": result}}
 
 
+async def _delete_media(db: AsyncSession, user_id, *where) -> tuple[list, set]:
+    """Удаляет записи загрузок пользователя (с условиями where — только подходящие)
+    вместе с вариантами, возвращает место в квоте и отпускает ссылки CAS.
+
+    Возвращает удалённые строки и файлы, которые после commit можно удалить с диска.
+    """
+    # Записи вариантов удалились бы и каскадом, но имена файлов нужны до этого
+    variants = {}
+    result = await db.execute(
+        delete(MediaVariant)
+        .where(MediaVariant.media_id.in_(select(MediaFile.id).where(MediaFile.user_id == user_id, *where)))
+        .returning(MediaVariant.media_id, MediaVariant.filename)
+    )
+    for media_id, name in result.all():
+        variants.setdefault(media_id, []).append(name)
+    result = await db.execute(
+        delete(MediaFile)
+        .where(MediaFile.user_id == user_id, *where)
+        .returning(MediaFile.id, MediaFile.stem, MediaFile.filename, MediaFile.digest, MediaFile.size)
+    )
+    rows = result.all()
+    await quotas.release(db, user_id, sum(row.size for row in rows), len(rows))
+
+    to_remove = set()
+    released = Counter()
+    shared = {}
+    for row in rows:
+        if row.digest:
+            released[row.digest] += 1
+            shared.setdefault(row.digest, set()).update(variants.get(row.id, []))
+        else:
+            to_remove.update([row.filename, f"{row.stem}_preview.jpg", *variants.get(row.id, [])])
+    # Общий файл удаляется только вместе с последней ссылкой на него
+    for digest, count in released.items():
+        files = await cas.release(db, digest, count)
+        if files:
+            to_remove.update([*files, *shared[digest]])
+    return rows, to_remove
+
+
+async def _remove_media_files(rows, to_remove: set):
+    """Удаляет с диска и из кэша вариантов файлы, собранные _delete_media."""
+    cached = [cached for name in to_remove if is_variant_source(name) for cached in variant_names(name)]
+    await run_in_threadpool(storage.remove_many, with_alternates(to_remove))
+    await variant_cache.discard(with_alternates(to_remove) + with_alternates(cached),
+                                stems={row.stem for row in rows})
+
+
 @app.post("/delete_files")
 async def delete_files(
     data: DeleteFilesRequest,
     user=Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
+    """Удаляет загрузки по любым ссылкам из ответа /upload/file вместе с вариантами и превью"""
+    stems = {}
     for url in data.urls:
-        filename = os.path.basename(unquote(str(url)))
-
-        result = await db.execute(
-            select(MediaFile).where(
-                MediaFile.filename == filename,
-                MediaFile.user_id == user.id
-            )
-        )
-        media = result.scalar_one_or_none()
-
-        if not media:
-            continue
-
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-        await db.delete(media)
+        filename = os.path.basename(unquote(urlparse(str(url)).path))
+        stems[url] = storage.stem(filename) if storage.is_valid_name(filename) else None
 
+    rows, to_remove = [], set()
+    wanted = {stem for stem in stems.values() if stem}
+    if wanted:
+        rows, to_remove = await _delete_media(db, user.id, MediaFile.stem.in_(wanted))
     await db.commit()
-    return {"message": "Files deleted"}
-
+    await _remove_media_files(rows, to_remove)
+
+    deleted = {row.stem for row in rows}
+    return {
+        "message": "Files deleted",
+        "results": [{"url": url, "status": "deleted" if stem in deleted else "not_found"}
+                    for url, stem in stems.items()],
+    }
+
+
+@app.api_route(f"/{SERVER_ID}/files/{{filename}}", methods=["GET", "HEAD"])
+async def get_file(request: Request, filename: str, w: int = Query(None), h: int = Query(None),
+                   fit: str = Query("contain")):
+    """Отдача файла. С ?w=&h=&fit= отдаётся вариант изображения, который
+    рендерится при первом запросе и дальше берётся из кэша (variants.py).
+    JPEG-варианты отдаются в webp/avif, если их принимает клиент (Accept)."""
+    filename = unquote(filename)
+    avatar = avatars.parse_name(filename)
+    if avatar is not None:
+        data = await avatars.get_avatar(*avatar)
+        return MemoryFileResponse(data, media_type="image/jpeg")
+
+    file_path = storage.resolve(filename)
+
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="File not found")
 
-@app.get(f"/{SERVER_ID}/files/{{filename}}")
-async def get_file(filename: str):
-    file_path = os.path.join(UPLOAD_DIR, unquote(filename))
+    if w is None and h is None:
+        name = filename
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
+        def render(path, fmt):
+            return admission.lanes["interactive"].run(encode_alternate, file_path, path, fmt)
+    else:
+        size = (w, h)
+        if size not in VARIANT_SIZES or fit not in VARIANT_FITS:
+            raise HTTPException(status_code=400, detail="Unsupported variant size")
+        if not (mimetypes.guess_type(filename)[0] or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail="Variants are available only for images")
+        name = variant_name(filename, size, fit)
+
+        def render(path, fmt):
+            return admission.lanes["interactive"].run(render_variant, file_path, path, size, fit, fmt)
+
+    formats = alternate_formats(name)
+    fmt = negotiate_format(request.headers.get("accept"), formats)
+    path = None
+    if fmt is not None:
+        alternate = alternate_name(name, fmt)
+        # В режиме ALTERNATE_FORMATS_EAGER файл уже лежит рядом с JPEG
+        path = storage.resolve(alternate) if name == filename else None
+        if path is None:
+            try:
+                path = await variant_cache.get_or_render(alternate, lambda path: render(path, fmt))
+            except HTTPException as e:
+                # Исходник слишком велик, чтобы перекодировать его целиком, — отдаём как есть
+                if e.status_code != 413 or name != filename:
+                    raise
+    if path is not None:
+        response = MediaFileResponse(path, filename=alternate, media_type=IMAGE_FORMATS[fmt][1])
+    elif name == filename:
+        response = MediaFileResponse(file_path, filename=filename)
+    else:
+        path = await variant_cache.get_or_render(name, lambda path: render(path, "jpeg"))
+        response = MediaFileResponse(path, filename=name, media_type="image/jpeg")
 
-    return FileResponse(file_path, filename=unquote(filename))
+    if formats:
+        response.headers["vary"] = "Accept"
+    return response
 
 
 @app.post("/upload/from_string/{string}")
 async def image_from_string(string: str, authorized: bool = Depends(verify_secret)):
-    filename = f"{string[0].upper()}"
-    file_urls = {}
-    bg = random.choice(BACKGROUND_COLORS)
-    for n, size in enumerate(AVATAR_SIZES_STRINGS):
-        path = os.path.join(UPLOAD_DIR, f"{filename}_{size}.jpg")
-        if not os.path.exists(path):
-            path = generate_image_from_string(string, AVATAR_SIZES[n], bg=bg)
-        file_urls[f"{LETTERS[n]}"] = get_file_url(path)
-    return {"result": {"file": filename, "urls": file_urls}}
+    """Ссылки на буквенный аватар. Сами картинки рендерятся при первом GET и
+    отдаются из памяти (avatars.py), на диск ничего не пишется."""
+    text = avatars.initials(string)
+    if not text:
+        raise HTTPException(status_code=400, detail="String has no letters or digits")
+    palette = avatars.palette_index(string)
+    file_urls = {f"{LETTERS[n]}": get_file_url(avatars.avatar_name(text, size, palette))
+                 for n, size in enumerate(AVATAR_SIZES)}
+    return {"result": {"file": text, "urls": file_urls}}
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="127.0.0.1", port=PORT)
@@ -0,0 +1,275 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from conf import METRICS_ENABLED
+
+# Границы корзин гистограмм в секундах: от быстрых запросов до обработки видео
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_caches = {}
+_queues = {}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _sample(name: str, labelnames, labelvalues, value) -> str:
+    if labelnames:
+        labels = ",".join(f'{key}="{_escape(val)}"' for key, val in zip(labelnames, labelvalues))
+        return f"{name}{{{labels}}} {_format(value)}"
+    return f"{name} {_format(value)}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            yield _sample(self.name, self.labelnames, labelvalues, value)
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # labelvalues -> [счётчики по корзинам, сумма]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self._values.items()]
+        labelnames = self.labelnames + ("le",)
+        for labelvalues, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield _sample(f"{self.name}_bucket", labelnames, labelvalues + (_format(float(bound)),), cumulative)
+            yield _sample(f"{self.name}_sum", self.labelnames, labelvalues, total)
+            yield _sample(f"{self.name}_count", self.labelnames, labelvalues, cumulative)
+
+
+class Collected:
+    """Показатель, который снимается в момент выдачи /metrics.
+
+    collect() возвращает число или словарь {значения меток: число}; так
+    отдаются размеры очередей, пула соединений и счётчики кэшей, которые
+    уже ведутся в самих объектах.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), collect=None,
+                 type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+        self.type = type
+        _registry.append(self)
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelvalues, value in values.items():
+            if value is not None:
+                yield _sample(self.name, self.labelnames, labelvalues, value)
+
+
+def register_cache(name: str, stats):
+    """Добавляет кэш в media_cache_*; stats() — метод stats() кэша (TTLCache, VariantCache)."""
+    _caches[name] = stats
+
+
+def register_queue(name: str, depth):
+    """Добавляет очередь в media_queue_depth; depth() возвращает текущую длину."""
+    _queues[name] = depth
+
+
+def _cache_field(*fields):
+    def collect():
+        values = {}
+        for name, stats in _caches.items():
+            data = stats()
+            for field in fields:
+                if field in data:
+                    values[(name,)] = data[field]
+                    break
+        return values
+    return collect
+
+
+requests_total = Counter("media_http_requests_total", "HTTP requests by route and status",
+                         ("method", "route", "status"))
+request_seconds = Histogram("media_http_request_duration_seconds", "HTTP request latency by route",
+                            ("method", "route"))
+request_bytes = Counter("media_http_request_bytes_total", "Request body bytes received", ("method", "route"))
+response_bytes = Counter("media_http_response_bytes_total", "Response body bytes sent", ("method", "route"))
+stage_seconds = Histogram("media_stage_duration_seconds", "Time spent in processing stages", ("stage",))
+
+Collected("media_queue_depth", "Items waiting or in progress per queue", ("queue",),
+          lambda: {(name,): depth() for name, depth in _queues.items()})
+Collected("media_cache_hits_total", "Cache hits", ("cache",), _cache_field("hits"), type="counter")
+Collected("media_cache_misses_total", "Cache misses", ("cache",), _cache_field("misses"), type="counter")
+Collected("media_cache_evictions_total", "Cache evictions", ("cache",), _cache_field("evictions"), type="counter")
+Collected("media_cache_hit_ratio", "Cache hit ratio since start", ("cache",), _cache_field("hit_ratio"))
+Collected("media_cache_entries", "Entries in cache", ("cache",), _cache_field("size", "files"))
+
+
+def render() -> str:
+    """Все показатели процесса в текстовом формате Prometheus."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+# В дочернем процессе пула тайминги копятся здесь и возвращаются родителю вместе
+# с результатом задачи (workers._call), в основном процессе пишутся сразу
+_stage_buffer = None
+
+
+def record_stage(name: str, seconds: float):
+    if _stage_buffer is not None:
+        _stage_buffer.append((name, seconds))
+    else:
+        stage_seconds.observe(seconds, name)
+
+
+@contextmanager
+def stage(name: str):
+    """Замеряет этап обработки: with stage("resize.decode"): ..."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """Декоратор: вся функция — один этап. Функция остаётся пригодной для пула процессов."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collect_stages():
+    global _stage_buffer
+    _stage_buffer = []
+
+
+def take_stages() -> list:
+    global _stage_buffer
+    stages, _stage_buffer = _stage_buffer or [], None
+    return stages
+
+
+def observe_stages(stages: list):
+    for name, seconds in stages:
+        stage_seconds.observe(seconds, name)
+
+
+class MetricsMiddleware:
+    """Считает запросы, задержку и трафик по шаблону маршрута (/files/{filename}),
+    а не по фактическому пути, чтобы число рядов не росло с числом файлов."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        received = 0
+        sent = 0
+        length = 0  # Content-Length ответа
+
+        async def receive_wrapper():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status, sent, length
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                length = next((int(value) for key, value in message.get("headers", ())
+                               if key.lower() == b"content-length"), 0)
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            # Расширения ASGI, которыми тело отдаёт сам сервер (responses.MediaFileResponse)
+            elif message["type"] == "http.response.zerocopysend":
+                if "count" in message:
+                    sent += message["count"]
+                else:
+                    sent += os.fstat(message["file"].fileno()).st_size - message.get("offset", 0)
+            elif message["type"] == "http.response.pathsend":
+                sent += length
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            # Маршрут Starlette записывает в scope при сопоставлении
+            route = getattr(scope.get("route"), "path", None) or "<unmatched>"
+            method = scope["method"]
+            requests_total.inc(method, route, str(status))
+            request_seconds.observe(time.perf_counter() - start, method, route)
+            if received:
+                request_bytes.inc(method, route, amount=received)
+            if sent:
+                response_bytes.inc(method, route, amount=sent)
@@ -0,0 +1,54 @@
+"""Перенос файлов из плоского UPLOAD_DIR в шардированную раскладку ab/cd/<name>.
+
+Можно запускать на работающем сервере: файлы переносятся атомарным
+os.replace в пределах одного диска, а get_file до конца миграции ищет
+файл в обоих местах (STORAGE_LEGACY_LOOKUP). Скрипт идемпотентен — при
+обрыве достаточно запустить его ещё раз. После завершения можно выключить
+STORAGE_LEGACY_LOOKUP, чтобы не делать лишний stat на каждый запрос.
+
+    python migrate_storage.py --batch 1000 --pause 0.2
+"""
+import argparse
+import os
+import time
+
+import storage
+from conf import UPLOAD_DIR
+
+
+def migrate(batch: int, pause: float, dry_run: bool = False) -> int:
+    moved = 0
+    in_batch = 0
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            # Каталоги шардов и служебные каталоги (.tmp) пропускаем
+            if not entry.is_file(follow_symlinks=False) or not storage.is_valid_name(entry.name):
+                continue
+
+            target = os.path.join(storage.shard_dir(entry.name), entry.name)
+            if not dry_run:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(entry.path, target)
+            moved += 1
+            in_batch += 1
+
+            if in_batch >= batch:
+                print(f"Перенесено файлов: {moved}")
+                in_batch = 0
+                time.sleep(pause)  # Не отбираем весь диск у живых запросов
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=1000, help="файлов между паузами")
+    parser.add_argument("--pause", type=float, default=0.1, help="пауза между пачками, секунды")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать файлы")
+    args = parser.parse_args()
+
+    moved = migrate(args.batch, args.pause, args.dry_run)
+    print(f"Готово, перенесено файлов: {moved}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+-- Метаданные медиафайлов из services.probe_media
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS width INTEGER;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS height INTEGER;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS video_codec VARCHAR;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS audio_codec VARCHAR;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS bitrate BIGINT;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS frame_rate DOUBLE PRECISION;
@@ -0,0 +1,18 @@
+-- Очередь фоновой обработки видео (jobs.py)
+CREATE TABLE IF NOT EXISTS processing_jobs (
+    id UUID PRIMARY KEY,
+    media_id UUID NOT NULL REFERENCES media_files(id) ON DELETE CASCADE,
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    status VARCHAR NOT NULL DEFAULT 'queued',
+    progress INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    error VARCHAR,
+    result JSON,
+    run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_processing_jobs_user_id ON processing_jobs (user_id);
+CREATE INDEX IF NOT EXISTS ix_processing_jobs_pending ON processing_jobs (status, run_after)
+    WHERE status IN ('queued', 'running');
@@ -0,0 +1,17 @@
+-- Content-addressed хранение с подсчётом ссылок (cas.py)
+CREATE TABLE IF NOT EXISTS content_blobs (
+    digest VARCHAR(64) PRIMARY KEY,
+    filename VARCHAR NOT NULL,
+    type VARCHAR NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 1,
+    result JSON,
+    files JSON,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+-- Одинаковое содержимое разных загрузок хранится под одним именем
+ALTER TABLE media_files DROP CONSTRAINT IF EXISTS media_files_filename_key;
+CREATE INDEX IF NOT EXISTS ix_media_files_filename ON media_files (filename);
+
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS digest VARCHAR REFERENCES content_blobs(digest);
+CREATE INDEX IF NOT EXISTS ix_media_files_digest ON media_files (digest);
@@ -0,0 +1,9 @@
+-- Поиск загрузки по любой ссылке из ответа и удаление производных файлов (delete_files)
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS stem VARCHAR;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS files JSON;
+
+-- Для старых записей stem — имя исходника без расширения; их варианты назывались
+-- случайными uuid, поэтому files остаётся пустым и удаляется только исходник
+UPDATE media_files SET stem = split_part(filename, '.', 1) WHERE stem IS NULL;
+
+CREATE INDEX IF NOT EXISTS ix_media_files_user_stem ON media_files (user_id, stem);
@@ -0,0 +1,14 @@
+-- Список файлов пользователя (GET /media): ссылки на варианты и индекс для курсорной пагинации
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS urls JSON;
+
+-- Ссылки известны для content-addressed загрузок и фоновой обработки видео,
+-- у остальных старых записей urls остаётся пустым
+UPDATE media_files m SET urls = b.result -> 'urls'
+FROM content_blobs b
+WHERE m.digest = b.digest AND m.urls IS NULL AND b.result IS NOT NULL;
+
+UPDATE media_files m SET urls = j.result -> 'urls'
+FROM processing_jobs j
+WHERE j.media_id = m.id AND j.status = 'done' AND m.urls IS NULL AND j.result IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS ix_media_files_user_created ON media_files (user_id, created_at, id);
@@ -0,0 +1,21 @@
+-- Производные файлы загрузок (варианты, размытые копии, превью) и сборщик мусора (storage_gc.py)
+CREATE TABLE IF NOT EXISTS media_variants (
+    id UUID PRIMARY KEY,
+    media_id UUID NOT NULL REFERENCES media_files(id) ON DELETE CASCADE,
+    filename VARCHAR NOT NULL,
+    kind VARCHAR NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_media_variants_media_id ON media_variants (media_id);
+CREATE INDEX IF NOT EXISTS ix_media_variants_filename ON media_variants (filename);
+
+-- Переносим media_files.files (004) в таблицу; gen_random_uuid() есть в PostgreSQL 13+
+INSERT INTO media_variants (id, media_id, filename, kind)
+SELECT gen_random_uuid(), m.id, f.name,
+       CASE WHEN f.name LIKE '%\_preview.jpg' THEN 'preview'
+            WHEN f.name LIKE '%\_blurred.jpg' THEN 'blur'
+            ELSE 'photo' END
+FROM media_files m, json_array_elements_text(m.files) AS f(name)
+WHERE m.files IS NOT NULL;
+
+ALTER TABLE media_files DROP COLUMN IF EXISTS files;
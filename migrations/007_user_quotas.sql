@@ -0,0 +1,11 @@
+-- Квоты пользователей: счётчики занятого места и свои лимиты (quotas.py)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS used_bytes BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS used_files INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_bytes BIGINT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_files INTEGER;
+ALTER TABLE media_files ADD COLUMN IF NOT EXISTS size BIGINT NOT NULL DEFAULT 0;
+
+-- Число загрузок считается здесь, размеры старых файлов — python quotas.py --recount
+UPDATE users u SET used_files = c.files
+FROM (SELECT user_id, count(*) AS files FROM media_files GROUP BY user_id) c
+WHERE c.user_id = u.id;
@@ -0,0 +1,12 @@
+-- Возобновляемые загрузки (POST /uploads, resumable.py)
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id UUID PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    filename VARCHAR NOT NULL,
+    length BIGINT NOT NULL,
+    upload_offset BIGINT NOT NULL DEFAULT 0,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_upload_sessions_user_id ON upload_sessions (user_id);
+CREATE INDEX IF NOT EXISTS ix_upload_sessions_expires_at ON upload_sessions (expires_at);
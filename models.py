@@ -3,8 +3,12 @@ from sqlalchemy import (
     Column,
     String,
     Float,
+    Integer,
+    BigInteger,
     ForeignKey,
     DateTime,
+    JSON,
+    Index,
     func
 )
 from sqlalchemy.dialects.postgresql import UUID
@@ -19,12 +23,23 @@ class User(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     api_key = Column(String, unique=True, nullable=False, index=True)
 
+    # Занятое место (исходники с вариантами) и число загрузок, см. quotas.py
+    used_bytes = Column(BigInteger, nullable=False, default=0, server_default="0")
+    used_files = Column(Integer, nullable=False, default=0, server_default="0")
+    # Свои лимиты пользователя, None — QUOTA_BYTES / QUOTA_FILES, 0 — без ограничения
+    quota_bytes = Column(BigInteger, nullable=True)
+    quota_files = Column(Integer, nullable=True)
+
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Файлов у пользователя могут быть сотни тысяч: коллекцию не загружаем
+    # (список — GET /media), при удалении пользователя записи удаляет ON DELETE CASCADE
     files = relationship(
         "MediaFile",
         back_populates="user",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
 
 
@@ -39,14 +54,121 @@ class MediaFile(Base):
         nullable=False
     )
 
-    filename = Column(String, nullable=False, unique=True)
+    # В content-addressed режиме одно имя файла делят все загрузки одинакового содержимого
+    filename = Column(String, nullable=False, index=True)
     original_name = Column(String, nullable=False)
+    digest = Column(String, ForeignKey("content_blobs.digest"), nullable=True, index=True)
+    # Общая часть имени исходника и производных файлов (storage.stem)
+    stem = Column(String, nullable=True)
+    # Ссылки из ответа обработки (urls), None пока обработка не закончена
+    urls = Column(JSON, nullable=True)
+    # Байты исходника и вариантов, учтённые в User.used_bytes
+    size = Column(BigInteger, nullable=False, default=0, server_default="0")
 
     type = Column(String, nullable=False)  # image / video / audio
     duration = Column(Float, nullable=True)
 
+    # Метаданные из services.probe_media, заполняются один раз при загрузке
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    video_codec = Column(String, nullable=True)
+    audio_codec = Column(String, nullable=True)
+    bitrate = Column(BigInteger, nullable=True)
+    frame_rate = Column(Float, nullable=True)
+
     url = Column(String, nullable=False)
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     user = relationship("User", back_populates="files")
+
+    __table_args__ = (
+        Index("ix_media_files_user_stem", "user_id", "stem"),
+        # Курсорная пагинация GET /media
+        Index("ix_media_files_user_created", "user_id", "created_at", "id"),
+    )
+
+
+class MediaVariant(Base):
+    """Производный файл загрузки: вариант размера, размытая копия, превью видео.
+
+    Удаляется вместе с MediaFile (ON DELETE CASCADE), файл на диске — в
+    delete_files, а всё, на что не осталось записей, подбирает storage_gc.py.
+    """
+    __tablename__ = "media_variants"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    media_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("media_files.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+    filename = Column(String, nullable=False, index=True)
+    kind = Column(String, nullable=False)  # photo / preview / blur, см. services.variant_family
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class UploadSession(Base):
+    """Возобновляемая загрузка (resumable.py): тело копится в PARTIAL_DIR/<id>"""
+    __tablename__ = "upload_sessions"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+    filename = Column(String, nullable=False)
+    length = Column(BigInteger, nullable=False)  # Upload-Length, объявленный при создании
+    upload_offset = Column(BigInteger, nullable=False, default=0)  # Сколько байт уже на диске
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ContentBlob(Base):
+    """Сохранённое содержимое в content-addressed режиме (CONTENT_ADDRESSED), см. cas.py"""
+    __tablename__ = "content_blobs"
+
+    digest = Column(String(64), primary_key=True)  # sha256 исходных байтов
+    filename = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    refcount = Column(Integer, nullable=False, default=1)
+
+    result = Column(JSON, nullable=True)  # Ответ обработки без поля file, None пока не готов
+    files = Column(JSON, nullable=True)  # Все файлы на диске: оригинал и производные
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ProcessingJob(Base):
+    """Фоновая обработка загруженного видео (превью и варианты), см. jobs.py"""
+    __tablename__ = "processing_jobs"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+
+    media_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("media_files.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True
+    )
+
+    status = Column(String, nullable=False, default="queued")  # queued / running / done / failed
+    progress = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    error = Column(String, nullable=True)
+    result = Column(JSON, nullable=True)  # Готовый VideoUploadResponse
+
+    run_after = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,80 @@
+from contextlib import nullcontext
+
+import admission
+import cas
+from conf import PHOTO_SIZES, LAZY_VARIANTS
+from models import MediaVariant
+from services import generate_video_preview, resize_image, get_file_url, variant_urls, variant_family
+from workers import run_in_pool
+
+
+def derived_files(result: dict, source: str) -> list[str]:
+    """Имена производных файлов из результата обработки, кроме самого исходника."""
+    return sorted({name for name in cas.result_files(result) if name != source})
+
+
+def variant_rows(media_id, names) -> list[MediaVariant]:
+    """Записи media_variants для производных файлов загрузки media_id."""
+    return [MediaVariant(media_id=media_id, filename=name, kind=variant_family(name)) for name in names]
+
+
+def upload_lane(file_type: str) -> admission.Lane | None:
+    """Полоса, через которую пойдёт обработка загрузки; None — в пуле ничего не делается."""
+    if file_type.startswith("image") and LAZY_VARIANTS:
+        return None
+    return admission.for_type(file_type)
+
+
+def _admit(kind: str, background: bool, admitted: bool):
+    if admitted:
+        return nullcontext()
+    return admission.lanes[kind].admit(bounded=not background)
+
+
+async def _report(progress, value: int):
+    if progress is not None:
+        await progress(value)
+
+
+async def process_upload(file_path: str, file_type: str, filename: str, metadata: dict,
+                         progress=None, stem: str = None, background: bool = False,
+                         admitted: bool = False) -> dict:
+    """Обрабатывает сохранённый файл и собирает элемент ответа /upload/file.
+
+    Общий код для синхронной загрузки и фоновых задач (jobs.py). progress —
+    необязательная корутина, получающая процент выполнения, stem — имя для
+    производных файлов (digest в content-addressed режиме).
+
+    Работа в пуле идёт через полосу допуска image или video: при полной
+    очереди — 503. Фоновые задачи (background) ждут места без лимита очереди,
+    admitted — место в полосе уже занял вызывающий (_store_upload в main.py).
+    """
+    if file_type.startswith("image"):
+        if LAZY_VARIANTS:
+            # Исходник остаётся на диске, размеры рендерит get_file по первому запросу
+            urls = variant_urls(file_path, PHOTO_SIZES)
+        else:
+            async with _admit("image", background, admitted):
+                urls = await run_in_pool(resize_image, file_path, PHOTO_SIZES, stem=stem)
+        return {"file": filename, "type": "image", "metadata": metadata, "urls": urls}
+
+    if file_type.startswith("video"):
+        async with _admit("video", background, admitted):
+            await _report(progress, 10)
+            # Постер сразу во всех размерах и лента миниатюр — один запуск ffmpeg
+            urls = await run_in_pool(generate_video_preview, file_path, metadata,
+                                     None if LAZY_VARIANTS else PHOTO_SIZES, stem=stem)
+            if LAZY_VARIANTS:
+                urls["preview"] = variant_urls(urls["preview"], PHOTO_SIZES)
+            await _report(progress, 90)
+        return {"file": filename,
+                "type": "video",
+                "duration": metadata["duration"],
+                "metadata": metadata,
+                "urls": {**urls, "video": get_file_url(file_path)}}
+
+    return {"file": filename,
+            "type": "audio",
+            "duration": metadata["duration"] or 0.0,
+            "metadata": metadata,
+            "urls": {"audio": get_file_url(file_path)}}
@@ -0,0 +1,155 @@
+"""Квоты пользователей на занятое место и число загрузок.
+
+Счётчики used_bytes/used_files лежат в строке users и меняются в той же
+транзакции, что и записи media_files, поэтому проверка квоты — чтение одной
+строки по первичному ключу, без обхода media_files и диска. Размер загрузки
+(MediaFile.size) — исходник вместе с вариантами: исходник списывается
+условным UPDATE при создании записи, варианты добавляются после обработки
+без проверки. Квота может быть превышена на варианты одной загрузки,
+следующая загрузка уже не пройдёт.
+
+Размеры записей, созданных до миграции 007, пересчитываются по диску один раз:
+
+    python quotas.py --recount
+"""
+import argparse
+import asyncio
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, update, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from conf import QUOTA_BYTES, QUOTA_FILES
+import storage
+from database import AsyncSessionLocal, engine
+from ingest import QUOTA_EXCEEDED
+from models import User, MediaFile, MediaVariant
+from services import with_alternates
+
+FILES_EXCEEDED = "File count quota exceeded"
+
+_limit_bytes = func.coalesce(User.quota_bytes, QUOTA_BYTES)
+_limit_files = func.coalesce(User.quota_files, QUOTA_FILES)
+
+
+async def files_size(names) -> int:
+    """Байты файлов на диске вместе с альтернативными форматами."""
+    return await run_in_threadpool(storage.total_size, with_alternates(names))
+
+
+async def usage(db: AsyncSession, user_id) -> dict:
+    row = (await db.execute(
+        select(User.used_bytes, User.used_files, _limit_bytes.label("quota_bytes"),
+               _limit_files.label("quota_files"))
+        .where(User.id == user_id)
+    )).one()
+    return {"used_bytes": row.used_bytes, "used_files": row.used_files,
+            "quota_bytes": row.quota_bytes or None, "quota_files": row.quota_files or None}
+
+
+async def remaining(db: AsyncSession, user_id) -> int | None:
+    """Сколько байт пользователь ещё может загрузить, None — без ограничения.
+
+    Исчерпанная квота отвечает 413 до приёма тела запроса.
+    """
+    current = await usage(db, user_id)
+    # Соединение не держим, пока принимается тело
+    await db.rollback()
+    if current["quota_files"] and current["used_files"] >= current["quota_files"]:
+        raise HTTPException(status_code=413, detail=FILES_EXCEEDED)
+    if not current["quota_bytes"]:
+        return None
+    if current["used_bytes"] >= current["quota_bytes"]:
+        raise HTTPException(status_code=413, detail=QUOTA_EXCEEDED)
+    return current["quota_bytes"] - current["used_bytes"]
+
+
+async def charge(db: AsyncSession, user_id, size: int, files: int = 1) -> bool:
+    """Списывает size байт и files загрузок, если квота позволяет. False — не позволяет.
+
+    Строка users заблокирована до конца транзакции, поэтому параллельные
+    загрузки одного пользователя не проскочат квоту вместе.
+    """
+    result = await db.execute(
+        update(User)
+        .where(User.id == user_id,
+               or_(_limit_bytes == 0, User.used_bytes + size <= _limit_bytes),
+               or_(_limit_files == 0, User.used_files + files <= _limit_files))
+        .values(used_bytes=User.used_bytes + size, used_files=User.used_files + files)
+        .execution_options(synchronize_session=False)
+    )
+    return bool(result.rowcount)
+
+
+async def add(db: AsyncSession, user_id, size: int):
+    """Добавляет байты вариантов без проверки квоты."""
+    if size:
+        await db.execute(update(User).where(User.id == user_id)
+                         .values(used_bytes=User.used_bytes + size)
+                         .execution_options(synchronize_session=False))
+
+
+async def release(db: AsyncSession, user_id, size: int, files: int):
+    if size or files:
+        await db.execute(update(User).where(User.id == user_id)
+                         .values(used_bytes=User.used_bytes - size, used_files=User.used_files - files)
+                         .execution_options(synchronize_session=False))
+
+
+async def recount(batch: int = 500) -> int:
+    """Пересчитывает MediaFile.size по диску, затем счётчики всех пользователей."""
+    counted = 0
+    last = None
+    while True:
+        async with AsyncSessionLocal() as db:
+            query = select(MediaFile.id, MediaFile.filename).order_by(MediaFile.id).limit(batch)
+            if last is not None:
+                query = query.where(MediaFile.id > last)
+            rows = (await db.execute(query)).all()
+            if not rows:
+                break
+            variants = {}
+            result = await db.execute(select(MediaVariant.media_id, MediaVariant.filename)
+                                      .where(MediaVariant.media_id.in_([row.id for row in rows])))
+            for media_id, name in result.all():
+                variants.setdefault(media_id, []).append(name)
+            for row in rows:
+                size = await files_size([row.filename, *variants.get(row.id, [])])
+                await db.execute(update(MediaFile).where(MediaFile.id == row.id).values(size=size))
+            await db.commit()
+        last = rows[-1].id
+        counted += len(rows)
+        print(f"Пересчитано загрузок: {counted}")
+
+    # Одним запросом по уже записанным размерам; на сервере без загрузок счётчики сойдутся точно
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(User).values(
+            used_bytes=select(func.coalesce(func.sum(MediaFile.size), 0))
+            .where(MediaFile.user_id == User.id).scalar_subquery(),
+            used_files=select(func.count(MediaFile.id)).where(MediaFile.user_id == User.id).scalar_subquery(),
+        ))
+        await db.commit()
+    return counted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recount", action="store_true", help="пересчитать размеры загрузок и счётчики")
+    parser.add_argument("--batch", type=int, default=500, help="загрузок в одной транзакции")
+    args = parser.parse_args()
+    if not args.recount:
+        parser.print_help()
+        return
+
+    async def run():
+        try:
+            return await recount(args.batch)
+        finally:
+            await engine.dispose()
+
+    print(f"Готово, пересчитано загрузок: {asyncio.run(run())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import hashlib
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from urllib.parse import quote
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Файлы в UPLOAD_DIR никогда не перезаписываются (имя = uuid или digest), поэтому кэшируются навсегда
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Сгенерированные файлы (аватары) по тому же имени меняются вместе с кодом рендера,
+# поэтому не immutable: раз в сутки кэш сверяется по ETag и обычно получает 304
+MEMORY_CACHE_CONTROL = "public, max-age=86400"
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_ranges(header: str, size: int, max_ranges: int) -> list[tuple[int, int]] | None:
+    """Разбирает заголовок Range в список (start, end) включительно.
+
+    Возвращает None, если заголовок некорректен или диапазонов слишком много —
+    тогда по RFC 9110 отдаётся весь файл. Пересекающиеся диапазоны склеиваются.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    try:
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            first, dash, last = part.partition("-")
+            if not dash:
+                return None
+            if not first:  # bytes=-500 — последние 500 байт
+                length = int(last)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            if start < size:
+                ranges.append((start, min(end, size - 1)))
+    except ValueError:
+        return None
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    if len(merged) > max_ranges:
+        return None
+    return merged
+
+
+def negotiate_format(accept: str | None, formats: list[str]) -> str | None:
+    """Первый из formats (они идут по предпочтению сервера), явно разрешённый в Accept.
+
+    image/* и */* не считаются: их шлют и браузеры без поддержки AVIF.
+    """
+    if not accept or not formats:
+        return None
+    accepted = set()
+    for item in accept.split(","):
+        media_type, *params = item.strip().split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.strip().lower())
+    for fmt in formats:
+        if f"image/{fmt}" in accepted:
+            return fmt
+    return None
+
+
+class MemoryFileResponse(Response):
+    """Отдача небольшого сгенерированного файла из памяти с ETag и If-None-Match.
+
+    ETag считается от содержимого: после изменения рендера (шрифт, палитра,
+    версия Pillow) он меняется, и кэши, сверившись, получают новый файл.
+    """
+
+    def __init__(self, content: bytes, media_type: str):
+        etag = f'"{hashlib.md5(content, usedforsecurity=False).hexdigest()}"'
+        super().__init__(content, media_type=media_type,
+                         headers={"etag": etag, "cache-control": MEMORY_CACHE_CONTROL})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if_none_match = Headers(scope=scope).get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if "*" in tags or self.headers["etag"] in tags:
+                headers = {key: self.headers[key] for key in ("etag", "cache-control")}
+                return await Response(status_code=304, headers=headers)(scope, receive, send)
+        await super().__call__(scope, receive, send)
+
+
+class MediaFileResponse(Response):
+    """Отдача файла из UPLOAD_DIR с Range, ETag и условными запросами.
+
+    - Range / If-Range, в том числе несколько диапазонов (multipart/byteranges);
+    - сильный ETag, If-None-Match и If-Modified-Since -> 304;
+    - Cache-Control: immutable;
+    - тело уходит через расширение ASGI http.response.zerocopysend (sendfile в ядре)
+      или http.response.pathsend, если сервер их поддерживает, иначе читается
+      кусками в пуле потоков.
+
+    uvicorn не объявляет ни одно из расширений, поэтому под ним тело всегда
+    читается кусками по chunk_size; отдача без копирования работает только под
+    сервером с pathsend или zerocopysend (например, Granian поддерживает pathsend).
+    """
+
+    chunk_size = 256 * 1024
+    max_ranges = 16
+
+    def __init__(self, path: str, filename: str = None, media_type: str = None,
+                 content_disposition_type: str = "attachment"):
+        self.path = path
+        self.filename = filename or os.path.basename(path)
+        self.media_type = media_type or guess_type(self.filename)[0] or "application/octet-stream"
+        self.background = None
+        self.status_code = 200
+        self.init_headers()
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        disposition_name = quote(self.filename)
+        if disposition_name != self.filename:
+            self.headers["content-disposition"] = f"{content_disposition_type}; filename*=utf-8''{disposition_name}"
+        else:
+            self.headers["content-disposition"] = f'{content_disposition_type}; filename="{self.filename}"'
+
+    @staticmethod
+    def make_etag(stat_result: os.stat_result, name: str) -> str:
+        base = f"{name}:{stat_result.st_size}:{stat_result.st_mtime_ns}"
+        return f'"{hashlib.md5(base.encode(), usedforsecurity=False).hexdigest()}"'
+
+    @staticmethod
+    def _parse_date(value: str):
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def _not_modified(self, request: Headers, etag: str, mtime: float) -> bool:
+        if_none_match = request.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = request.get("if-modified-since")
+        if if_modified_since:
+            since = self._parse_date(if_modified_since)
+            return since is not None and int(mtime) <= since
+        return False
+
+    def _range_allowed(self, request: Headers, etag: str, mtime: float) -> bool:
+        if_range = request.get("if-range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == etag  # Слабые ETag для If-Range не подходят
+        since = self._parse_date(if_range)
+        return since is not None and int(mtime) == since
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            # Файл удалили между поиском и отдачей
+            return await Response(status_code=404)(scope, receive, send)
+
+        size = stat_result.st_size
+        etag = self.make_etag(stat_result, self.filename)
+        self.headers["etag"] = etag
+        self.headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+
+        request = Headers(scope=scope)
+        method = scope["method"].upper()
+        head_only = method == "HEAD"
+
+        if method in ("GET", "HEAD") and self._not_modified(request, etag, stat_result.st_mtime):
+            headers = {key: self.headers[key] for key in ("etag", "last-modified", "cache-control", "vary")
+                       if key in self.headers}
+            return await Response(status_code=304, headers=headers)(scope, receive, send)
+
+        ranges = None
+        if method == "GET" and "range" in request and self._range_allowed(request, etag, stat_result.st_mtime):
+            try:
+                ranges = parse_ranges(request["range"], size, self.max_ranges)
+            except RangeNotSatisfiable:
+                headers = {"content-range": f"bytes */{size}", "accept-ranges": "bytes"}
+                return await Response(status_code=416, headers=headers)(scope, receive, send)
+
+        extensions = scope.get("extensions") or {}
+        self.zerocopy = "http.response.zerocopysend" in extensions
+        self.pathsend = "http.response.pathsend" in extensions
+
+        async with anyio.create_task_group() as task_group:
+            async def watch_disconnect():
+                # Клиент ушёл (например, перемотал видео) — прекращаем чтение файла
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+                task_group.cancel_scope.cancel()
+
+            if not head_only:
+                task_group.start_soon(watch_disconnect)
+
+            if not ranges:
+                await self._send_full(send, size, head_only)
+            elif len(ranges) == 1:
+                await self._send_single(send, ranges[0], size)
+            else:
+                await self._send_multiple(send, ranges, size)
+            task_group.cancel_scope.cancel()
+
+    async def _start(self, send: Send, status_code: int):
+        await send({"type": "http.response.start", "status": status_code, "headers": self.raw_headers})
+
+    async def _send_full(self, send: Send, size: int, head_only: bool):
+        self.headers["content-length"] = str(size)
+        self.headers["content-type"] = self.media_type
+        await self._start(send, 200)
+        if head_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif self.pathsend and not self.zerocopy:
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+        else:
+            await self._send_ranges(send, [(0, size - 1)] if size else [], [], b"")
+
+    async def _send_single(self, send: Send, byte_range: tuple[int, int], size: int):
+        start, end = byte_range
+        self.status_code = 206
+        self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        self.headers["content-length"] = str(end - start + 1)
+        self.headers["content-type"] = self.media_type
+        await self._start(send, 206)
+        await self._send_ranges(send, [byte_range], [], b"")
+
+    async def _send_multiple(self, send: Send, ranges: list[tuple[int, int]], size: int):
+        boundary = uuid.uuid4().hex
+        part_headers = [
+            (f"--{boundary}\r\ncontent-type: {self.media_type}\r\n"
+             f"content-range: bytes {start}-{end}/{size}\r\n\r\n").encode("latin-1")
+            for start, end in ranges
+        ]
+        # Перед каждой частью, кроме первой, идёт CRLF, после последней — закрывающая граница
+        part_headers = [part_headers[0]] + [b"\r\n" + header for header in part_headers[1:]]
+        closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        length = sum(len(h) for h in part_headers) + sum(end - start + 1 for start, end in ranges) + len(closing)
+
+        self.status_code = 206
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(length)
+        await self._start(send, 206)
+        await self._send_ranges(send, ranges, part_headers, closing)
+
+    async def _send_ranges(self, send: Send, ranges: list, part_headers: list, closing: bytes):
+        if not ranges:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            for n, (start, end) in enumerate(ranges):
+                if part_headers:
+                    await send({"type": "http.response.body", "body": part_headers[n], "more_body": True})
+                more_body = bool(closing) or n < len(ranges) - 1
+                await self._send_range(send, file, start, end - start + 1, more_body)
+            if closing:
+                await send({"type": "http.response.body", "body": closing, "more_body": False})
+        finally:
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(file.close)
+
+    async def _send_range(self, send: Send, file, offset: int, count: int, more_body: bool):
+        if self.zerocopy:
+            await send({"type": "http.response.zerocopysend", "file": file,
+                        "offset": offset, "count": count, "more_body": more_body})
+            return
+
+        await anyio.to_thread.run_sync(file.seek, offset)
+        while count > 0:
+            chunk = await anyio.to_thread.run_sync(file.read, min(self.chunk_size, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body or count > 0})
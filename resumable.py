@@ -0,0 +1,298 @@
+"""Возобновляемые загрузки по протоколу tus (ядро и расширения creation, termination, expiration).
+
+POST /uploads с Upload-Length создаёт сессию и пустой файл PARTIAL_DIR/<id>,
+PATCH /uploads/{id} дописывает тело с Upload-Offset, HEAD отдаёт текущее
+смещение, POST /uploads/{id}/complete передаёт готовый файл в обычный путь
+/upload/file. Тело PATCH пишется на диск по мере получения, в памяти не
+больше одного куска; при обрыве связи принятые байты сохраняются и клиент
+продолжает с Upload-Offset из HEAD. Сессия удаляется только после успешной
+обработки, после 503 complete можно повторить.
+
+Сессии истекают через UPLOAD_SESSION_TTL после последнего PATCH, их и
+файлы без сессий удаляет SessionReaper.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import traceback
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from conf import (
+    PARTIAL_DIR,
+    TMP_DIR,
+    MAX_FILE_SIZES,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_SESSION_TTL,
+    UPLOAD_SESSION_CLEANUP_INTERVAL
+)
+from database import AsyncSessionLocal
+from ingest import IngestedFile, SNIFF_BYTES, sniff_mimetype
+from models import UploadSession
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,termination,expiration"
+
+# PATCH одной сессии в этом процессе; tus-клиенты шлют куски последовательно
+_writing = set()
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def expires_in() -> datetime:
+    return _now() + timedelta(seconds=UPLOAD_SESSION_TTL)
+
+
+def partial_path(upload_id) -> str:
+    return os.path.join(PARTIAL_DIR, str(upload_id))
+
+
+def parse_metadata(value: str | None) -> dict:
+    """Upload-Metadata: пары «ключ base64(значение)» через запятую."""
+    metadata = {}
+    for pair in (value or "").split(","):
+        key, _, encoded = pair.strip().partition(" ")
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(encoded).decode("utf-8") if encoded else ""
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Upload-Metadata")
+    return metadata
+
+
+def headers(session: UploadSession) -> dict:
+    return {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(session.upload_offset),
+        "Upload-Length": str(session.length),
+        "Upload-Expires": session.expires_at.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        "Cache-Control": "no-store",
+    }
+
+
+async def get_session(db: AsyncSession, upload_id, user_id) -> UploadSession:
+    session = (await db.execute(
+        select(UploadSession).where(UploadSession.id == upload_id, UploadSession.user_id == user_id,
+                                    UploadSession.expires_at > _now())
+    )).scalar_one_or_none()
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+
+def _create_file(path: str):
+    open(path, "xb").close()
+
+
+async def create(db: AsyncSession, user_id, filename: str, length: int) -> UploadSession:
+    session = UploadSession(user_id=user_id, filename=filename, length=length, upload_offset=0,
+                            expires_at=expires_in())
+    db.add(session)
+    await db.commit()
+    # Файл создаётся после коммита: cleanup удаляет только файлы без записей
+    await run_in_threadpool(_create_file, partial_path(session.id))
+    return session
+
+
+class PartialFile:
+    """Дописывает тело PATCH к файлу сессии с offset; offset растёт по мере записи,
+    поэтому после обрыва связи известно, сколько байт принято."""
+
+    def __init__(self, upload_id, offset: int, length: int):
+        self.path = partial_path(upload_id)
+        self.offset = offset
+        self.length = length
+        self.file = None
+
+    def _open(self):
+        file = open(self.path, "r+b")
+        # Хвост от прерванного PATCH после offset не учтён в БД — отбрасываем
+        file.truncate(self.offset)
+        file.seek(self.offset)
+        return file
+
+    async def __aenter__(self):
+        try:
+            self.file = await run_in_threadpool(self._open)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        return self
+
+    async def __aexit__(self, *exc):
+        await run_in_threadpool(self.file.close)
+
+    async def write(self, chunk: bytes):
+        if self.offset + len(chunk) > self.length:
+            raise HTTPException(status_code=413, detail="Upload exceeds Upload-Length")
+        await run_in_threadpool(self.file.write, chunk)
+        self.offset += len(chunk)
+
+
+def claim(upload_id):
+    if upload_id in _writing:
+        raise HTTPException(status_code=409, detail="Upload is already being written")
+    _writing.add(upload_id)
+
+
+def release(upload_id):
+    _writing.discard(upload_id)
+
+
+async def save_offset(db: AsyncSession, upload_id, offset: int) -> datetime:
+    expires_at = expires_in()
+    await db.execute(update(UploadSession).where(UploadSession.id == upload_id)
+                     .values(upload_offset=offset, expires_at=expires_at))
+    await db.commit()
+    return expires_at
+
+
+def _inspect(path: str, with_digest: bool) -> tuple[str | None, str | None]:
+    """Тип по первым байтам и, для content-addressed режима, sha256 содержимого."""
+    with open(path, "rb") as source:
+        head = source.read(SNIFF_BYTES)
+        if not with_digest:
+            return sniff_mimetype(head), None
+        digest = hashlib.sha256(head)
+        for block in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+    return sniff_mimetype(head), digest.hexdigest()
+
+
+def held_path(upload_id) -> str:
+    """Файл сессии на время complete: вне PARTIAL_DIR его не трогает cleanup()."""
+    return os.path.join(TMP_DIR, f"{upload_id}.part")
+
+
+def _hold(upload_id) -> str:
+    held = held_path(upload_id)
+    os.replace(partial_path(upload_id), held)
+    # Время последнего PATCH может быть старше GC_GRACE_PERIOD, а storage_gc чистит TMP_DIR
+    os.utime(held)
+    link = os.path.join(TMP_DIR, f"{upload_id}.{uuid.uuid4().hex}.part")
+    os.link(held, link)
+    return link
+
+
+async def complete(db: AsyncSession, session: UploadSession, with_digest: bool) -> IngestedFile:
+    """Отдаёт докачанный файл в обработку, как обычную принятую загрузку.
+
+    Файл сессии переносится в TMP_DIR — атомарный захват, повторный complete
+    получит 409, — а обработка получает жёсткую ссылку на него. Сессия
+    остаётся до finish(): если обработка упала (503, 413 по квоте, ошибка
+    чтения), restore() возвращает файл и complete можно повторить, не
+    докачивая заново. Ошибки типа и размера — 400/413, сессия при этом удаляется.
+    """
+    file = IngestedFile("file", session.filename)
+    file.size = session.length
+    try:
+        file.path = await run_in_threadpool(_hold, session.id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=409, detail="Upload is already completed")
+
+    file.mimetype, file.digest = await run_in_threadpool(_inspect, file.path, with_digest)
+    if file.kind not in MAX_FILE_SIZES or file.extension is None:
+        file.status_code, file.error = 400, f"Invalid file type: {file.mimetype}"
+    elif file.size > MAX_FILE_SIZES[file.kind]:
+        file.status_code, file.error = 413, f"{file.kind.capitalize()} file is too large"
+    if file.error:
+        await file.discard()
+        await finish(db, session.id)
+        raise HTTPException(status_code=file.status_code, detail=file.error)
+    return file
+
+
+async def restore(upload_id):
+    """Возвращает файл сессии на место после неудачной обработки."""
+    try:
+        await run_in_threadpool(os.replace, held_path(upload_id), partial_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+async def finish(db: AsyncSession, upload_id):
+    """Удаляет сессию и её файл после обработки."""
+    await db.execute(delete(UploadSession).where(UploadSession.id == upload_id))
+    await db.commit()
+    try:
+        await run_in_threadpool(os.remove, held_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+def _remove_partial(names):
+    for name in names:
+        try:
+            os.remove(os.path.join(PARTIAL_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+async def terminate(db: AsyncSession, upload_id, user_id) -> bool:
+    result = await db.execute(delete(UploadSession)
+                              .where(UploadSession.id == upload_id, UploadSession.user_id == user_id)
+                              .returning(UploadSession.id))
+    deleted = result.scalar_one_or_none()
+    await db.commit()
+    if deleted is not None:
+        await run_in_threadpool(_remove_partial, [str(upload_id)])
+    return deleted is not None
+
+
+async def cleanup() -> int:
+    """Удаляет просроченные сессии и файлы, у которых сессии уже нет (пользователь удалён)."""
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(UploadSession).where(UploadSession.expires_at <= _now()))
+        await db.commit()
+        names = await run_in_threadpool(os.listdir, PARTIAL_DIR)
+        alive = set()
+        for start in range(0, len(names), 500):
+            ids = []
+            for name in names[start:start + 500]:
+                try:
+                    ids.append(uuid.UUID(name))
+                except ValueError:
+                    pass
+            result = await db.execute(select(UploadSession.id).where(UploadSession.id.in_(ids)))
+            alive.update(str(upload_id) for upload_id in result.scalars())
+    orphans = [name for name in names if name not in alive]
+    await run_in_threadpool(_remove_partial, orphans)
+    return len(orphans)
+
+
+class SessionReaper:
+    """Периодически вызывает cleanup(), как JobRunner — фоновая задача в lifespan."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.removed = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                self.removed += await cleanup()
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+
+reaper = SessionReaper(UPLOAD_SESSION_CLEANUP_INTERVAL)
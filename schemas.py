@@ -16,6 +16,18 @@ class UserOut(BaseModel):
         from_attributes = True
 
 
+class QuotaUpdate(BaseModel):
+    quota_bytes: int | None = Field(None, ge=0)
+    quota_files: int | None = Field(None, ge=0)
+
+
+class UsageOut(BaseModel):
+    used_bytes: int
+    used_files: int
+    quota_bytes: int | None = None  # None — без ограничения
+    quota_files: int | None = None
+
+
 # ---------- REQUESTS ----------
 
 class BlurRequest(BaseModel):
@@ -28,6 +40,32 @@ class DeleteFilesRequest(BaseModel):
 
 # ---------- RESPONSES ----------
 
+class MediaMetadata(BaseModel):
+    duration: float | None = None
+    width: int | None = None
+    height: int | None = None
+    video_codec: str | None = None
+    audio_codec: str | None = None
+    bitrate: int | None = None
+    frame_rate: float | None = None
+
+
+class MediaItem(BaseModel):
+    id: UUID
+    file: str
+    type: str
+    mimetype: str
+    url: str
+    urls: dict | None = None
+    metadata: MediaMetadata
+    created_at: datetime | None = None
+
+
+class MediaPage(BaseModel):
+    items: list[MediaItem]
+    next_cursor: str | None = None
+
+
 class ImageUrls(BaseModel):
     original: HttpUrl | None = None
     sizes: dict[str, HttpUrl]
@@ -36,20 +74,51 @@ class ImageUrls(BaseModel):
 class ImageUploadResponse(BaseModel):
     file: str
     type: str = "image"
+    metadata: MediaMetadata | None = None
     urls: dict[str, HttpUrl]
 
 
+class VideoUrls(BaseModel):
+    video: HttpUrl
+    preview: dict[str, HttpUrl]  # Постер по размерам
+    sprite: HttpUrl | None = None  # Лента миниатюр и её WebVTT-индекс
+    thumbnails: HttpUrl | None = None
+
+
 class VideoUploadResponse(BaseModel):
     file: str
     type: str = "video"
     duration: float
-    urls: dict[str, HttpUrl]
+    metadata: MediaMetadata | None = None
+    urls: VideoUrls
+
+
+class JobAcceptedResponse(BaseModel):
+    file: str
+    type: str = "video"
+    job_id: UUID
+    status: str
+
+
+class JobStatusResponse(BaseModel):
+    id: UUID
+    status: str
+    progress: int
+    attempts: int
+    error: str | None = None
+    result: VideoUploadResponse | None = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
 
 
 class AudioUploadResponse(BaseModel):
     file: str
     type: str = "audio"
     duration: float
+    metadata: MediaMetadata | None = None
     urls: dict[str, HttpUrl]
 
 
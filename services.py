@@ -1,82 +1,48 @@
+import functools
+import json
+import math
 import mimetypes
-import random
+import subprocess
 import uuid
 from urllib.parse import quote
 
-from moviepy import VideoFileClip
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageFilter, ImageOps, features
 import os
-import ffmpeg
 from fastapi import HTTPException
 
-from conf import UPLOAD_DIR, BASE_URL, LETTERS
+from metrics import stage, timed
+from conf import (
+    BASE_URL,
+    LETTERS,
+    MAX_FILE_SIZES,
+    MAX_IMAGE_PIXELS,
+    MAX_DECODE_PIXELS,
+    VARIANT_FORMATS,
+    ALTERNATE_FORMATS_EAGER,
+    FFMPEG_BINARY,
+    WORKER_TASK_TIMEOUT,
+    VIDEO_SPRITE_FRAMES,
+    VIDEO_SPRITE_COLUMNS,
+    VIDEO_SPRITE_WIDTH
+)
+import backends
+import storage
 
-import subprocess
-from mutagen.mp3 import MP3
-from mutagen.wave import WAVE
-
-
-BACKGROUND_COLORS = [
-    ((230, 230, 230), (0, 0, 0)),  # Светлый серый
-    ((220, 220, 220), (0, 0, 0)),  # Серый
-    ((200, 200, 200), (0, 0, 0)),  # Тёмно-серый
-    ((190, 190, 190), (0, 0, 0)),  # Стальной серый
-    ((180, 180, 180), (0, 0, 0)),  # Графитовый
-    ((160, 160, 160), (0, 0, 0)),  # Угольно-серый
-    ((140, 140, 140), (255, 255, 255)),  # Тёмно-серый (белый текст)
-    ((120, 120, 120), (255, 255, 255)),  # Антрацитовый
-    ((100, 100, 100), (255, 255, 255)),  # Чёрный жемчуг
-    ((80, 80, 80), (255, 255, 255)),  # Графитовый
-    ((60, 60, 60), (255, 255, 255)),  # Темно-угольный
-    ((40, 40, 40), (255, 255, 255)),  # Почти чёрный
-    ((255, 239, 213), (0, 0, 0)),  # Персиковый
-    ((255, 228, 196), (0, 0, 0)),  # Бежевый
-    ((255, 218, 185), (0, 0, 0)),  # Песочный
-    ((250, 235, 215), (0, 0, 0)),  # Античный белый
-    ((255, 182, 193), (0, 0, 0)),  # Розовый
-    ((255, 160, 122), (0, 0, 0)),  # Лососевый
-    ((233, 150, 122), (0, 0, 0)),  # Персиково-оранжевый
-    ((210, 180, 140), (0, 0, 0)),  # Светло-коричневый
-    ((244, 164, 96), (0, 0, 0)),  # Тёмно-персиковый
-    ((218, 165, 32), (0, 0, 0)),  # Золотистый
-    ((184, 134, 11), (255, 255, 255)),  # Тёмно-золотистый
-    ((189, 183, 107), (0, 0, 0)),  # Оливковый
-    ((143, 188, 143), (0, 0, 0)),  # Тёмно-зелёный
-    ((60, 179, 113), (0, 0, 0)),  # Средне-зелёный
-    ((46, 139, 87), (255, 255, 255)),  # Морской волны
-    ((102, 205, 170), (0, 0, 0)),  # Аквамариновый
-    ((175, 238, 238), (0, 0, 0)),  # Голубоватый
-    ((72, 209, 204), (0, 0, 0)),  # Бирюзовый
-    ((0, 255, 255), (0, 0, 0)),  # Ярко-голубой
-    ((70, 130, 180), (255, 255, 255)),  # Стальной синий
-    ((100, 149, 237), (255, 255, 255)),  # Голубой Корнфлауэр
-    ((30, 144, 255), (255, 255, 255)),  # Ярко-голубой
-    ((25, 25, 112), (255, 255, 255)),  # Тёмно-синий
-    ((123, 104, 238), (255, 255, 255)),  # Средний сланцевый синий
-    ((72, 61, 139), (255, 255, 255)),  # Тёмно-фиолетовый
-    ((255, 140, 0), (0, 0, 0)),  # Оранжевый
-    ((255, 165, 0), (0, 0, 0)),  # Тёмно-оранжевый
-    ((218, 112, 214), (0, 0, 0)),  # Орхидея
-    ((199, 21, 133), (255, 255, 255)),  # Розово-фиолетовый
-    ((255, 20, 147), (0, 0, 0)),  # Темно-розовый
-    ((176, 224, 230), (0, 0, 0)),  # Светло-голубой
-    ((173, 255, 47), (0, 0, 0)),  # Жёлто-зелёный
-    ((124, 252, 0), (0, 0, 0)),  # Ярко-зелёный
-    ((50, 205, 50), (0, 0, 0)),  # Лаймовый
-    ((0, 255, 127), (0, 0, 0)),  # Весенне-зелёный
-    ((47, 79, 79), (255, 255, 255)),  # Тёмный серо-зелёный
-    ((119, 136, 153), (255, 255, 255)),  # Синий серый
-]
 
+MEDIA_METADATA_FIELDS = ("duration", "width", "height", "video_codec", "audio_codec", "bitrate", "frame_rate")
+
+IMAGE_TOO_LARGE = "Image resolution is too large"
+# Pillow сам отказывается открывать изображения больше 2 * MAX_IMAGE_PIXELS
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
 
 
 def get_audio_duration(file_path: str) -> float:
     """Определяет длительность аудиофайла (MP3, WAV)."""
     try:
         if file_path.endswith(".mp3"):
-            audio = MP3(file_path)
+            audio = backends.get("mutagen.mp3").MP3(file_path)
         elif file_path.endswith(".wav"):
-            audio = WAVE(file_path)
+            audio = backends.get("mutagen.wave").WAVE(file_path)
         else:
             return 0.0  # Если формат не поддерживается
         return round(audio.info.length, 2)
@@ -87,129 +53,540 @@ def get_audio_duration(file_path: str) -> float:
 
 def get_video_duration(file_path: str) -> float:
     """Определяет длительность видеофайла"""
-    try:
-        clip = VideoFileClip(file_path)
-        duration = clip.duration
-        clip.close()
-        return duration
-    except Exception as e:
-        print(e)
+    duration = probe_media(file_path, "video")["duration"]
+    if duration is None:
         raise HTTPException(detail="При определении длительности видео произошла ошибка", status_code=500)
+    return duration
 
 
-def generate_image_from_string(string, size, bg: tuple = None):
-    if not string:
-        raise ValueError("String cannot be empty")
+def _parse_rate(rate: str | None) -> float | None:
+    """Переводит частоту кадров ffprobe вида '30000/1001' в число."""
+    if not rate or rate == "0/0":
+        return None
+    num, _, den = rate.partition("/")
+    return round(float(num) / float(den or 1), 3)
 
-    font = ImageFont.truetype("arial.ttf", size[0] / 2)
-    if not bg:
-        background, text_color = random.choice(BACKGROUND_COLORS)
-    else:
-        background, text_color = bg
-    image = Image.new("RGB", size, background)
-    draw = ImageDraw.Draw(image)
 
-    text = string[0].upper()
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
+def _rotation(stream: dict) -> int:
+    """Поворот видеопотока в градусах: тег rotate или матрица отображения."""
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        if rotation is None and "rotation" in side_data:
+            rotation = side_data["rotation"]
+    return abs(int(float(rotation or 0)))
+
 
-    text_x = (size[0] - text_width) // 2
-    text_y = (size[1] - text_height) // 2.5
+@timed("probe")
+def probe_media(file_path: str, mimetype: str = None) -> dict:
+    """Однократно читает метаданные файла: длительность, размеры, кодеки, битрейт, fps.
 
-    draw.text((text_x, text_y), text, font=font, fill=text_color)
+    Видео и аудио разбираются через ffprobe (без декодирования), изображения —
+    по заголовку через Pillow. Если прочитать не удалось, поля остаются None.
+    """
+    mimetype = mimetype or mimetypes.guess_type(file_path)[0] or ""
+    metadata = dict.fromkeys(MEDIA_METADATA_FIELDS)
+
+    try:
+        if mimetype.startswith("image"):
+            with Image.open(file_path) as img:  # Читается только заголовок
+                metadata["width"], metadata["height"] = img.size
+            return metadata
+
+        info = _ffprobe(file_path)
+        fmt = info.get("format", {})
+        if fmt.get("duration"):
+            metadata["duration"] = float(fmt["duration"])
+        if fmt.get("bit_rate"):
+            metadata["bitrate"] = int(fmt["bit_rate"])
+
+        for stream in info.get("streams", []):
+            if stream.get("codec_type") == "video" and metadata["video_codec"] is None:
+                if stream.get("disposition", {}).get("attached_pic"):
+                    continue  # Обложка внутри mp3/m4a — не видео
+                metadata["video_codec"] = stream.get("codec_name")
+                metadata["width"] = stream.get("width")
+                metadata["height"] = stream.get("height")
+                # Размеры кадра, как его показывают: ffmpeg поворачивает видео по метаданным
+                if _rotation(stream) % 180 == 90:
+                    metadata["width"], metadata["height"] = metadata["height"], metadata["width"]
+                metadata["frame_rate"] = _parse_rate(stream.get("avg_frame_rate"))
+                if metadata["duration"] is None and stream.get("duration"):
+                    metadata["duration"] = float(stream["duration"])
+            elif stream.get("codec_type") == "audio" and metadata["audio_codec"] is None:
+                metadata["audio_codec"] = stream.get("codec_name")
+    except Exception as e:
+        print(f"Ошибка чтения метаданных {file_path}: {e}")
+        if mimetype.startswith("audio"):
+            try:
+                metadata["duration"] = get_audio_duration(file_path)
+            except HTTPException:
+                pass
+
+    return metadata
 
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    image_path = os.path.join(UPLOAD_DIR, f"{text}_{size[0]}x{size[1]}.jpg")
-    image.save(image_path, format="JPEG")
 
-    return image_path
+def _ffprobe(file_path: str) -> dict:
+    """То же, что ffmpeg.probe, но с таймаутом: зависший ffprobe не держит процесс пула."""
+    result = subprocess.run(["ffprobe", "-show_format", "-show_streams", "-of", "json", file_path],
+                            capture_output=True, timeout=WORKER_TASK_TIMEOUT)
+    if result.returncode != 0:
+        raise backends.get("ffmpeg").Error("ffprobe", result.stdout, result.stderr)
+    return json.loads(result.stdout)
 
 
-def validate_file(file_path):
+def _run_ffmpeg(process) -> tuple[bytes, bytes]:
+    """Дожидается ffmpeg, запущенного run_async, не дольше WORKER_TASK_TIMEOUT.
+
+    Процесс пула, в котором зависла задача, убивается (workers.WorkerPool), а ffmpeg
+    при этом остался бы работать, поэтому таймаут нужен и здесь.
+    """
+    try:
+        out, err = process.communicate(timeout=WORKER_TASK_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    if process.returncode != 0:
+        raise backends.get("ffmpeg").Error("ffmpeg", out, err)
+    return out, err
+
+
+@timed("validate")
+def validate_file(file_path, metadata: dict = None):
     file_size = os.path.getsize(file_path)
     mimetype = mimetypes.guess_type(file_path)[0]
 
     if mimetype and mimetype.startswith("audio"):
-        if file_size > 100 * 1024 * 1024:
+        if file_size > MAX_FILE_SIZES["audio"]:
             return False, "Audio file size must not exceed 100MB"
 
     elif mimetype and mimetype.startswith("video"):
-        if file_size > 1024 * 1024 * 1024:
+        if file_size > MAX_FILE_SIZES["video"]:
             return False, "Video file size must not exceed 1GB"
 
-        try:
-            clip = VideoFileClip(file_path)
-            duration = clip.duration
-            clip.close()
-            if duration > 90:
-                return False, "Video duration must not exceed 1 minute 30 seconds"
-        except Exception as e:
-            print(e)
-            return False, f"Could not determine video duration {e}"
+        if metadata is None:
+            metadata = probe_media(file_path, mimetype)
+        duration = metadata["duration"]
+        if duration is None:
+            return False, "Could not determine video duration"
+        if duration > 90:
+            return False, "Video duration must not exceed 1 minute 30 seconds"
 
     elif mimetype and mimetype.startswith("image"):
-        if file_size > 50 * 1024 * 1024:
+        if file_size > MAX_FILE_SIZES["image"]:
             return False, "Image file size must not exceed 50MB"
+
+        # 50MB PNG может развернуться в гигабайты, поэтому разрешение проверяется по заголовку
+        try:
+            with Image.open(file_path) as img:
+                error = resolution_error(img)
+        except Image.DecompressionBombError:
+            error = IMAGE_TOO_LARGE
+        if error:
+            return False, error
     else:
         return False, "File is not an image, video or audio"
 
     return True, "Valid file"
 
 
-def resize_image(image_path: str, sizes: list[tuple], blur: list[int] = None):
-    paths = {}
-    new_path = None
-    with Image.open(image_path) as img:
-        for n, size in enumerate(sizes):
-            max_width, max_height = size
-            img_width, img_height = img.width, img.height
+def _reduced_decoding(img) -> bool:
+    """Декодер JPEG умеет сразу уменьшать в 2/4/8 раз (draft), не собирая полный растр.
+    Progressive JPEG всё равно держит в памяти коэффициенты всего изображения."""
+    return img.format == "JPEG" and not img.info.get("progressive")
 
-            if img_width < max_width and img_height < max_height:
-                paths[f"{LETTERS[n]}"] = new_path or image_path
-                continue
 
-            aspect_ratio = img.width / img.height
+def resolution_error(img) -> str | None:
+    """Проверка разрешения открытого изображения по заголовку, до декодирования."""
+    limit = MAX_IMAGE_PIXELS if _reduced_decoding(img) else MAX_DECODE_PIXELS
+    if img.width * img.height > limit:
+        return f"Image resolution must not exceed {limit // 1_000_000} megapixels"
+    return None
 
-            if img_width > img_height:
-                new_width = max_width
-                new_height = int(new_width / aspect_ratio)
-            else:
-                new_height = max_height
-                new_width = int(new_height * aspect_ratio)
 
-            img_resized = img.copy()
-            img_resized.thumbnail((new_width, new_height))
+def _prepare_decode(img, box: tuple = None):
+    """Включает уменьшенное декодирование JPEG не мельче box и проверяет, что растр,
+    который будет декодирован, укладывается в MAX_DECODE_PIXELS. Иначе 413 до
+    выделения памяти."""
+    error = resolution_error(img)
+    if error:
+        raise HTTPException(status_code=413, detail=error)
+    if box is not None:
+        img.draft("RGB", box)
+    if img.width * img.height > MAX_DECODE_PIXELS:
+        raise HTTPException(status_code=413, detail=IMAGE_TOO_LARGE)
+
+
+def _save_atomic(img, path: str, *args, **kwargs):
+    """Сохраняет изображение через временный файл, чтобы параллельная запись
+    одного и того же варианта (content-addressed режим) не портила файл."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        img.save(tmp_path, *args, **kwargs)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Настройки JPEG по длинной стороне варианта. Мелкие превью — без
+# прореживания цвета, на них оно заметнее всего. Средние — baseline с
+# оптимизированным Хаффманом: progressive на них в 2 раза дороже по CPU ради
+# 1-2% размера. Крупные — progressive, чтобы раньше появлялись на экране
+JPEG_PROFILES = [
+    (200, {"quality": 80, "optimize": True, "subsampling": "4:4:4"}),
+    (800, {"quality": 78, "optimize": True, "subsampling": "4:2:0"}),
+    (None, {"quality": 80, "progressive": True, "subsampling": "4:2:0"}),
+]
+
+
+def jpeg_options(size: tuple) -> dict:
+    longest = max(size)
+    for limit, options in JPEG_PROFILES:
+        if limit is None or longest <= limit:
+            return options
+
+
+# Форматы в порядке предпочтения при согласовании по Accept
+IMAGE_FORMATS = {
+    "avif": ("AVIF", "image/avif", {"quality": 55, "speed": 6}),
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+}
+_FAMILY_SUFFIXES = {"blurred": "blur", "preview": "preview", "avatar": "avatar", "sprite": "sprite"}
+
+
+@functools.cache
+def supported_formats() -> list[str]:
+    """Форматы из IMAGE_FORMATS, которые есть в этой сборке Pillow (AVIF — не в каждой).
+    Проверка загружает плагины Pillow, поэтому делается при первом вызове, а не при импорте."""
+    return [fmt for fmt in IMAGE_FORMATS if features.check(fmt)]
 
-            if blur and n < len(blur):  # Исправлено условие
-                img_resized = img_resized.filter(ImageFilter.GaussianBlur(radius=blur[n]))
-                new_path = os.path.join(
-                    os.path.dirname(image_path), f"{uuid.uuid4().hex}_{new_width}x{new_height}_blurred.jpg")
-            else:
-                new_path = os.path.join(os.path.dirname(image_path), f"{uuid.uuid4().hex}_{new_width}x{new_height}.jpg")
 
-            img_resized.save(new_path, "JPEG")
-            paths[f"{LETTERS[n]}"] = get_file_url(new_path)
+def variant_family(name: str) -> str:
+    """Семейство варианта по имени файла: photo, avatar, blur, preview или sprite."""
+    parts = os.path.splitext(name)[0].split("_")
+    for part in reversed(parts[1:]):
+        if part in _FAMILY_SUFFIXES:
+            return _FAMILY_SUFFIXES[part]
+    if len(parts[0]) not in (32, 64):  # Буквенные аватары avatars.py
+        return "avatar"
+    return "photo"
 
-    os.remove(image_path)  # Удаляем оригинал
+
+def alternate_formats(name: str) -> list[str]:
+    """Дополнительные форматы, включённые для семейства JPEG-варианта."""
+    if not name.endswith(".jpg"):
+        return []
+    return [fmt for fmt in supported_formats() if fmt in VARIANT_FORMATS.get(variant_family(name), ())]
+
+
+def alternate_name(name: str, fmt: str) -> str:
+    return f"{os.path.splitext(name)[0]}.{fmt}"
+
+
+def with_alternates(names) -> list[str]:
+    """Имена вместе со всеми возможными альтернативными форматами, для удаления."""
+    return [alt for name in names
+            for alt in [name, *(alternate_name(name, fmt) for fmt in IMAGE_FORMATS if name.endswith(".jpg"))]]
+
+
+def _save_image(img, path: str, fmt: str, **jpeg_kwargs):
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    with stage(f"encode.{fmt}"):
+        if fmt == "jpeg":
+            _save_atomic(img, path, "JPEG", **(jpeg_kwargs or jpeg_options(img.size)))
+        else:
+            format_name, _, options = IMAGE_FORMATS[fmt]
+            _save_atomic(img, path, format_name, **options)
+
+
+def save_variant(img, path: str, **jpeg_kwargs):
+    """Пишет JPEG-вариант и, в режиме ALTERNATE_FORMATS_EAGER, его webp/avif рядом."""
+    _save_image(img, path, "jpeg", **jpeg_kwargs)
+    if ALTERNATE_FORMATS_EAGER:
+        _save_alternates(img, os.path.basename(path))
+
+
+def _save_alternates(img, name: str):
+    for fmt in alternate_formats(name):
+        _save_image(img, storage.path_for(alternate_name(name, fmt)), fmt)
+
+
+def encode_alternate(source_path: str, target_path: str, fmt: str) -> str:
+    """Перекодирует готовый JPEG-вариант в fmt для ленивой отдачи."""
+    with Image.open(source_path) as img:
+        _prepare_decode(img)
+        _save_image(img, target_path, fmt)
+    return target_path
+
+
+def _variant_box(width: int, height: int, size: tuple) -> tuple[int, int]:
+    """Рамка варианта, по ней же назван файл: длинная сторона изображения
+    приводится к стороне size, вторая — по пропорциям."""
+    max_width, max_height = size
+    aspect_ratio = width / height
+    if width > height:
+        return max_width, int(max_width / aspect_ratio)
+    return int(max_height * aspect_ratio), max_height
+
+
+def _fit_size(width: int, height: int, box: tuple) -> tuple[int, int]:
+    """Итоговый размер варианта, с тем же округлением, что у Image.thumbnail."""
+    x, y = box
+    if x >= width and y >= height:
+        return width, height
+    aspect = width / height
+    if x / y >= aspect:
+        x = max(min(math.floor(y * aspect), math.ceil(y * aspect), key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        y = max(min(math.floor(x / aspect), math.ceil(x / aspect),
+                    key=lambda n: 0 if n == 0 else abs(aspect - x / n)), 1)
+    return x, y
+
+
+def _variant_boxes(width: int, height: int, sizes: list[tuple]) -> list[tuple | None]:
+    """Рамки вариантов по sizes; None — изображение меньше рамки, не увеличиваем.
+    Если изображение меньше всех рамок, первая — его собственный размер."""
+    boxes = []
+    for size in sizes:
+        if width < size[0] and height < size[1]:
+            boxes.append(None)
+        else:
+            boxes.append(_variant_box(width, height, size))
+    if all(box is None for box in boxes):
+        boxes[0] = (width, height)
+    return boxes
+
+
+def _size_urls(urls: dict, count: int) -> dict:
+    """Ссылки по буквам размеров; размеры, до которых изображение не дотягивает,
+    получают ближайший меньший вариант."""
+    paths = {}
+    last_url = None
+    for n in range(count):
+        last_url = urls.get(n, last_url)
+        paths[f"{LETTERS[n]}"] = last_url
     return paths
 
 
-def generate_video_preview(video_path: str):
-    preview_path = f"{os.path.splitext(video_path)[0]}_preview.jpg"
+def resize_image(image_path: str, sizes: list[tuple], blur: list[int] = None,
+                 stem: str = None, remove_source: bool = False, family: str = "photo"):
+    """Создаёт варианты изображения под sizes.
+
+    stem задаёт детерминированное имя вариантов (digest в content-addressed
+    режиме), по умолчанию каждый вариант получает случайный uuid. family
+    (avatar, preview) добавляется суффиксом к имени, по нему выбираются
+    дополнительные форматы (VARIANT_FORMATS); размытые копии аватара
+    остаются в семействе avatar.
+
+    JPEG декодируется сразу в уменьшенном виде (draft), если самый крупный
+    вариант намного меньше исходника, поэтому полный растр снимка на 100+
+    мегапикселей в памяти не собирается; остальные форматы декодируются целиком
+    и ограничены MAX_DECODE_PIXELS. Каждый следующий вариант строится из
+    предыдущего, большего, а не из оригинала. Если изображение меньше рамки,
+    отдаётся ближайший меньший вариант, а для совсем маленьких — копия в
+    исходном размере. Исходник остаётся на диске (на него указывает
+    MediaFile.url); remove_source — для промежуточных файлов вроде кадра превью.
+    """
+    with Image.open(image_path) as img:
+        width, height = img.size
+
+        boxes = _variant_boxes(width, height, sizes)
+        targets = {box: _fit_size(width, height, box) for box in boxes if box is not None}
+        largest = max(targets.values(), key=lambda dims: dims[0] * dims[1])
+        # Декодер JPEG уменьшает в 2/4/8 раз, не опускаясь ниже самого крупного варианта
+        with stage("resize.decode"):
+            _prepare_decode(img, largest)
+            current = img if img.mode == "RGB" else img.convert("RGB")
+            current.load()
+
+        urls = {}
+        # От большего к меньшему: каждый вариант ресемплится из предыдущего
+        order = sorted((n for n, box in enumerate(boxes) if box is not None),
+                       key=lambda n: targets[boxes[n]][0] * targets[boxes[n]][1], reverse=True)
+        for n in order:
+            box = boxes[n]
+            dims = targets[box]
+            if current.size != dims:
+                with stage("resize.resample"):
+                    current = current.resize(dims, Image.BICUBIC, reducing_gap=2.0)
+
+            suffix = "" if family == "photo" else f"_{family}"
+            if blur and n < len(blur):  # Исправлено условие
+                output = current.filter(ImageFilter.GaussianBlur(radius=blur[n]))
+                new_path = storage.path_for(f"{stem or uuid.uuid4().hex}_{box[0]}x{box[1]}_blurred{suffix}.jpg")
+            else:
+                output = current
+                new_path = storage.path_for(f"{stem or uuid.uuid4().hex}_{box[0]}x{box[1]}{suffix}.jpg")
+
+            save_variant(output, new_path)
+            urls[n] = get_file_url(new_path)
+
+    if remove_source:
+        os.remove(image_path)
+    return _size_urls(urls, len(sizes))
+
+
+def render_variant(source_path: str, target_path: str, size: tuple, fit: str = "contain",
+                   fmt: str = "jpeg") -> str:
+    """Рендерит один вариант для ленивой отдачи (/files/{name}?w=&h=&fit=).
+
+    contain — вписать в size с сохранением пропорций, cover — заполнить
+    size целиком с обрезкой краёв. Меньшие изображения не увеличиваются.
+    """
+    with Image.open(source_path) as img:
+        # До поворота по EXIF, который декодирует изображение; рамка квадратная — стороны могут поменяться
+        _prepare_decode(img, (max(size), max(size)))
+        with stage("variant.resize"):
+            img = ImageOps.exif_transpose(img)
+            if fit == "cover":
+                if img.width > size[0] or img.height > size[1]:
+                    img = ImageOps.fit(img, (min(size[0], img.width), min(size[1], img.height)))
+            else:
+                img.thumbnail(size)
+        _save_image(img, target_path, fmt)
+    return target_path
+
+
+def variant_urls(file_path: str, sizes: list[tuple]) -> dict:
+    """Ссылки на ленивые варианты файла в формате ответа resize_image."""
+    url = get_file_url(file_path)
+    return {f"{LETTERS[n]}": f"{url}?w={width}&h={height}" for n, (width, height) in enumerate(sizes)}
+
+
+def _even(value: float) -> int:
+    """Чётный размер кадра не меньше 2: так его примет любой кодировщик."""
+    return max(2, round(value / 2) * 2)
+
+
+def _vtt_time(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def _frame(ffmpeg, video_path: str, position: float, keyframe: bool = False):
+    """Один кадр с позиции position: -ss перед -i переходит к ключевому кадру перед ней и
+    декодирует только до неё, -t не даёт читать видео дальше.
+
+    keyframe=True — берётся сам ключевой кадр, без декодирования до position (миниатюры
+    спрайта: точность в пределах GOP не видна, а декодирования в разы меньше). Такой
+    вход декодируется в один поток: входов VIDEO_SPRITE_FRAMES, и с потоками по числу
+    ядер на каждом ffmpeg упирается в WORKER_MEMORY_LIMIT, унаследованный от процесса пула."""
+    if not keyframe:
+        return ffmpeg.input(video_path, ss=round(position, 3), t=1)["v"].trim(end_frame=1)
+    stream = ffmpeg.input(video_path, ss=round(position, 3), t=1, noaccurate_seek=None, skip_frame="nokey",
+                          threads=1)
+    return stream["v"].trim(end_frame=1).setpts("PTS-STARTPTS")
+
+
+def _jpeg_output(ffmpeg, stream, path: str, quality: int, written: list):
+    """Кадр пишется во временный файл и переносится на место после ffmpeg, как в _save_atomic."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    written.append((tmp_path, path))
+    return ffmpeg.output(stream, tmp_path, format="image2", vcodec="mjpeg", frames=1, **{"q:v": quality})
+
+
+def _write_vtt(path: str, sprite_url: str, duration: float, frames: int, columns: int, tile: tuple):
+    """Индекс WebVTT ленты: отрезок видео -> область листа (#xywh), как ждут плееры."""
+    step = duration / frames
+    cues = ["WEBVTT", ""]
+    for n in range(frames):
+        x, y = n % columns * tile[0], n // columns * tile[1]
+        cues += [f"{_vtt_time(n * step)} --> {_vtt_time(min((n + 1) * step, duration))}",
+                 f"{sprite_url}#xywh={x},{y},{tile[0]},{tile[1]}", ""]
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as vtt_file:
+        vtt_file.write("\n".join(cues))
+    os.replace(tmp_path, path)
+
+
+@timed("preview.extract")
+def generate_video_preview(video_path: str, metadata: dict = None, sizes: list[tuple] = None,
+                           stem: str = None) -> dict:
+    """Постер и лента миниатюр для перемотки за один запуск ffmpeg.
+
+    Каждый кадр — отдельный вход с переходом к нужной позиции, поэтому видео
+    не декодируется целиком. Постер — кадр из середины, в sizes (имена и
+    округление как у resize_image) или, без sizes, в исходном размере в
+    <stem>_preview.jpg — исходник ленивых вариантов. Лента —
+    VIDEO_SPRITE_FRAMES кадров, равномерно по длительности, одним листом
+    <stem>_sprite.jpg и индекс WebVTT <stem>_sprite.vtt к нему.
+
+    Возвращает {"preview": ссылки по размерам или путь постера,
+    "sprite": ссылка на лист, "thumbnails": ссылка на индекс}; без ленты
+    двух последних нет.
+    """
+    stem = stem or os.path.splitext(os.path.basename(video_path))[0]
+    if not (metadata and metadata["duration"] and metadata["width"] and metadata["height"]):
+        metadata = probe_media(video_path, "video")
+    duration, width, height = metadata["duration"], metadata["width"], metadata["height"]
+    if not (duration and width and height):
+        raise HTTPException(status_code=500, detail="Error creating video preview: could not read video metadata")
+
+    ffmpeg = backends.get("ffmpeg")
+    outputs, written = [], []
+    result = {}
+    poster = _frame(ffmpeg, video_path, duration / 2)
+    if sizes:
+        boxes = _variant_boxes(width, height, sizes)
+        targets = {box: _fit_size(width, height, box) for box in boxes if box is not None}
+        split = poster.split()
+        names = {}
+        for n, (box, dims) in enumerate(targets.items()):
+            names[box] = f"{stem}_{box[0]}x{box[1]}_preview.jpg"
+            outputs.append(_jpeg_output(ffmpeg, split[n].filter("scale", *dims), storage.path_for(names[box]),
+                                        3, written))
+        result["preview"] = _size_urls({n: get_file_url(storage.path_for(names[box]))
+                                        for n, box in enumerate(boxes) if box is not None}, len(sizes))
+    else:
+        result["preview"] = storage.path_for(f"{stem}_preview.jpg")
+        outputs.append(_jpeg_output(ffmpeg, poster, result["preview"], 2, written))
+
+    frames = VIDEO_SPRITE_FRAMES
+    if frames > 0:
+        tile = (_even(VIDEO_SPRITE_WIDTH), _even(VIDEO_SPRITE_WIDTH * height / width))
+        columns = min(VIDEO_SPRITE_COLUMNS, frames)
+        tiles = [_frame(ffmpeg, video_path, duration * (n + 0.5) / frames, keyframe=True).filter("scale", *tile)
+                 .filter("setsar", 1) for n in range(frames)]
+        sprite = ffmpeg.concat(*tiles, v=1, a=0).filter("tile", f"{columns}x{math.ceil(frames / columns)}")
+        sprite_path = storage.path_for(f"{stem}_sprite.jpg")
+        outputs.append(_jpeg_output(ffmpeg, sprite, sprite_path, 5, written))
+
     try:
-        clip = VideoFileClip(video_path)
-        frame = clip.get_frame(clip.duration / 2)  # Берём кадр из середины видео
-        img = Image.fromarray(frame)
-        img.thumbnail(clip.size)  # Сжимаем превью
-        img.save(preview_path, format="JPEG", quality=50, optimize=True)
-        clip.close()
-        return preview_path
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error creating video preview: {str(e)}")
+        with stage("preview.ffmpeg"):
+            _run_ffmpeg(ffmpeg.merge_outputs(*outputs).global_args("-loglevel", "error").overwrite_output()
+                        .run_async(cmd=FFMPEG_BINARY, pipe_stdout=True, pipe_stderr=True))
+        for tmp_path, path in written:
+            os.replace(tmp_path, path)
+    except subprocess.TimeoutExpired:
+        raise HTTPException(status_code=504, detail="Processing timed out")
+    except (ffmpeg.Error, OSError) as e:
+        stderr = getattr(e, "stderr", None)
+        detail = stderr.decode(errors="replace").strip() if stderr else str(e)
+        raise HTTPException(status_code=500, detail=f"Error creating video preview: {detail}")
+    finally:
+        for tmp_path, _ in written:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if frames > 0:
+        result["sprite"] = get_file_url(sprite_path)
+        vtt_path = storage.path_for(f"{stem}_sprite.vtt")
+        _write_vtt(vtt_path, result["sprite"], duration, frames, columns, tile)
+        result["thumbnails"] = get_file_url(vtt_path)
+
+    if ALTERNATE_FORMATS_EAGER and sizes:
+        for _, path in written:
+            with Image.open(path) as img:
+                _save_alternates(img, os.path.basename(path))
+    return result
 
 
 def get_file_url(file_path: str) -> str:
-    """Приводит путь к файлу в корректный URL-формат."""
-    relative_path = os.path.relpath(file_path, UPLOAD_DIR).replace("\\", "/")
-    return f"{BASE_URL}/{quote(relative_path)}"
+    """Приводит путь к файлу в корректный URL-формат.
+
+    Каталог шарда в URL не попадает: ссылка всегда BASE_URL/<имя файла>.
+    """
+    return f"{BASE_URL}/{quote(os.path.basename(file_path))}"
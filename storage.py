@@ -0,0 +1,96 @@
+import hashlib
+import os
+
+from conf import UPLOAD_DIR, STORAGE_LEGACY_LOOKUP
+
+
+def is_valid_name(name: str) -> bool:
+    """Имя файла без каталогов; скрытые служебные каталоги (.tmp и т.п.) недоступны."""
+    return bool(name) and name == os.path.basename(name) and not name.startswith(".")
+
+
+def stem(name: str) -> str:
+    """Общая часть имени загрузки и всех её производных файлов.
+
+    Производные файлы называются <stem>_<суффикс>.jpg (варианты размеров,
+    превью видео), поэтому по любой ссылке из ответа /upload/file можно
+    найти исходную загрузку.
+    """
+    return name.split(".", 1)[0].split("_", 1)[0]
+
+
+def shard_dir(name: str) -> str:
+    """Каталог файла в раскладке ab/cd/<name>, где abcd — начало md5 от имени.
+
+    Хэш берётся от имени, а не от содержимого, поэтому путь вычисляется
+    из URL без обращения к БД, а имена с общим префиксом (A_100x100.jpg,
+    варианты одного uuid) всё равно расходятся по разным каталогам.
+    """
+    digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+    return os.path.join(UPLOAD_DIR, digest[:2], digest[2:4])
+
+
+def path_for(name: str) -> str:
+    """Путь для записи нового файла; каталог шарда создаётся при необходимости."""
+    directory = shard_dir(name)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def legacy_path(name: str) -> str:
+    return os.path.join(UPLOAD_DIR, name)
+
+
+def resolve(name: str) -> str | None:
+    """Путь к существующему файлу или None.
+
+    Пока migrate_storage.py не перенёс старую плоскую раскладку, файл ищется
+    и в корне UPLOAD_DIR. Повторная проверка шарда закрывает гонку, когда
+    файл переносится между двумя проверками.
+    """
+    if not is_valid_name(name):
+        return None
+    sharded = os.path.join(shard_dir(name), name)
+    if os.path.isfile(sharded):
+        return sharded
+    if STORAGE_LEGACY_LOOKUP:
+        flat = legacy_path(name)
+        if os.path.isfile(flat):
+            return flat
+        if os.path.isfile(sharded):
+            return sharded
+    return None
+
+
+def remove(name: str) -> bool:
+    """Удаляет файл в любой из раскладок. Возвращает True, если что-то удалено."""
+    if not is_valid_name(name):
+        return False
+    removed = False
+    paths = [os.path.join(shard_dir(name), name)]
+    if STORAGE_LEGACY_LOOKUP:
+        paths.append(legacy_path(name))
+    for path in paths:
+        try:
+            os.remove(path)
+            removed = True
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def remove_many(names) -> int:
+    """Удаляет пачку файлов, вызывать вне event loop. Возвращает число удалённых."""
+    return sum(remove(name) for name in names)
+
+
+def total_size(names) -> int:
+    """Сколько байт занимают существующие из names, вызывать вне event loop."""
+    total = 0
+    for name in names:
+        path = resolve(name)
+        try:
+            total += os.path.getsize(path) if path else 0
+        except FileNotFoundError:
+            pass
+    return total
@@ -0,0 +1,220 @@
+"""Сборщик мусора хранилища: удаляет файлы UPLOAD_DIR, на которые нет записей в БД.
+
+Файл нужен, если его имя есть в media_files.filename или
+media_variants.filename либо его stem — digest из content_blobs
+(content-addressed режим). webp/avif проверяются по JPEG с тем же именем.
+Не трогаются файлы моложе GC_GRACE_PERIOD (обработка ещё пишет варианты),
+аватары (в БД не записываются) и служебные каталоги, кроме .tmp, где
+удаляются брошенные недокачанные загрузки.
+
+Обход инкрементальный: по одному каталогу шарда, имена проверяются в БД
+пачками по GC_BATCH, удаления ограничены GC_MAX_DELETES_PER_SECOND, между
+каталогами пауза GC_PAUSE, чтобы не отбирать диск у живых запросов.
+Варианты, записанные до миграции 006 мимо media_files.files, тоже будут
+удалены — сначала стоит посмотреть на --dry-run.
+
+    python storage_gc.py --dry-run
+    python storage_gc.py --max-deletes-per-second 20 --grace-period 86400
+"""
+import argparse
+import asyncio
+import os
+import time
+import traceback
+
+from sqlalchemy import select
+
+from conf import (
+    UPLOAD_DIR,
+    TMP_DIR,
+    GC_GRACE_PERIOD,
+    GC_MAX_DELETES_PER_SECOND,
+    GC_PAUSE,
+    GC_BATCH,
+    GC_INTERVAL
+)
+import metrics
+import storage
+from database import AsyncSessionLocal, engine
+from models import MediaFile, MediaVariant, ContentBlob
+from services import variant_family, IMAGE_FORMATS
+
+
+def _subdirs(path: str) -> list[str]:
+    """Подкаталоги без служебных (.tmp, .cache)."""
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entry.path for entry in entries
+                          if entry.is_dir(follow_symlinks=False) and storage.is_valid_name(entry.name))
+    except FileNotFoundError:
+        return []
+
+
+def _directories() -> list[str]:
+    """Корень UPLOAD_DIR (старая плоская раскладка) и каталоги шардов ab/cd."""
+    return [UPLOAD_DIR, *(directory for first in _subdirs(UPLOAD_DIR) for directory in _subdirs(first))]
+
+
+def _old_files(directory: str, older_than: float) -> list[str]:
+    names = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False) or not storage.is_valid_name(entry.name):
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime <= older_than:
+                        names.append(entry.name)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return names
+
+
+def _remove(path: str, older_than: float) -> int | None:
+    """Удаляет файл, если его не перезаписали после проверки. Возвращает освобождённые байты."""
+    try:
+        stat = os.stat(path)
+        if stat.st_mtime > older_than:
+            return None
+        os.remove(path)
+        return stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+def _record_name(name: str) -> str:
+    """Имя, под которым файл записан в БД: альтернативный формат — по своему JPEG."""
+    base, extension = os.path.splitext(name)
+    return f"{base}.jpg" if extension[1:] in IMAGE_FORMATS else name
+
+
+async def _referenced(names: list[str]) -> set[str]:
+    """Имена из names, на которые есть записи в БД."""
+    keys = list({*names, *map(_record_name, names)})
+    stems = list({storage.stem(name) for name in names})
+    async with AsyncSessionLocal() as db:
+        known = set((await db.execute(select(MediaFile.filename).where(MediaFile.filename.in_(keys)))).scalars())
+        known.update((await db.execute(
+            select(MediaVariant.filename).where(MediaVariant.filename.in_(keys))
+        )).scalars())
+        digests = set((await db.execute(select(ContentBlob.digest).where(ContentBlob.digest.in_(stems)))).scalars())
+    return {name for name in names
+            if name in known or _record_name(name) in known or storage.stem(name) in digests}
+
+
+class StorageCollector:
+    """Периодический обход UPLOAD_DIR в фоне (GC_ENABLED) или один проход из CLI."""
+
+    def __init__(self, grace_period: float, max_deletes_per_second: float, pause: float, batch: int,
+                 interval: float, dry_run: bool = False):
+        self.grace_period = grace_period
+        self.max_deletes_per_second = max_deletes_per_second
+        self.pause = pause
+        self.batch = batch
+        self.interval = interval
+        self.dry_run = dry_run
+        self.runs = 0
+        self.scanned = 0
+        self.removed = 0
+        self.freed_bytes = 0
+        self.last_run = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "scanned": self.scanned, "removed": self.removed,
+                "freed_bytes": self.freed_bytes, "last_run": self.last_run}
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.interval)
+
+    async def collect(self) -> int:
+        """Один проход по хранилищу. Возвращает число удалённых (в dry_run — найденных) файлов."""
+        older_than = time.time() - self.grace_period
+        removed = 0
+        for directory in await asyncio.to_thread(_directories):
+            names = await asyncio.to_thread(_old_files, directory, older_than)
+            for start in range(0, len(names), self.batch):
+                chunk = [name for name in names[start:start + self.batch] if variant_family(name) != "avatar"]
+                self.scanned += len(chunk)
+                if not chunk:
+                    continue
+                referenced = await _referenced(chunk)
+                for name in chunk:
+                    if name not in referenced:
+                        removed += await self._reclaim(os.path.join(directory, name), older_than)
+            await asyncio.sleep(self.pause)
+
+        # Недокачанные загрузки ingest.py удаляет сам, здесь остаются только брошенные при падении
+        for name in await asyncio.to_thread(_old_files, TMP_DIR, older_than):
+            removed += await self._reclaim(os.path.join(TMP_DIR, name), older_than)
+
+        self.runs += 1
+        self.last_run = time.time()
+        return removed
+
+    async def _reclaim(self, path: str, older_than: float) -> int:
+        if self.dry_run:
+            print(path)
+            return 1
+        freed = await asyncio.to_thread(_remove, path, older_than)
+        if freed is not None:
+            self.removed += 1
+            self.freed_bytes += freed
+        if self.max_deletes_per_second > 0:
+            await asyncio.sleep(1 / self.max_deletes_per_second)
+        return 0 if freed is None else 1
+
+
+collector = StorageCollector(GC_GRACE_PERIOD, GC_MAX_DELETES_PER_SECOND, GC_PAUSE, GC_BATCH, GC_INTERVAL)
+metrics.Collected("media_gc_removed_files_total", "Orphan files removed by storage GC", (),
+                  lambda: collector.removed, type="counter")
+metrics.Collected("media_gc_freed_bytes_total", "Bytes freed by storage GC", (),
+                  lambda: collector.freed_bytes, type="counter")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grace-period", type=float, default=GC_GRACE_PERIOD,
+                        help="не трогать файлы моложе, секунды")
+    parser.add_argument("--max-deletes-per-second", type=float, default=GC_MAX_DELETES_PER_SECOND,
+                        help="0 — без ограничения")
+    parser.add_argument("--pause", type=float, default=GC_PAUSE, help="пауза между каталогами, секунды")
+    parser.add_argument("--batch", type=int, default=GC_BATCH, help="имён в одном запросе к БД")
+    parser.add_argument("--dry-run", action="store_true", help="только вывести лишние файлы")
+    args = parser.parse_args()
+
+    gc = StorageCollector(args.grace_period, args.max_deletes_per_second, args.pause, args.batch,
+                          GC_INTERVAL, dry_run=args.dry_run)
+
+    async def run():
+        try:
+            return await gc.collect()
+        finally:
+            await engine.dispose()
+
+    found = asyncio.run(run())
+    if args.dry_run:
+        print(f"Готово, лишних файлов: {found} (проверено {gc.scanned})")
+    else:
+        print(f"Готово, удалено файлов: {gc.removed}, освобождено {gc.freed_bytes / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
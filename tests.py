@@ -1,10 +1,35 @@
+import asyncio
+import hashlib
+import io
+import json
 import os
-from urllib.parse import quote
+import shutil
+import struct
+import subprocess
+import sys
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, urlparse
 
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-
-from conf import SERVER_ID, AVATAR_SIZES_STRINGS, UPLOAD_DIR, BASE_URL, LETTERS, SECRET
+from PIL import Image
+from sqlalchemy import select
+
+import admission
+import quotas
+import storage
+from conf import (SERVER_ID, AVATAR_SIZES_STRINGS, BASE_URL, LETTERS, SECRET, MAX_DECODE_PIXELS, FFMPEG_BINARY,
+                  VIDEO_SPRITE_FRAMES, VIDEO_SPRITE_COLUMNS, VIDEO_SPRITE_WIDTH, WORKER_START_METHOD)
+from database import AsyncSessionLocal
+from jobs import runner
+from models import MediaFile, ProcessingJob
+from services import supported_formats
+from storage_gc import StorageCollector
+from workers import WorkerPool
 from main import app  # Импортируем FastAPI-приложение
 
 TEST_FILES_DIR = "test_files"
@@ -19,12 +44,11 @@ def uploaded_files():
     yield files
     # Удаляем только файлы, загруженные во время теста
     for file_url in files:
-        file_path = os.path.join(UPLOADS_DIR, os.path.basename(file_url))
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"Ошибка при удалении {file_path}: {e}")
+        filename = os.path.basename(file_url)
+        try:
+            storage.remove(filename)
+        except Exception as e:
+            print(f"Ошибка при удалении {filename}: {e}")
 
 @pytest.mark.parametrize("filename, mime_type, expected_type", [
     ("image.jpg", "image/jpeg", "image"),
@@ -54,6 +78,301 @@ def test_upload_files(filename, mime_type, expected_type, uploaded_files):
             uploaded_files.append(url)
 
 
+def test_upload_video_async(uploaded_files):
+    """Тестируем фоновую обработку видео: 202 с job_id и статус задачи"""
+    file_path = os.path.join(TEST_FILES_DIR, "video.mp4")
+    assert os.path.exists(file_path), "Файл video.mp4 отсутствует в test_files"
+
+    with open(file_path, "rb") as file:
+        files = {"file": ("video.mp4", file, "video/mp4")}
+        response = client.post("/upload/file?async=true", files=files, headers={"SECRET": SECRET})
+
+    assert response.status_code == 202
+    data = response.json()
+    assert data[0]["type"] == "video"
+    assert data[0]["status"] == "queued"
+
+    response = client.get(f"/jobs/{data[0]['job_id']}", headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    job = response.json()
+    assert job["status"] in ("queued", "running", "done")
+    assert 0 <= job["progress"] <= 100
+
+    # Без lifespan фоновых воркеров нет: забираем и выполняем задачи сами
+    async def run_jobs():
+        while (claimed := await runner._claim()) is not None:
+            await runner._run(*claimed)
+
+    asyncio.run(run_jobs())
+    response = client.get(f"/jobs/{data[0]['job_id']}", headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    job = response.json()
+    assert job["status"] == "done" and job["progress"] == 100
+    urls = job["result"]["urls"]
+    uploaded_files.append(urls["video"])
+    uploaded_files.extend(urls["preview"].values())
+    assert set(urls["preview"]) == set(LETTERS)
+
+
+def test_stale_job_attempts_exhausted(uploaded_files):
+    """Тестируем, что зависшая задача без оставшихся попыток помечается failed, а не перезапускается"""
+    buffer = io.BytesIO()
+    Image.effect_noise((320, 240), 60).convert("RGB").save(buffer, "JPEG")
+    response = client.post("/upload/file", files={"file": ("job.jpg", buffer.getvalue(), "image/jpeg")},
+                           headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    urls = list(response.json()[0]["urls"].values())
+    uploaded_files.extend(urls)
+    stem = storage.stem(os.path.basename(urls[0]))
+
+    async def claim_stale():
+        async with AsyncSessionLocal() as db:
+            media = (await db.execute(select(MediaFile).where(MediaFile.stem == stem))).scalar_one()
+            # Процесс умер на последней попытке: задача так и осталась running
+            job = ProcessingJob(media_id=media.id, user_id=media.user_id, status="running", attempts=3,
+                                max_attempts=3, updated_at=datetime.now(timezone.utc) - timedelta(days=1))
+            db.add(job)
+            await db.commit()
+        while (claimed := await runner._claim()) is not None:
+            await runner._run(*claimed)
+        async with AsyncSessionLocal() as db:
+            return await db.get(ProcessingJob, job.id)
+
+    job = asyncio.run(claim_stale())
+    assert job.status == "failed"
+    assert job.attempts == 3
+
+
+def test_user_key_revoked():
+    """Тестируем, что удалённый ключ сразу перестаёт работать, несмотря на кэш, а его файлы удаляются"""
+    api_key = f"test-{uuid.uuid4()}"
+    missing_job = f"/jobs/{uuid.uuid4()}"
+
+    assert client.get(missing_job, headers={"SECRET": api_key}).status_code == 403
+    response = client.post("/users", json={"api_key": api_key})
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+
+    # Ключ был в кэше неверных ключей, но создание пользователя его сбросило
+    assert client.get(missing_job, headers={"SECRET": api_key}).status_code == 404
+    assert client.get(missing_job, headers={"SECRET": api_key}).status_code == 404
+
+    buffer = io.BytesIO()
+    Image.effect_noise((320, 240), 60).convert("RGB").save(buffer, "JPEG")
+    response = client.post("/upload/file", files={"file": ("revoked.jpg", buffer.getvalue(), "image/jpeg")},
+                           headers={"SECRET": api_key})
+    assert response.status_code == 200
+    names = [os.path.basename(url) for url in response.json()[0]["urls"].values()]
+
+    response = client.delete(f"/users/{user_id}", headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    assert client.get(missing_job, headers={"SECRET": api_key}).status_code == 403
+    # Загрузки удаляются вместе с пользователем, ссылки на содержимое отпускаются
+    for name in names:
+        assert storage.resolve(name) is None, f"Файл {name} не был удалён"
+
+
+def test_resumable_upload(uploaded_files, monkeypatch):
+    """Тестируем возобновляемую загрузку: куски PATCH, смещение в HEAD, завершение как /upload/file"""
+    buffer = io.BytesIO()
+    Image.effect_noise((800, 600), 60).convert("RGB").save(buffer, "JPEG")
+    data = buffer.getvalue()
+    headers = {"SECRET": SECRET, "Tus-Resumable": "1.0.0"}
+
+    response = client.post("/uploads", headers={**headers, "Upload-Length": str(len(data)),
+                                                "Upload-Metadata": "filename cmVzdW1lLmpwZw=="})
+    assert response.status_code == 201
+    location = urlparse(response.headers["Location"]).path
+    chunk = {**headers, "Content-Type": "application/offset+octet-stream"}
+
+    response = client.patch(location, content=data[:4096], headers={**chunk, "Upload-Offset": "0"})
+    assert response.status_code == 204
+    assert response.headers["Upload-Offset"] == "4096"
+    # Кусок не с того смещения не принимается
+    assert client.patch(location, content=data[:10], headers={**chunk, "Upload-Offset": "0"}).status_code == 409
+    assert client.post(f"{location}/complete", headers=headers).status_code == 409
+
+    offset = client.head(location, headers=headers).headers["Upload-Offset"]
+    response = client.patch(location, content=data[int(offset):], headers={**chunk, "Upload-Offset": offset})
+    assert response.headers["Upload-Offset"] == str(len(data))
+
+    # Обработка не удалась (квоту заняли параллельно, пул перегружен): сессия и файл
+    # остаются, а загрузка с упавшей обработки не остаётся в БД и в квоте
+    async def no_quota(*args, **kwargs):
+        return False
+
+    async def busy(*args, **kwargs):
+        raise HTTPException(status_code=503, detail="Server is busy, try again later")
+
+    used_files = client.get("/usage", headers={"SECRET": SECRET}).json()["used_files"]
+    with monkeypatch.context() as patch:
+        patch.setattr(quotas, "charge", no_quota)
+        assert client.post(f"{location}/complete", headers=headers).status_code == 413
+    assert client.head(location, headers=headers).headers["Upload-Offset"] == str(len(data))
+    with monkeypatch.context() as patch:
+        patch.setattr("main.process_upload", busy)
+        assert client.post(f"{location}/complete", headers=headers).status_code == 503
+    assert client.head(location, headers=headers).headers["Upload-Offset"] == str(len(data))
+
+    response = client.post(f"{location}/complete", headers=headers)
+    assert response.status_code == 200
+    assert client.get("/usage", headers={"SECRET": SECRET}).json()["used_files"] == used_files + 1
+    assert response.json()[0]["file"] == "resume.jpg"
+    uploaded_files.extend(response.json()[0]["urls"].values())
+    assert client.head(location, headers=headers).status_code == 404
+
+
+def test_usage_quota(uploaded_files):
+    """Тестируем учёт места: загрузка и удаление меняют счётчики, исчерпанная квота — 413"""
+    api_key = f"test-{uuid.uuid4()}"
+    user_id = client.post("/users", json={"api_key": api_key}).json()["id"]
+    headers = {"SECRET": api_key}
+    try:
+        buffer = io.BytesIO()
+        Image.new("RGB", (640, 480), (40, 90, 160)).save(buffer, "JPEG")
+        response = client.post("/upload/file", files={"file": ("quota.jpg", buffer.getvalue(), "image/jpeg")},
+                               headers=headers)
+        assert response.status_code == 200
+        urls = list(response.json()[0]["urls"].values())
+        uploaded_files.extend(urls)
+
+        usage = client.get("/usage", headers=headers).json()
+        assert usage["used_files"] == 1
+        assert usage["used_bytes"] > len(buffer.getvalue())  # Исходник вместе с вариантами
+
+        response = client.put(f"/users/{user_id}/quota", json={"quota_bytes": usage["used_bytes"]},
+                              headers={"SECRET": SECRET})
+        assert response.status_code == 200
+        response = client.post("/upload/file", files={"file": ("quota.jpg", buffer.getvalue(), "image/jpeg")},
+                               headers=headers)
+        assert response.status_code == 413
+
+        client.post("/delete_files", json={"urls": urls[:1]}, headers=headers)
+        usage = client.get("/usage", headers=headers).json()
+        assert (usage["used_bytes"], usage["used_files"]) == (0, 0)
+    finally:
+        client.delete(f"/users/{user_id}", headers={"SECRET": SECRET})
+
+
+def test_invalid_upload_not_charged():
+    """Тестируем, что отклонённая проверкой загрузка не занимает квоту и не остаётся на диске"""
+    api_key = f"test-{uuid.uuid4()}"
+    user_id = client.post("/users", json={"api_key": api_key}).json()["id"]
+    headers = {"SECRET": api_key}
+    try:
+        # Заголовок PNG на 30000x30000 при крошечном теле: разрешение больше MAX_IMAGE_PIXELS
+        buffer = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(buffer, "PNG")
+        data = bytearray(buffer.getvalue())
+        data[16:24] = struct.pack(">II", 30000, 30000)
+        data[29:33] = struct.pack(">I", zlib.crc32(bytes(data[12:29])))
+        files = {"file": ("huge.png", bytes(data), "image/png")}
+        response = client.post("/upload/file", files=files, headers=headers)
+        assert response.status_code == 200
+        assert response.json()[0]["error"]
+
+        usage = client.get("/usage", headers=headers).json()
+        assert (usage["used_bytes"], usage["used_files"]) == (0, 0)
+        assert client.get("/media", headers=headers).json()["items"] == []
+
+        response = client.post("/upload/files", files=[("files", ("huge.png", bytes(data), "image/png"))],
+                               headers=headers)
+        assert response.status_code == 200
+        assert json.loads(response.text.splitlines()[0])["status_code"] == 400
+        usage = client.get("/usage", headers=headers).json()
+        assert (usage["used_bytes"], usage["used_files"]) == (0, 0)
+    finally:
+        client.delete(f"/users/{user_id}", headers={"SECRET": SECRET})
+
+
+def test_upload_small_image(uploaded_files):
+    """Тестируем изображение меньше всех PHOTO_SIZES: все размеры — ссылки на один вариант"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (100, 80), (200, 30, 30)).save(buffer, "PNG")
+    files = {"file": ("small.png", buffer.getvalue(), "image/png")}
+    response = client.post("/upload/file", files=files, headers={"SECRET": SECRET})
+
+    assert response.status_code == 200
+    urls = response.json()[0]["urls"]
+    uploaded_files.extend(urls.values())
+    assert set(urls) == set(LETTERS)
+    assert all(url.startswith(BASE_URL) for url in urls.values())
+    assert client.get(f"{SERVER_ID}/files/{os.path.basename(urls['xl'])}").status_code == 200
+
+
+@pytest.mark.parametrize("header", [
+    b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic",
+    b"\x00\x00\x00\x14ftypabcd\x00\x00\x00\x00abcd",
+])
+def test_upload_unknown_ftyp_brand(header):
+    """Тестируем, что HEIC и неизвестные бренды ftyp не принимаются за видео"""
+    files = {"file": ("photo.mp4", header + b"\x00" * 1024, "video/mp4")}
+    response = client.post("/upload/file", files=files, headers={"SECRET": SECRET})
+    assert response.status_code == 400
+
+
+@pytest.mark.skipif("avif" not in supported_formats(), reason="Pillow без AVIF")
+def test_upload_avif(uploaded_files):
+    """Тестируем, что AVIF распознаётся по бренду ftyp и обрабатывается как изображение"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (320, 240), (30, 160, 90)).save(buffer, "AVIF")
+    response = client.post("/upload/file", files={"file": ("photo.avif", buffer.getvalue(), "image/avif")},
+                           headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    assert response.json()[0]["type"] == "image"
+    uploaded_files.extend(response.json()[0]["urls"].values())
+
+
+def test_upload_files_batch(uploaded_files):
+    """Тестируем пакетную загрузку: NDJSON по строке на файл, ошибочный файл не ломает пакет"""
+    def png(color):
+        buffer = io.BytesIO()
+        Image.new("RGB", (900, 700), color).save(buffer, "PNG")
+        return buffer.getvalue()
+
+    files = [
+        ("files", ("red.png", png((200, 30, 30)), "image/png")),
+        ("files", ("notes.txt", b"not a media file" * 8, "text/plain")),
+        ("files", ("blue.png", png((30, 30, 200)), "image/png")),
+    ]
+    response = client.post("/upload/files", files=files, headers={"SECRET": SECRET})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = {item["index"]: item for item in map(json.loads, response.text.splitlines())}
+    assert sorted(lines) == [0, 1, 2]
+    assert lines[1]["status_code"] == 400
+    for index in (0, 2):
+        assert lines[index]["type"] == "image"
+        assert lines[index]["file"] == files[index][1][0]
+        uploaded_files.extend(lines[index]["urls"].values())
+
+
+def test_list_media(uploaded_files):
+    """Тестируем GET /media: курсорная пагинация без повторов и фильтр по типу"""
+    for color in ((10, 120, 10), (10, 10, 120)):
+        buffer = io.BytesIO()
+        Image.new("RGB", (320, 240), color).save(buffer, "PNG")
+        response = client.post("/upload/file", files={"file": ("list.png", buffer.getvalue(), "image/png")},
+                               headers={"SECRET": SECRET})
+        assert response.status_code == 200
+        uploaded_files.extend(response.json()[0]["urls"].values())
+
+    response = client.get("/media", params={"limit": 1, "type": "image"}, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    first = response.json()
+    assert len(first["items"]) == 1 and first["next_cursor"]
+    assert first["items"][0]["type"] == "image"
+    assert set(first["items"][0]["urls"]) == set(LETTERS)
+
+    response = client.get("/media", params={"limit": 1, "type": "image", "cursor": first["next_cursor"]},
+                          headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    assert response.json()["items"][0]["id"] != first["items"][0]["id"]
+
+    assert client.get("/media", params={"cursor": "broken"}, headers={"SECRET": SECRET}).status_code == 400
+
+
 def test_create_blured(uploaded_files):
     """Тестируем создание размытого изображения"""
     file_path = os.path.join(TEST_FILES_DIR, "image.jpg")
@@ -101,25 +420,129 @@ def test_upload_avatar(uploaded_files):
         uploaded_files.append(v)
 
 
+def test_blur_avatar_survives_gc(uploaded_files):
+    """Размытые копии аватара без записей в БД сборщик мусора не удаляет"""
+    with open(os.path.join(TEST_FILES_DIR, "image.jpg"), "rb") as file:
+        response = client.post("/upload/avatar", files={"file": ("avatar.jpg", file, "image/jpeg")},
+                               headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    avatar = next(url for url in response.json()["result"]["urls"].values() if url)
+    uploaded_files.append(avatar)
+
+    response = client.post("/blur_image", json={"url": avatar}, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    blurred = [url for url in response.json()["blurred_urls"].values() if url]
+    uploaded_files.extend(blurred)
+
+    # Состариваем только файлы этого теста, остальные моложе grace-периода
+    names = [os.path.basename(url) for url in [avatar, *blurred]]
+    for name in names:
+        os.utime(storage.resolve(name), (0, 0))
+    collector = StorageCollector(grace_period=3600, max_deletes_per_second=0, pause=0, batch=100, interval=0)
+    asyncio.run(collector.collect())
+    for name in names:
+        assert storage.resolve(name) is not None, f"Сборщик удалил {name}"
+
+
+def test_admission_queue_full(monkeypatch):
+    """При заполненной полосе допуска — сразу 503 с Retry-After, тело не принимается"""
+    lane = admission.lanes["image"]
+    monkeypatch.setattr(lane, "concurrency", 0)
+    monkeypatch.setattr(lane, "queue_size", 0)
+    rejected = lane.rejected
+
+    files = {"file": ("image.jpg", io.BytesIO(b"\xff\xd8\xff" + b"0" * 1024), "image/jpeg")}
+    response = client.post("/upload/avatar", files=files, headers={"SECRET": SECRET})
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    assert lane.rejected == rejected + 1
+
+    stats = client.get("/stats", headers={"SECRET": SECRET}).json()
+    assert stats["admission"]["image"]["rejected"] == lane.rejected
+    assert 'media_admission_rejected_total{lane="image"}' in client.get("/metrics", headers={"SECRET": SECRET}).text
+
+
 def test_delete_files(uploaded_files):
-    """Тестируем удаление загруженного файла"""
-    file_to_delete = "video.mp4"
-    file_path = os.path.join(UPLOADS_DIR, file_to_delete)
+    """Тестируем удаление загруженного видео вместе с превью"""
+    with open(os.path.join(TEST_FILES_DIR, "video.mp4"), "rb") as file:
+        files = {"file": ("video.mp4", file, "video/mp4")}
+        response = client.post("/upload/file", files=files, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    urls = response.json()[0]["urls"]
+    uploaded_files.append(urls["video"])
+    uploaded_files.extend(urls["preview"].values())
 
-    if not os.path.exists(file_path):
-        with open(os.path.join(TEST_FILES_DIR, file_to_delete), "rb") as file:
-            files = {"file": (file_to_delete, file, "image/jpeg")}
+    # Достаточно любой ссылки из ответа, например превью
+    missing_url = f"{BASE_URL}/{uuid.uuid4().hex}.mp4"
+    response = client.post("/delete_files", json={"urls": [urls["preview"]["s"], missing_url]},
+                           headers={"SECRET": SECRET})
 
-            response = client.post("/upload/file", files=files,headers={"SECRET":SECRET})
-            assert response.status_code == 200
-            uploaded_files.append(response.json()[0]["urls"]["video"])
-            uploaded_files.extend(response.json()[0]["urls"]["preview"].values())
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"url": urls["preview"]["s"], "status": "deleted"},
+        {"url": missing_url, "status": "not_found"},
+    ]
+    for url in [urls["video"], *urls["preview"].values()]:
+        assert storage.resolve(os.path.basename(url)) is None, "Файл не был удалён"
+
+
+@pytest.mark.skipif(not (shutil.which(FFMPEG_BINARY) and shutil.which("ffprobe")), reason="Нет ffmpeg/ffprobe")
+def test_video_sprite(uploaded_files, tmp_path):
+    """Тестируем ленту миниатюр видео: лист, индекс WebVTT по сетке и удаление вместе с видео"""
+    video_path = tmp_path / "sprite.mp4"
+    subprocess.run([FFMPEG_BINARY, "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=320x180:rate=25",
+                    "-t", "8", "-pix_fmt", "yuv420p", str(video_path)], check=True)
+    with open(video_path, "rb") as file:
+        response = client.post("/upload/file", files={"file": ("sprite.mp4", file, "video/mp4")},
+                               headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    urls = response.json()[0]["urls"]
+    uploaded_files.extend([urls["video"], urls["sprite"], urls["thumbnails"], *urls["preview"].values()])
 
-    response = client.post("/delete_files", json={"urls": [file_path]},headers={"SECRET":SECRET})
+    tile = (VIDEO_SPRITE_WIDTH, VIDEO_SPRITE_WIDTH * 180 // 320)
+    columns = min(VIDEO_SPRITE_COLUMNS, VIDEO_SPRITE_FRAMES)
+    rows = -(-VIDEO_SPRITE_FRAMES // columns)
+    response = client.get(urlparse(urls["sprite"]).path)
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).size == (columns * tile[0], rows * tile[1])
 
+    response = client.get(urlparse(urls["thumbnails"]).path)
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "WEBVTT"
+    targets = [line for line in lines if "#xywh=" in line]
+    assert len(targets) == VIDEO_SPRITE_FRAMES
+    for n, target in enumerate(targets):
+        x, y = n % columns * tile[0], n // columns * tile[1]
+        assert target == f"{urls['sprite']}#xywh={x},{y},{tile[0]},{tile[1]}"
+
+    response = client.post("/delete_files", json={"urls": [urls["video"]]}, headers={"SECRET": SECRET})
     assert response.status_code == 200
-    assert response.json() == {"message": "Files deleted successfully"}
-    assert not os.path.exists(file_path), "Файл не был удалён"
+    for url in (urls["sprite"], urls["thumbnails"]):
+        assert storage.resolve(os.path.basename(url)) is None, f"Файл {url} не был удалён"
+
+
+def test_delete_files_with_blurred(uploaded_files):
+    """Исходник остаётся на диске, а удаление забирает и варианты, и размытые копии"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (1200, 900), (90, 140, 60)).save(buffer, "JPEG")
+    response = client.post("/upload/file", files={"file": ("blur.jpg", buffer.getvalue(), "image/jpeg")},
+                           headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    urls = list(response.json()[0]["urls"].values())
+    original = client.get("/media", params={"limit": 1}, headers={"SECRET": SECRET}).json()["items"][0]["url"]
+    uploaded_files.extend([original, *urls])
+    assert storage.resolve(os.path.basename(original)) is not None, "Исходник удалён после обработки"
+
+    response = client.post("/blur_image", json={"url": original}, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    blurred = list(response.json()["blurred_urls"].values())
+    uploaded_files.extend(blurred)
+
+    response = client.post("/delete_files", json={"urls": [urls[0]]}, headers={"SECRET": SECRET})
+    assert response.json()["results"][0]["status"] == "deleted"
+    for url in [original, *urls, *blurred]:
+        assert storage.resolve(os.path.basename(url)) is None, f"Файл {url} не был удалён"
 
 
 def test_get_file(uploaded_files):
@@ -144,11 +567,138 @@ def test_get_file(uploaded_files):
     assert int(response.headers["content-length"]) > 0
 
 
-@pytest.mark.parametrize("test_string", ["Але", "banana", "cherry"])
-def test_image_from_string(test_string, uploaded_files):
-    """Тестируем генерацию изображения из строки."""
-    expected_filename = f"{test_string[0].upper()}"
+def test_get_file_variant(uploaded_files):
+    """Тестируем ленивый вариант изображения по ?w=&h=&fit="""
+    with open(os.path.join(TEST_FILES_DIR, "image.jpg"), "rb") as file:
+        files = {"file": ("image.jpg", file, "image/jpeg")}
+        response = client.post("/upload/file", files=files, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    urls = response.json()[0]["urls"]
+    uploaded_files.extend(urls.values())
+    filename = os.path.basename(urls["xl"].split("?")[0])
+
+    response = client.get(f"{SERVER_ID}/files/{filename}?w=150&h=150&fit=cover")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    # Повторный запрос отдаётся из кэша тем же файлом
+    again = client.get(f"{SERVER_ID}/files/{filename}?w=150&h=150&fit=cover")
+    assert again.headers["etag"] == response.headers["etag"]
+
+    response = client.get(f"{SERVER_ID}/files/{filename}?w=123&h=45")
+    assert response.status_code == 400
+
 
+def test_get_file_accept_webp(uploaded_files):
+    """Тестируем выбор формата по Accept: webp для тех, кто его принимает, иначе JPEG"""
+    with open(os.path.join(TEST_FILES_DIR, "image.jpg"), "rb") as file:
+        files = {"file": ("image.jpg", file, "image/jpeg")}
+        response = client.post("/upload/file", files=files, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    urls = response.json()[0]["urls"]
+    uploaded_files.extend(urls.values())
+    filename = os.path.basename(urls["m"])
+
+    response = client.get(f"{SERVER_ID}/files/{filename}", headers={"Accept": "image/webp,*/*"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["vary"] == "Accept"
+
+    response = client.get(f"{SERVER_ID}/files/{filename}", headers={"Accept": "*/*"})
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["vary"] == "Accept"
+
+
+def test_get_file_range_and_etag(uploaded_files):
+    """Тестируем Range-запросы и условный GET по ETag"""
+    file_path = os.path.join(TEST_FILES_DIR, "audio.mp3")
+    assert os.path.exists(file_path), "Файл audio.mp3 отсутствует в test_files"
+
+    with open(file_path, "rb") as file:
+        content = file.read()
+        file.seek(0)
+        files = {"file": ("audio.mp3", file, "audio/mpeg")}
+        response = client.post("/upload/file", files=files, headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    audio_url = response.json()[0]["urls"]["audio"]
+    uploaded_files.append(audio_url)
+    url = f"{SERVER_ID}/files/{os.path.basename(audio_url)}"
+
+    response = client.get(url, headers={"Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 0-99/{len(content)}"
+    assert response.content == content[:100]
+
+    response = client.get(url, headers={"Range": "bytes=0-9,20-29"})
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges")
+
+    response = client.get(url, headers={"Range": f"bytes={len(content)}-"})
+    assert response.status_code == 416
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
+    response = client.get(url, headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+def _response_bytes(path: str) -> float:
+    """media_http_response_bytes_total для GET по маршруту path из /metrics."""
+    prefix = f'media_http_response_bytes_total{{method="GET",route="{path}"}} '
+    lines = client.get("/metrics", headers={"SECRET": SECRET}).text.splitlines()
+    return next((float(line[len(prefix):]) for line in lines if line.startswith(prefix)), 0.0)
+
+
+@pytest.mark.parametrize("extension", ["http.response.pathsend", "http.response.zerocopysend"])
+def test_file_zero_copy_counted(uploaded_files, extension):
+    """Тело, которое отдаёт сам сервер через расширение ASGI, учитывается в байтах ответов"""
+    with open(os.path.join(TEST_FILES_DIR, "audio.mp3"), "rb") as file:
+        response = client.post("/upload/file", files={"file": ("audio.mp3", file, "audio/mpeg")},
+                               headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    audio_url = response.json()[0]["urls"]["audio"]
+    uploaded_files.append(audio_url)
+    filename = os.path.basename(audio_url)
+    size = os.path.getsize(storage.resolve(filename))
+    route = f"/{SERVER_ID}/files/{{filename}}"
+    before = _response_bytes(route)
+
+    # TestClient не объявляет расширения, поэтому вызываем приложение как сервер с их поддержкой
+    async def serve() -> list:
+        path = f"/{SERVER_ID}/files/{filename}"
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+                 "root_path": "", "headers": [(b"host", b"testserver")], "client": ("testclient", 50000),
+                 "server": ("testserver", 80), "extensions": {extension: {}}}
+        disconnected = asyncio.Event()
+        sent = []
+
+        async def receive():
+            if not sent:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await app(scope, receive, send)
+        return sent
+
+    messages = asyncio.run(serve())
+    assert messages[0]["status"] == 200
+    assert extension in [message["type"] for message in messages]
+    assert _response_bytes(route) == before + size
+
+
+@pytest.mark.parametrize("test_string, expected_filename", [
+    ("Але", "А"),
+    ("banana", "B"),
+    ("cherry", "C"),
+    ("Иван Петров", "ИП"),
+])
+def test_image_from_string(test_string, expected_filename):
+    """Тестируем генерацию аватара из строки."""
     # Отправляем запрос
     response = client.post(f"/upload/from_string/{test_string}",headers={"SECRET":SECRET} )
     assert response.status_code == 200
@@ -157,12 +707,105 @@ def test_image_from_string(test_string, uploaded_files):
     assert "result" in data
     assert data["result"]["file"] == expected_filename
 
-    # Проверяем, что сгенерированы все файлы с правильными путями
-    for n, size in enumerate(AVATAR_SIZES_STRINGS):
-        expected_file_path = os.path.join(UPLOAD_DIR, f"{expected_filename}_{size}.jpg")
-        expected_url = f"{BASE_URL}/{quote(expected_filename)}_{size}.jpg"
+    # Цвет выбирается по строке, поэтому повторный запрос даёт те же ссылки
+    again = client.post(f"/upload/from_string/{test_string}", headers={"SECRET": SECRET})
+    assert again.json() == data
 
-        # Приводим путь к универсальному формату
-        assert data["result"]["urls"][LETTERS[n]].replace("\\", "/") == expected_url
-        assert os.path.exists(expected_file_path), f"Файл {expected_file_path} не был создан"
+    for n, size in enumerate(AVATAR_SIZES_STRINGS):
+        url = data["result"]["urls"][LETTERS[n]]
+        assert url.startswith(f"{BASE_URL}/{quote(expected_filename)}_{size}_")
 
+        response = client.get(f"{SERVER_ID}/files/{os.path.basename(url)}")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+        width, height = map(int, size.split("x"))
+        assert Image.open(io.BytesIO(response.content)).size == (width, height)
+        # ETag от содержимого, а не от имени: другой рендер под тем же именем получит новый
+        assert response.headers["etag"] == f'"{hashlib.md5(response.content).hexdigest()}"'
+        assert "immutable" not in response.headers["cache-control"]
+        cached = client.get(f"{SERVER_ID}/files/{os.path.basename(url)}",
+                            headers={"If-None-Match": response.headers["etag"]})
+        assert cached.status_code == 304
+
+
+def test_metrics():
+    """Тестируем /metrics: формат Prometheus, запросы считаются по шаблону маршрута"""
+    client.get(f"{SERVER_ID}/files/missing.jpg")
+    assert client.get("/metrics").status_code == 403
+
+    response = client.get("/metrics", headers={"SECRET": SECRET})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE media_http_request_duration_seconds histogram" in response.text
+    assert f'route="/{SERVER_ID}/files/{{filename}}"' in response.text
+    assert 'media_queue_depth{queue="worker_pool"}' in response.text
+
+
+def test_media_backends_imported_lazily():
+    """Импорт main не тянет ffmpeg, mutagen и numpy: они грузятся в пуле при первом использовании"""
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    script = "import sys, main; print(','.join(m for m in ('ffmpeg', 'mutagen', 'numpy') if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env=env, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
+
+
+def test_worker_pool_timeout_kills_hung_task():
+    """Зависшая задача по таймауту убивается вместе с процессом, и место в пуле сразу освобождается"""
+    pool = WorkerPool(1, 1, 60, WORKER_START_METHOD)
+
+    async def run():
+        try:
+            with pytest.raises(HTTPException) as error:
+                await pool.run(time.sleep, 3600, timeout=3)
+            assert error.value.status_code == 504
+            return await pool.run(time.time, timeout=20)
+        finally:
+            pool.shutdown()
+
+    assert asyncio.run(run()) > 0
+    assert not pool._retired and not pool._futures
+
+
+# Прирост пикового RSS процесса пула при обработке снимка на 120 МП (полный растр — ~460 МБ)
+DECODE_RSS_CEILING_MB = 160
+
+# Выполняется в отдельном процессе с тем же потолком памяти, что у процессов пула
+DECODE_SCRIPT = """
+import json, sys
+from fastapi import HTTPException
+import services, storage, workers
+from conf import PHOTO_SIZES
+
+def peak_mb():
+    with open("/proc/self/status") as status:
+        return next(int(line.split()[1]) for line in status if line.startswith("VmHWM:")) / 1024
+
+workers.limit_memory(workers.WORKER_MEMORY_LIMIT)
+before = peak_mb()
+try:
+    urls = services.resize_image(sys.argv[1], PHOTO_SIZES)
+    status = 200
+    storage.remove_many([url.rsplit("/", 1)[1] for url in set(urls.values())])
+except HTTPException as e:
+    status = e.status_code
+print(json.dumps({"status": status, "growth_mb": peak_mb() - before}))
+"""
+
+
+@pytest.mark.parametrize("fmt, expected_status", [("JPEG", 200), ("PNG", 413)])
+def test_resize_huge_image_memory(tmp_path, fmt, expected_status):
+    """Снимок на 120 МП: JPEG декодируется уменьшенным, PNG больше MAX_DECODE_PIXELS
+    отклоняется по заголовку. В обоих случаях пиковый RSS не растёт до полного растра"""
+    size = (12000, 10000)
+    assert size[0] * size[1] > MAX_DECODE_PIXELS
+    path = str(tmp_path / f"huge.{fmt.lower()}")
+    Image.new("RGB", size, (180, 120, 60)).save(path, fmt)
+
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    result = subprocess.run([sys.executable, "-c", DECODE_SCRIPT, path], capture_output=True, text=True,
+                            env=env, timeout=120)
+    assert result.returncode == 0, result.stderr
+    data = json.loads(result.stdout.splitlines()[-1])
+    assert data["status"] == expected_status
+    assert data["growth_mb"] < DECODE_RSS_CEILING_MB
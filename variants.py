@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+import metrics
+import storage
+from conf import VARIANT_CACHE_DIR, VARIANT_CACHE_MAX_BYTES, VARIANT_SIZES
+
+VARIANT_FITS = ("contain", "cover")
+
+
+def variant_name(source: str, size: tuple, fit: str) -> str:
+    """Имя варианта в кэше: <исходник без расширения>_<w>x<h>_<fit>.jpg"""
+    return f"{os.path.splitext(source)[0]}_{size[0]}x{size[1]}_{fit}.jpg"
+
+
+def variant_names(source: str) -> list[str]:
+    """Все возможные варианты исходника, для удаления вместе с ним."""
+    return [variant_name(source, size, fit) for size in VARIANT_SIZES for fit in VARIANT_FITS]
+
+
+def is_variant_source(name: str) -> bool:
+    """Ленивые варианты строятся только из исходника <stem>.<ext> и превью видео <stem>_preview.jpg."""
+    root = os.path.splitext(name)[0]
+    stem = storage.stem(name)
+    return root == stem or root == f"{stem}_preview"
+
+
+def _unlink_many(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class VariantCache:
+    """Дисковый кэш вариантов изображений с ограничением размера и вытеснением LRU.
+
+    Одинаковые одновременные запросы ждут один рендер. Порядок LRU хранится
+    в памяти процесса и при старте восстанавливается по atime файлов; каждый
+    воркер uvicorn следит за своим лимитом, но видит файлы, отрендеренные
+    соседями.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = OrderedDict()
+        self._inflight = {}
+        self._load_lock = None
+        self._loaded = False
+
+    def _path(self, name: str) -> str:
+        digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], name)
+
+    def _scan(self) -> list[tuple[str, int]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat_result = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat_result.st_atime, name, stat_result.st_size))
+        entries.sort()
+        return [(name, size) for _, name, size in entries]
+
+    async def _load(self):
+        if self._loaded:
+            return
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for name, size in await run_in_threadpool(self._scan):
+                self._index[name] = size
+                self.size += size
+            self._loaded = True
+
+    async def warm_up(self):
+        """Индексирует каталог кэша при старте, а не на первом запросе."""
+        await self._load()
+
+    async def get_or_render(self, name: str, render) -> str:
+        """Путь к варианту; при промахе вызывает await render(path) один раз на все запросы."""
+        await self._load()
+        path = self._path(name)
+        if await run_in_threadpool(os.path.isfile, path):
+            self.hits += 1
+            if name in self._index:
+                self._index.move_to_end(name)
+            else:  # Отрендерил другой воркер
+                await self._add(name, path)
+            return path
+
+        self.misses += 1
+        future = self._inflight.get(name)
+        if future is None:
+            future = asyncio.ensure_future(self._render(name, path, render))
+            self._inflight[name] = future
+            future.add_done_callback(lambda _: self._inflight.pop(name, None))
+        # Отключившийся клиент не должен отменять рендер для остальных
+        return await asyncio.shield(future)
+
+    async def _render(self, name: str, path: str, render) -> str:
+        await run_in_threadpool(os.makedirs, os.path.dirname(path), exist_ok=True)
+        await render(path)
+        await self._add(name, path)
+        return path
+
+    async def _add(self, name: str, path: str):
+        try:
+            size = await run_in_threadpool(os.path.getsize, path)
+        except FileNotFoundError:
+            return
+        self.size += size - self._index.pop(name, 0)
+        self._index[name] = size
+
+        evicted = []
+        while self.size > self.max_bytes and len(self._index) > 1:
+            old_name, old_size = self._index.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+            evicted.append(self._path(old_name))
+        if evicted:
+            await run_in_threadpool(_unlink_many, evicted)
+
+    async def discard(self, names, stems=()):
+        """Удаляет варианты вместе с исходником (delete_files).
+
+        Кроме перечисленных имён удаляются все известные процессу варианты
+        загрузок stems; остальные вытеснит LRU.
+        """
+        names = set(names)
+        if stems:
+            stems = set(stems)
+            names.update(name for name in self._index if storage.stem(name) in stems)
+        paths = []
+        for name in names:
+            self.size -= self._index.pop(name, 0)
+            paths.append(self._path(name))
+        await run_in_threadpool(_unlink_many, paths)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "files": len(self._index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "rendering": len(self._inflight),
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+variant_cache = VariantCache(VARIANT_CACHE_DIR, VARIANT_CACHE_MAX_BYTES)
+metrics.register_cache("variants", variant_cache.stats)
+metrics.register_queue("variant_renders", lambda: len(variant_cache._inflight))
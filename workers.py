@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+
+import metrics
+from conf import WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, WORKER_TASK_TIMEOUT, WORKER_START_METHOD, WORKER_MEMORY_LIMIT
+
+task_seconds = metrics.Histogram("media_worker_task_duration_seconds",
+                                 "Worker pool task time including queue wait", ("task",))
+
+# Порядок выдачи свободных процессов: рендер для get_file идёт вперёд загрузок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+
+
+class WorkerError(Exception):
+    """HTTPException из дочернего процесса (сам HTTPException не переживает pickle)."""
+
+    def __init__(self, status_code: int, detail):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def limit_memory(limit: int):
+    """Выполняется в каждом дочернем процессе при старте: потолок адресного пространства.
+
+    Крупная аллокация сверх limit даёт MemoryError в задаче, процесс остаётся жив.
+    """
+    if limit:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _call(func, args, kwargs):
+    """Выполняется в дочернем процессе. Возвращает результат и тайминги этапов (metrics.stage)."""
+    metrics.collect_stages()
+    try:
+        return func(*args, **kwargs), metrics.take_stages()
+    except HTTPException as e:
+        raise WorkerError(e.status_code, e.detail)
+    except MemoryError:
+        raise WorkerError(413, "File is too large to process")
+    finally:
+        metrics.take_stages()
+
+
+class WorkerPool:
+    """Пул процессов для CPU-тяжёлой работы с ограниченной очередью и таймаутами.
+
+    Одновременно принимается не больше size + queue_size задач, остальные сразу
+    получают 503; задачи PRIORITY_INTERACTIVE в этот лимит не упираются.
+    Задача занимает место, пока реально не завершилась в дочернем процессе,
+    поэтому задачи, отвалившиеся по таймауту, не дают переполнить пул. Executor
+    с зависшей задачей выводится из работы: новые задачи идут в новый, а процессы
+    старого убиваются, когда в нём остаются только зависшие задачи (_retire).
+
+    В executor отправляется не больше size задач: очередь ждущих своя, и
+    освободившийся процесс получает задача с меньшим priority, а не та, что
+    пришла раньше. memory_limit — потолок памяти каждого процесса (limit_memory).
+    """
+
+    def __init__(self, size: int, queue_size: int, timeout: float, start_method: str, memory_limit: int = 0):
+        self.size = size
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.start_method = start_method
+        self.memory_limit = memory_limit
+        self._executor = None
+        self._in_flight = 0
+        self._busy = 0  # Процессы, отданные задачам
+        self._waiters = []  # (priority, порядок, future) задач, ждущих процесс
+        self._order = itertools.count()
+        self._futures = {}  # executor -> его незавершённые задачи
+        self._hung = set()  # Задачи, отвалившиеся по таймауту во время выполнения
+        self._retired = {}  # Выведенный executor -> его процессы
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.size,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=limit_memory,
+                initargs=(self.memory_limit,),
+            )
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _shutdown(self, executor):
+        """shutdown() после BrokenProcessPool, если упал текущий executor, а не уже выведенный."""
+        if executor is self._executor:
+            self.shutdown()
+
+    async def _acquire_worker(self, priority: int):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self._busy < self.size and not self._waiters:
+            self._busy += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Процесс уже передан этой задаче — отдаём следующей
+                self._release_worker()
+            raise
+
+    def _release_worker(self):
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)[2]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._busy -= 1
+
+    def _release(self, loop, executor):
+        def callback(future):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._done, executor, future)
+        return callback
+
+    def _done(self, executor=None, future=None):
+        self._in_flight -= 1
+        self._release_worker()
+        if executor is not None:
+            self._hung.discard(future)
+            futures = self._futures[executor]
+            futures.discard(future)
+            if not futures:
+                del self._futures[executor]
+            self._reap(executor)
+
+    def _retire(self, executor, future):
+        """Выводит из работы executor, в котором зависла задача future."""
+        self._hung.add(future)
+        if executor is self._executor:
+            # После shutdown() executor забывает свои процессы
+            self._retired[executor] = list(executor._processes.values())
+            self._executor = None
+            executor.shutdown(wait=False)
+        self._reap(executor)
+
+    def _reap(self, executor):
+        """Убивает процессы выведенного executor, если в нём остались только зависшие задачи.
+
+        Их future завершаются с BrokenProcessPool, и _done освобождает места в пуле.
+        """
+        if executor not in self._retired or not self._futures.get(executor, set()) <= self._hung:
+            return
+        for process in self._retired.pop(executor):
+            process.kill()
+
+    async def warm_up(self, func, *args) -> list:
+        """Запускает процессы пула заранее и выполняет в них func (импорт тяжёлых библиотек).
+
+        Задач столько же, сколько процессов, и первая в процессе идёт долго,
+        поэтому обычно каждая попадает в свой процесс.
+        """
+        return await asyncio.gather(*(self.run(func, *args) for _ in range(self.size)))
+
+    async def run(self, func, *args, timeout: float = None, priority: int = PRIORITY_NORMAL, **kwargs):
+        if priority != PRIORITY_INTERACTIVE and self._in_flight >= self.size + self.queue_size:
+            raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                                headers={"Retry-After": "1"})
+
+        timeout = timeout or self.timeout
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        self._in_flight += 1
+        try:
+            try:
+                await asyncio.wait_for(self._acquire_worker(priority), timeout)
+            except BaseException:
+                self._in_flight -= 1
+                raise
+            executor = self.start()
+            try:
+                future = executor.submit(_call, func, args, kwargs)
+            except BrokenProcessPool:
+                self._done()
+                self._shutdown(executor)
+                raise HTTPException(status_code=503, detail="Worker pool restarted, try again later",
+                                    headers={"Retry-After": "1"})
+            self._futures.setdefault(executor, set()).add(future)
+            future.add_done_callback(self._release(loop, executor))
+
+            waited = asyncio.wrap_future(future)
+            try:
+                result, stages = await asyncio.wait_for(asyncio.shield(waited),
+                                                        timeout - (time.perf_counter() - start))
+            except asyncio.TimeoutError:
+                # Результат или ошибка уже никому не нужны
+                waited.add_done_callback(lambda done: done.cancelled() or done.exception())
+                if not future.cancel():
+                    # Задача уже в процессе и может не завершиться никогда
+                    self._retire(executor, future)
+                raise
+            metrics.observe_stages(stages)
+            return result
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Processing timed out")
+        except WorkerError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except BrokenProcessPool:
+            # Дочерний процесс упал (например, OOM) — пересоздаём пул при следующем вызове
+            self._shutdown(executor)
+            raise HTTPException(status_code=500, detail="Worker process crashed")
+        finally:
+            task_seconds.observe(time.perf_counter() - start, func.__name__)
+
+
+pool = WorkerPool(WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, WORKER_TASK_TIMEOUT, WORKER_START_METHOD,
+                  WORKER_MEMORY_LIMIT)
+metrics.register_queue("worker_pool", lambda: pool.in_flight)
+
+
+async def run_in_pool(func, *args, **kwargs):
+    """Выполняет функцию из services в пуле процессов, не блокируя event loop."""
+    return await pool.run(func, *args, **kwargs)